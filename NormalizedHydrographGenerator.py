@@ -1,51 +1,61 @@
 import streamlit as st
 import pandas as pd
 import os
+import uuid
 import numpy as np
 
 
-from app.data_io import GetFlow, read_data
-from app.helpers import CreateFolder, log_progress
-from app.plotting import plot_hydrograph
-from app.peak_detection import DetectAndSavePeaks, update_peaks_data
-from app.smoothing import (
-    apply_gaussian_smoothing,
-    create_dimensionless_unit_hydrograph,
-    process_smoothed_files,
+from app.data_io import discharge_path
+from app.site_store import (SiteStore, save_event, save_smoothed, save_duh, list_events,
+                            load_event, event_number)
+from app.event_batch import process_all_events
+from app.sigma_sweep import best_sigma, DEFAULT_MIN_NSE, DEFAULT_MAX_PEAK_ATTENUATION
+from app.helpers import CreateFolder, log_progress, wait_for_background_task, flush_logs
+from app.instrumentation import TimingReport, set_report, set_memory_tracking
+from app.rendering import Figures
+from app.downsampling import DEFAULT_POINT_BUDGET
+from app.peak_detection import save_filtered_peaks, update_peaks_data
+from app.ui_cache import (detect_peaks, prominence_index, load_peaks_and_discharge, event_windows, smooth_event,
+                          job_queue)
+from app.smoothing import create_dimensionless_unit_hydrograph
+from app.jobs import InlineJob, download_task, detect_peaks_task, overall_duh_task
+from app.charts import (
+    streamlit_notify,
+    plot_hydrograph,
+    plot_smoothed_hydrograph,
+    plot_sigma_sweep,
+    plot_peak_count_curve,
     plot_duhs
 )
 
-# Function to get a subset of discharge data around a specified peak date
-def get_storm_hydrograph(discharge_data, peak_date, window_size_before, window_size_after):
-    if peak_date in discharge_data.index:
-        peak_idx = discharge_data.index.get_loc(peak_date)
-    else:
-        print(f"Peak date {peak_date} not found in discharge data.")
-        return None
-
-    start = max(peak_idx - window_size_before, 0)
-    end = min(peak_idx + window_size_after, len(discharge_data))
-    return discharge_data.iloc[start:end]
-
-# Function to process peak events and plot hydrographs in a Streamlit application
-def process_peaks(peaks_df, discharge_data):
+# Function to process peak events and plot hydrographs in a Streamlit application; windows is the
+# memoized events.EventWindows of the discharge record (ui_cache.event_windows)
+def process_peaks(peaks_df, windows, max_points=DEFAULT_POINT_BUDGET, storage='csv'):
     if 'events' not in st.session_state:
         st.session_state['events'] = {}
 
-    for event_no, row in enumerate(peaks_df.itertuples(), start=1):
-        event_key = f'event_{event_no}'
-        if event_key not in st.session_state['events']:
-            st.session_state['events'][event_key] = {'processed': False, 'window_before': 200, 'window_after': 200}
+    event_numbers = range(1, len(peaks_df) + 1)
+    for event_no in event_numbers:
+        if f'event_{event_no}' not in st.session_state['events']:
+            st.session_state['events'][f'event_{event_no}'] = {'processed': False, 'window_before': 50, 'window_after': 50}
 
-        peak_date = pd.to_datetime(row.Peak_Date)
+    # Cut every event window in one call, using the slider values of this rerun (window sizes in hours)
+    hours_before = [st.session_state.get(f'window_before_{event_no}', st.session_state['events'][f'event_{event_no}']['window_before'])
+                    for event_no in event_numbers]
+    hours_after = [st.session_state.get(f'window_after_{event_no}', st.session_state['events'][f'event_{event_no}']['window_after'])
+                   for event_no in event_numbers]
+    storm_hydrographs = windows.windows(peaks_df['Peak_Date'], hours_before, hours_after)
+
+    for event_no, storm_hydrograph in zip(event_numbers, storm_hydrographs):
+        event_key = f'event_{event_no}'
         st.markdown(f"### Event {event_no}")
 
-        window_before = st.slider(f"Window size before the peak for Event {event_no}",
-                                  min_value=0, max_value=2000,
+        window_before = st.slider(f"Hours before the peak for Event {event_no}",
+                                  min_value=0, max_value=500,
                                   value=st.session_state['events'][event_key]['window_before'],
                                   key=f'window_before_{event_no}')
-        window_after = st.slider(f"Window size after the peak for Event {event_no}",
-                                 min_value=0, max_value=2000,
+        window_after = st.slider(f"Hours after the peak for Event {event_no}",
+                                 min_value=0, max_value=500,
                                  value=st.session_state['events'][event_key]['window_after'],
                                  key=f'window_after_{event_no}')
 
@@ -57,18 +67,163 @@ def process_peaks(peaks_df, discharge_data):
             }
 
         if st.session_state['events'][event_key]['processed']:
-            storm_hydrograph = get_storm_hydrograph(discharge_data, peak_date, window_before, window_after)
-            if storm_hydrograph is not None:
-                plot_hydrograph(storm_hydrograph)
+            if storm_hydrograph is None or storm_hydrograph.empty:
+                st.warning(f"No discharge data found around the peak of Event {event_no}.")
+                continue
+            plot_hydrograph(storm_hydrograph, max_points)
 
             if st.button("Save this hydrograph", key=f'save_{event_no}'):
-                year = storm_hydrograph.index[0].year if not pd.isnull(storm_hydrograph.index[0]) else "unknown_year"
-                save_dir = st.session_state.USGS_data  
-                save_path = os.path.join(save_dir, f"Event_{event_no}_{year}.csv")
-                log_progress(st.session_state.USGS_data, f"Saved Event {event_no} hydrograph to Event_{event_no}_{year}.csv")
-                storm_hydrograph.to_csv(save_path)
-                st.success(f"Event {event_no} saved to {save_path}.")
-
+                saved_as = save_event(st.session_state.USGS_data, event_no, storm_hydrograph, storage)
+                log_progress(st.session_state.USGS_data, f"Saved Event {event_no} hydrograph to {saved_as}")
+                st.success(f"Event {event_no} saved to {describe_saved(st.session_state.USGS_data, saved_as, storage)}.")
+
+
+
+# Function to cut, smooth and normalize every peak in one pass with automatic windows
+def process_all_peaks(peaks_df, discharge_data, storage='csv', baseflow='first', baseflow_slope=None):
+    col1, col2, col3, col4 = st.columns(4)
+    max_hours_before = col1.number_input("Max hours before the peak", min_value=1, max_value=1000, value=72)
+    max_hours_after = col2.number_input("Max hours after the peak", min_value=1, max_value=2000, value=240)
+    recession_fraction = col3.number_input("Recession end (fraction of the rise)", min_value=0.0, max_value=1.0,
+                                           value=0.05, step=0.01,
+                                           help="An event ends when the flow falls back to baseflow plus this fraction of the rise.")
+    batch_sigma = col4.number_input("Sigma for Gaussian smoothing", min_value=0.0, max_value=100.0, value=10.0)
+    if st.checkbox("Choose sigma for each event automatically",
+                   help="The largest sigma that keeps NSE >= 0.99 and attenuates the peak by at most 5%."):
+        batch_sigma = 'auto'
+
+    if st.button("Process all events"):
+        progress_bar = st.progress(0.0, text="Writing event files...")
+        summary = process_all_events(discharge_data, peaks_df, st.session_state.USGS_data, batch_sigma,
+                                     max_hours_before=max_hours_before, max_hours_after=max_hours_after,
+                                     recession_fraction=recession_fraction, storage=storage,
+                                     baseflow=baseflow, baseflow_slope=baseflow_slope,
+                                     progress=lambda done, total: progress_bar.progress(done / total,
+                                                                                        text=f"Event {done} of {total}"))
+        progress_bar.empty()
+        st.session_state.all_events_summary = summary
+        st.success(f"Processed {int(summary['Processed'].sum())} of {len(summary)} events.")
+
+    if 'all_events_summary' in st.session_state:
+        st.dataframe(st.session_state.all_events_summary)
+
+
+# Sweep sigmas for the selected event and move the smoothing slider to the best one. Runs as a
+# button callback, i.e. before the slider is drawn on the next rerun.
+def suggest_sigma(USGS_data, event_name, storage):
+    event_data = load_event(USGS_data, event_name, storage)
+    sigma, sweep = best_sigma(event_data['discharge_cfs'], min_nse=st.session_state.sigma_min_nse,
+                              max_peak_attenuation=st.session_state.sigma_max_attenuation)
+    st.session_state.sigma_value = sigma
+    st.session_state.sigma_sweep = sweep
+
+
+def use_prominence(prominence_value):
+    st.session_state.prominence_value = prominence_value
+
+
+# Peak counts of the downloaded record over a range of prominences, from the memoized prominence
+# index: moving the slider is a lookup, not a new peak detection
+def explore_prominence(prominence_value, min_peak_gap):
+    index = prominence_index(st.session_state.discharge_filtered, st.session_state.discharge_key)
+    curve = index.count_curve()
+    if curve.empty:
+        st.write("The record has no peaks.")
+        return
+
+    options = sorted(set(float(f"{value:.3g}") for value in curve['Prominence']))
+    closest = options[int(np.argmin(np.abs(np.log(options) - np.log(max(prominence_value, options[0])))))]
+    explored = st.select_slider("Prominence to try", options=options, value=closest)
+    _, filtered = index.query(explored, min_peak_gap)
+    st.write(f"{index.peak_count(explored)} peaks with prominence of at least {explored:g}; "
+             f"{len(filtered)} left after the minimum time between peaks.")
+    plot_peak_count_curve(curve, explored, len(filtered))
+    st.button("Use this prominence", on_click=use_prominence, args=(explored,))
+
+
+# Where a result was saved, for the success messages
+def describe_saved(USGS_data, saved_as, storage):
+    if storage == 'store':
+        return f"site store entry {saved_as}"
+    return os.path.join(USGS_data, saved_as)
+
+
+# Stage timings of this rerun and of the whole session. The session's report is also saved as
+# timing_report.json/.csv in the site folder after every rerun that timed anything.
+def show_performance_panel(report, show, USGS_data):
+    if not report.frame(report.run).empty and USGS_data is not None and os.path.isdir(USGS_data):
+        report.save(USGS_data)
+    if not show:
+        return
+
+    with st.expander("Performance", expanded=True):
+        this_run = report.summary(report.run)
+        if this_run.empty:
+            st.write("Nothing was timed in this rerun (cached results were reused).")
+        else:
+            st.write("This rerun:")
+            st.dataframe(this_run, hide_index=True)
+        session = report.summary()
+        if not session.empty:
+            st.write("Whole session:")
+            st.bar_chart(session.set_index('Stage')['Seconds'])
+            st.dataframe(session, hide_index=True)
+            if USGS_data is not None:
+                st.caption(f"Saved to {os.path.join(USGS_data, 'timing_report.json')} and timing_report.csv")
+
+
+# Keep the result of a download, peak detection or overall DUH (a background job's, or one run in
+# the script) in the session
+def keep_result(kind, result):
+    if kind == 'download':
+        discharge_filtered, USGS_data, discharge_key, discharge_written = result
+        st.session_state.discharge_filtered, st.session_state.USGS_data = discharge_filtered, USGS_data
+        st.session_state.discharge_key = discharge_key
+        # The discharge file is still being written; the analysis waits for it (per site folder)
+        if 'discharge_writes' not in st.session_state:
+            st.session_state.discharge_writes = {}
+        st.session_state.discharge_writes[os.path.abspath(USGS_data)] = discharge_written
+        st.session_state.data_loaded = True
+    elif kind == 'peaks':
+        st.session_state.peaks_df = result
+    elif kind == 'overall_duh' and not result[0].empty:
+        # process_smoothed_files has already said why when there is nothing to combine
+        st.session_state.overall_duh_result = result
+        st.success("Normalized Hydrographs processed successfully.")
+
+
+# Hand this session's finished background jobs over to it, with the messages they sent
+def claim_finished_jobs(queue, session):
+    for job in queue.unclaimed(session):
+        for _, level, message in queue.messages(job['id']):
+            streamlit_notify(level, message)
+        result = queue.claim(job['id'])
+        if job['status'] == 'done':
+            keep_result(job['kind'], result)
+        elif job['status'] == 'failed':
+            st.error(f"{job['label']} failed: {job['error']}")
+            if job['site_key'] is not None and os.path.isdir(job['site_key']):
+                log_progress(job['site_key'], f"{job['label']} failed: {job['error']}")
+
+
+# Progress, latest messages and partial results of this session's running jobs, redrawn every
+# second. The whole page reruns once they have all finished, to pick up their results.
+@st.fragment(run_every=1)
+def show_jobs_panel(queue, session):
+    active = queue.jobs(session, active_only=True)
+    if not active:
+        st.rerun()
+    for job in reversed(active):
+        st.progress(job['progress'], text=f"{job['label']}: {job['message'] or job['status']}")
+        for _, level, message in queue.messages(job['id'])[-3:]:
+            st.caption(message)
+        partials = queue.partials(job['id'])
+        if 'peaks' in partials:
+            st.write(f"{len(partials['peaks'])} peaks found.")
+        if 'overall_duh' in partials:
+            st.line_chart(partials['overall_duh'].set_index('Normalized Time')['Normalized Discharge'])
+        if job['status'] == 'queued':
+            st.button("Cancel", key=f"cancel_{job['id']}", on_click=queue.cancel, args=(job['id'],))
 
 
 # Streamlit app main function
@@ -95,14 +250,44 @@ def main():
         - Click 'Detect and Save Peaks'
         - Review and filter peaks you want to keep
         ### Step 3: Process Events
-        - For each event, set time windows before/after the peak
+        - For each event, set the hours of data to keep before/after the peak
         - Save each hydrograph
+        - Or choose 'All events at once' to window, smooth and normalize every peak in one pass
         ### Step 4: Smoothing and DUH
         - Apply smoothing
         - Save results and generate Dimensionless Unit Hydrographs
         ### Final Step
         - Convert all saved hydrographs to a single normalized hydrograph
         """)
+
+        st.header("Charts")
+        # Interactive charts are downsampled (peaks kept exact) unless full resolution is requested
+        full_resolution = st.checkbox("Full resolution charts", value=False,
+                                      help="Send every sample to the browser, e.g. to zoom into a short window.")
+        max_points = None if full_resolution else st.number_input(
+            "Max points per chart line", min_value=200, max_value=50000, value=DEFAULT_POINT_BUDGET, step=100)
+
+        st.header("Performance")
+        show_performance = st.checkbox("Show performance panel", value=False,
+                                       help="Time spent in each stage (download, peak detection, plotting, smoothing, DUH interpolation).")
+        track_memory = st.checkbox("Track peak memory", value=False, disabled=not show_performance,
+                                   help="Adds each stage's peak memory to the report. Memory is traced for the whole "
+                                        "server, so this slows every session down while it is on.")
+
+        st.header("Jobs")
+        run_as_jobs = st.checkbox("Run long steps in the background", value=True,
+                                  help="Download, peak detection and the overall DUH run as jobs on the server: "
+                                       "the page stays usable and other users are not held up.")
+
+    # One timing report per session; every rerun is a new run of it
+    if 'timing_report' not in st.session_state:
+        st.session_state.timing_report = TimingReport("StreamSmith app")
+    else:
+        st.session_state.timing_report.new_run()
+    report = st.session_state.timing_report
+    report.track_memory = show_performance and track_memory
+    set_memory_tracking(report.track_memory, report)
+    set_report(report)
     st.write("""
         Developed by Mohsen Tahmasebi Nasab, PhD – https://www.hydromohsen.com/
     """)
@@ -129,6 +314,33 @@ def main():
     end_date = st.date_input("End Date (YYYY/MM/DD)", value=pd.to_datetime("2023-01-01"))
     output_folder = st.text_input("Output Folder")
 
+    figure_options = {
+        "Render in background": 'process',
+        "Render on request": 'defer',
+        "Don't save figures": 'off',
+    }
+    figure_choice = st.radio("Hydrograph figures (PNG/JPEG)", list(figure_options), horizontal=True)
+    # The mode and the deferred figures belong to this session; its jobs save figures into the same object
+    if 'figures' not in st.session_state:
+        st.session_state.figures = Figures()
+    figures = st.session_state.figures
+    figures.set_mode(figure_options[figure_choice])
+    deferred = figures.deferred_figures()
+    if deferred and st.button(f"Render {len(deferred)} deferred figures"):
+        rendered = figures.render_deferred()
+        st.success(f"Saved {len(rendered)} figures.")
+
+    storage_options = {
+        "CSV files": 'csv',
+        "Site store (Parquet)": 'store',
+    }
+    storage_choice = st.radio("Save events and DUHs as", list(storage_options), horizontal=True,
+                              help="The site store keeps typed tables in USGS{site}/site_store; CSV files can be exported from it.")
+    storage = storage_options[storage_choice]
+
+    parallel_requests = st.number_input("Parallel NWIS requests", min_value=1, max_value=8, value=1,
+                                        help="More than 1 splits long date ranges into chunks that are downloaded concurrently.")
+
     month_options = ["All"] + list(range(1, 13))
     selected_months = st.multiselect(
         "Select Months for Peak Detection",
@@ -142,15 +354,36 @@ def main():
     else:
         months = selected_months
 
+    # Jobs of this session: results of finished ones first, then the progress of the others
+    if 'job_session' not in st.session_state:
+        st.session_state.job_session = uuid.uuid4().hex
+    session = st.session_state.job_session
+    queue = job_queue()
+    claim_finished_jobs(queue, session)
+    if queue.jobs(session, active_only=True):
+        show_jobs_panel(queue, session)
+
+    # Jobs of one site folder run one after another
+    site_folder = os.path.abspath(os.path.join(output_folder, f"USGS{site_no}"))
+
     if st.button("Download Data"):
         if site_no and begin_date and end_date and output_folder and selected_months:
-            st.session_state.discharge_filtered, st.session_state.USGS_data = GetFlow(site_no, begin_date, end_date, output_folder, months)
-            st.session_state.data_loaded = True
+            download = (site_no, begin_date, end_date, output_folder, months)
+            options = dict(storage=storage, parallel_requests=parallel_requests, figures=figures)
+            if run_as_jobs:
+                queue.submit(session, 'download', download_task, *download, label=f"Download site {site_no}",
+                             site_key=site_folder, **options)
+                st.rerun()
+            keep_result('download', download_task(InlineJob(streamlit_notify), *download, **options))
 
     if st.session_state.get('data_loaded', False):
-        std_dev_suggestion = st.session_state.discharge_filtered['discharge_cfs'].std()
+        std_dev_suggestion = float(st.session_state.discharge_filtered['discharge_cfs'].std())
 
-        prominence_value = st.number_input("Prominence Value", value=std_dev_suggestion)
+        if st.session_state.get('prominence_key') != st.session_state.discharge_key:
+            # Each download starts from the suggested prominence
+            st.session_state.prominence_value = std_dev_suggestion
+            st.session_state.prominence_key = st.session_state.discharge_key
+        prominence_value = st.number_input("Prominence Value", key='prominence_value')
 
         st.caption("""
         **ℹ️ What is prominence?**  
@@ -169,17 +402,38 @@ def main():
         This helps avoid saving flat-topped hydrographs as separate storms.
         """)
 
+        peaks_by_year = st.checkbox("Detect peaks separately for each calendar year (legacy behaviour)", value=False)
+
+        if not peaks_by_year:
+            with st.expander("Explore prominence"):
+                explore_prominence(prominence_value, min_peak_gap)
+
 
         if st.button("Detect and Save Peaks"):
-            if st.session_state.get('data_loaded', False):
+            if run_as_jobs:
+                queue.submit(session, 'peaks', detect_peaks_task, st.session_state.discharge_filtered, prominence_value,
+                             st.session_state.USGS_data, site_no, min_peak_gap, by_year=peaks_by_year,
+                             figures=figures, label=f"Peaks of site {site_no}", site_key=site_folder)
+                st.rerun()
+            else:
                 try:
-                    # Run peak detection
-                    st.session_state.peaks_df = DetectAndSavePeaks(
+                    # Run peak detection (memoized on the downloaded data and the parameters)
+                    all_peaks_df, filtered_peaks_df = detect_peaks(
                         st.session_state.discharge_filtered,
+                        st.session_state.discharge_key,
+                        prominence_value,
+                        min_peak_gap,
+                        by_year=peaks_by_year
+                    )
+                    st.session_state.peaks_df = save_filtered_peaks(
+                        st.session_state.discharge_filtered,
+                        all_peaks_df,
+                        filtered_peaks_df,
                         prominence_value,
                         st.session_state.USGS_data,
                         site_no,
-                        min_peak_gap
+                        min_peak_gap,
+                        figures
                     )
                 except Exception as e:
                     st.error(f"An error occurred during peak detection: {e}")
@@ -199,7 +453,7 @@ def main():
             # Show input for indices only if peaks are available
             indices_to_keep = st.text_input("Enter the indices to keep (comma-separated, e.g., 500, 705, 2706):", key="indices_to_keep")
             if st.button("Update Peaks Data"):
-                update_peaks_data(peaks_file_path, indices_to_keep)
+                update_peaks_data(peaks_file_path, indices_to_keep, notify=streamlit_notify)
                 st.session_state.update_triggered = True
 
         elif "peaks_df" in st.session_state:
@@ -207,26 +461,60 @@ def main():
 
 
 
-        discharge_file_path = os.path.join(output_folder, f"USGS{site_no}", f"USGS_Discharge_{site_no}.csv")
+        discharge_file_path = discharge_path(os.path.join(output_folder, f"USGS{site_no}"), site_no, storage)
+        if st.session_state.get('update_triggered', False):
+            # The discharge record of this session's download is written in the background; a failed
+            # write is already in the site's log
+            discharge_written = st.session_state.get('discharge_writes', {}).get(site_folder)
+            if not wait_for_background_task(discharge_written):
+                st.warning(f"The discharge record could not be saved; see {os.path.join(site_folder, 'nuhg_log.txt')}.")
         if st.session_state.get('update_triggered', False) and os.path.exists(discharge_file_path):
             st.title("Hydrograph Analysis Tool")
             if st.button("Start the Analysis"):
                 st.session_state.start_analysis = True
 
         if st.session_state.get('start_analysis', False):
-            peaks_df, discharge_data = read_data(peaks_file_path, discharge_file_path)
-            process_peaks(peaks_df, discharge_data)
+            peaks_df, discharge_data = load_peaks_and_discharge(peaks_file_path, discharge_file_path)
+            baseflow_options = {"First sample": 'first', "Linear (start to end of the event)": 'linear',
+                                "Constant slope": 'constant_slope'}
+            baseflow_choice = st.radio("Baseflow separation for the DUHs", list(baseflow_options), horizontal=True,
+                                       help="The flow under this line is removed before the hydrograph is normalized.")
+            baseflow = baseflow_options[baseflow_choice]
+            baseflow_slope = None
+            if baseflow == 'constant_slope':
+                baseflow_slope = st.number_input("Baseflow slope (cfs per hour)", min_value=0.0, value=1.0, step=0.1)
+            event_mode = st.radio("Event processing", ["One event at a time", "All events at once"], horizontal=True,
+                                  help="'All events at once' picks every window from the recession and writes the "
+                                       "Event, S_Event and DUH_Event results in one pass.")
+            if event_mode == "One event at a time":
+                process_peaks(peaks_df, event_windows(discharge_file_path), max_points, storage)
+            else:
+                process_all_peaks(peaks_df, discharge_data, storage, baseflow, baseflow_slope)
 
             event_files_directory = os.path.join(output_folder, f"USGS{site_no}")
             if os.path.exists(event_files_directory):
-                files_to_process = [f for f in os.listdir(event_files_directory) if f.startswith("Event_") and f.endswith(".csv")]
+                files_to_process = list_events(event_files_directory, storage)
                 selected_file = st.selectbox("Select a file to process", files_to_process)
-                sigma_value = st.slider("Select Sigma Value for Gaussian Smoothing", min_value=0.0, max_value=100.0, value=10.0)
+                with st.expander("Suggest a sigma"):
+                    col1, col2 = st.columns(2)
+                    col1.number_input("Minimum NSE", min_value=0.0, max_value=1.0, value=DEFAULT_MIN_NSE, step=0.005,
+                                      format="%.3f", key='sigma_min_nse')
+                    col2.number_input("Maximum peak attenuation (fraction of the peak)", min_value=0.0, max_value=1.0,
+                                      value=DEFAULT_MAX_PEAK_ATTENUATION, step=0.01, key='sigma_max_attenuation')
+                    st.button("Find sigma", on_click=suggest_sigma, args=(event_files_directory, selected_file, storage),
+                              disabled=selected_file is None)
+                    if st.session_state.get('sigma_sweep') is not None:
+                        plot_sigma_sweep(st.session_state.sigma_sweep, st.session_state.sigma_value)
+                if 'sigma_value' not in st.session_state:
+                    st.session_state.sigma_value = 10.0
+                sigma_value = st.slider("Select Sigma Value for Gaussian Smoothing", min_value=0.0, max_value=100.0,
+                                        key='sigma_value')
 
                 if st.button("Apply Gaussian Smoothing"):
-                    event_file = os.path.join(event_files_directory, selected_file)
-                    event_data = pd.read_csv(event_file, parse_dates=['datetimeUTC'])
-                    processed_data, nse, peak_diff = apply_gaussian_smoothing(event_data, sigma_value)
+                    processed_data, nse, peak_diff = smooth_event(event_files_directory, selected_file, sigma_value, storage)
+                    if processed_data is not None:
+                        plot_smoothed_hydrograph(processed_data, processed_data['smoothed_discharge_cfs'], sigma_value,
+                                                 max_points)
                     st.session_state.processed_event_data = processed_data
                     st.write(f"Nash-Sutcliffe Efficiency: {nse:.2f}")
                     st.write(f"Peak Difference: {peak_diff:.2f}")
@@ -234,45 +522,49 @@ def main():
                 if 'processed_event_data' in st.session_state and st.session_state.processed_event_data is not None:
                     if st.button("Save Smoothed Data"):
                         try:
-                            event_no = selected_file.split('_')[1].split('.')[0]
-                            smoothed_file = os.path.join(event_files_directory, f"S_Event_{event_no}.csv")
-                            st.session_state.processed_event_data.to_csv(smoothed_file, index=False)
-                            log_progress(event_files_directory, f"Smoothed hydrograph saved as S_Event_{event_no}.csv")
-                            st.success(f"Smoothed hydrograph saved as {smoothed_file}")
-
-                            normalized_discharge, normalized_time = create_dimensionless_unit_hydrograph(st.session_state.processed_event_data)
+                            event_no = event_number(selected_file)
+                            saved_as = save_smoothed(event_files_directory, event_no, st.session_state.processed_event_data, storage)
+                            log_progress(event_files_directory, f"Smoothed hydrograph saved as {saved_as}")
+                            st.success(f"Smoothed hydrograph saved as {describe_saved(event_files_directory, saved_as, storage)}")
+
+                            normalized_discharge, normalized_time = create_dimensionless_unit_hydrograph(
+                                st.session_state.processed_event_data, notify=streamlit_notify, baseflow=baseflow,
+                                baseflow_slope=baseflow_slope)
                             if not normalized_discharge.empty and not normalized_time.empty:
-                                duh_df = pd.DataFrame({'Normalized Discharge': normalized_discharge, 'Normalized Time': normalized_time})
-                                duh_file_name = f"DUH_Event_{event_no}.csv"
-                                duh_df.to_csv(os.path.join(event_files_directory, duh_file_name), index=False)
-                                log_progress(event_files_directory, f"DUH file created: DUH_Event_{event_no}.csv")
+                                duh_file_name = save_duh(event_files_directory, event_no, normalized_discharge, normalized_time, storage)
+                                log_progress(event_files_directory, f"DUH file created: {duh_file_name}")
                                 st.write(f"DUH file created: {duh_file_name}")
                         except Exception as e:
                             st.error(f"An error occurred while saving the file: {e}")
 
             if st.button("Convert to Normalized Hydrograph"):
                 event_files_directory = os.path.join(output_folder, f"USGS{site_no}")
-                if os.path.exists(event_files_directory):
+                if not os.path.exists(event_files_directory):
+                    st.error("Directory not found. Please check the output folder and site number.")
+                elif run_as_jobs:
+                    queue.submit(session, 'overall_duh', overall_duh_task, event_files_directory, storage,
+                                 label=f"Overall DUH of site {site_no}", site_key=site_folder)
+                    st.rerun()
+                else:
                     try:
-                        overall_duh_df, all_interpolated_duhs = process_smoothed_files(event_files_directory)
-                        
-                        # ✅ Save the overall DUH before plotting
-                        output_path = os.path.join(event_files_directory, "overall_duh.csv")
-                        overall_duh_df.to_csv(output_path, index=False)
-                        log_progress(event_files_directory, "Saved overall normalized hydrograph to overall_duh.csv")
-
-                        # ✅ Plot the DUH
-                        plot_duhs(overall_duh_df, all_interpolated_duhs, np.arange(0, 10.001, 0.001), output_folder)
-
-                        log_progress(event_files_directory, "Normalized Hydrographs processed and plotted successfully.")
-                        st.success("Normalized Hydrographs processed and plotted successfully.")
-
+                        keep_result('overall_duh', overall_duh_task(InlineJob(streamlit_notify), event_files_directory,
+                                                                    storage))
                     except Exception as e:
                         st.error(f"An error occurred: {e}")
                         log_progress(event_files_directory, f"Error while processing DUHs: {e}")
 
-                else:
-                    st.error("Directory not found. Please check the output folder and site number.")
+            # The overall DUH, its bootstrap bands and the event DUHs it was made of
+            if st.session_state.get('overall_duh_result') is not None:
+                overall_duh_df, all_interpolated_duhs, bands = st.session_state.overall_duh_result
+                plot_duhs(overall_duh_df, all_interpolated_duhs, overall_duh_df['Normalized Time'].to_numpy(),
+                          output_folder, max_points, bands)
+
+            if storage == 'store' and st.button("Export CSV files"):
+                written = SiteStore(os.path.join(output_folder, f"USGS{site_no}")).export_csv(site_no)
+                st.success(f"Exported {len(written)} CSV files from the site store.")
+
+    show_performance_panel(report, show_performance, st.session_state.get('USGS_data'))
+    flush_logs()
 
 if __name__ == "__main__":
     main()
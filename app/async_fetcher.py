@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from .helpers import CreateFolder
+from .fetchers import empty_discharge_frame, discharge_from_nwis_df
+
+NWIS_IV_URL = "https://waterservices.usgs.gov/nwis/iv/"
+NWIS_SITE_URL = "https://waterservices.usgs.gov/nwis/site/"
+
+# Responses worth retrying: rate limited or a temporary server problem
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+# Inclusive day ranges of at most chunk_days covering begin_date to end_date
+def date_chunks(begin_date, end_date, chunk_days):
+    begin = pd.Timestamp(begin_date).normalize()
+    end = pd.Timestamp(end_date).normalize()
+    chunks = []
+    while begin <= end:
+        stop = min(begin + pd.Timedelta(days=chunk_days - 1), end)
+        chunks.append((begin, stop))
+        begin = stop + pd.Timedelta(days=1)
+    return chunks
+
+
+# Concurrency and rate limits shared by all requests of one run. Created inside the event loop,
+# because asyncio primitives belong to the loop they are made in.
+class _Limits:
+    def __init__(self, max_concurrency, requests_per_second):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.lock = asyncio.Lock()
+        self.next_start = 0.0
+
+    # Space request starts at least `interval` seconds apart
+    async def wait_turn(self):
+        if not self.interval:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Fetcher that downloads NWIS instantaneous values in date chunks, several at a time. Requests go
+# through one pooled requests.Session in worker threads (asyncio.to_thread); at most max_concurrency
+# are in flight and, with requests_per_second, their starts are spaced out. Failed requests are
+# retried with exponential backoff. With partial_dir, every finished chunk is saved there, so a
+# run that fails part way only fetches the missing chunks when repeated.
+# Same interface as NWISFetcher, plus discharge_many() for several sites at once.
+class AsyncNWISFetcher:
+    def __init__(self, max_concurrency=4, chunk_days=90, max_retries=5, backoff_seconds=1.0, max_backoff_seconds=60.0,
+                 requests_per_second=None, partial_dir=None, timeout=120, iv_url=NWIS_IV_URL, site_url=NWIS_SITE_URL):
+        self.max_concurrency = max_concurrency
+        self.chunk_days = chunk_days
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.requests_per_second = requests_per_second
+        self.partial_dir = partial_dir
+        self.timeout = timeout
+        self.iv_url = iv_url
+        self.site_url = site_url
+
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-encoding": "gzip"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _get(self, url, params):
+        return self.session.get(url, params=params, timeout=self.timeout)
+
+    def _backoff(self, attempt, response=None):
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), self.max_backoff_seconds)
+        delay = self.backoff_seconds * 2 ** attempt
+        return min(delay * random.uniform(0.5, 1.0), self.max_backoff_seconds)
+
+    # GET with retries; returns None when NWIS answers 404 (nothing for this request)
+    async def _request(self, limits, url, params, log=None):
+        for attempt in range(self.max_retries + 1):
+            response = None
+            async with limits.semaphore:
+                await limits.wait_turn()
+                try:
+                    response = await asyncio.to_thread(self._get, url, params)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                else:
+                    if response.status_code == 404:
+                        return None
+                    if response.status_code not in RETRY_STATUS:
+                        response.raise_for_status()
+                        return response
+                    error = requests.HTTPError(f"{response.status_code} from {response.url}", response=response)
+
+            if attempt == self.max_retries:
+                raise error
+            delay = self._backoff(attempt, response)
+            if log is not None:
+                log(f"NWIS request failed ({error}); retrying in {delay:.1f} s")
+            await asyncio.sleep(delay)
+
+    def _partial_path(self, site_no, start, stop):
+        return os.path.join(self.partial_dir, f"{site_no}_{start:%Y%m%d}_{stop:%Y%m%d}.parquet")
+
+    async def _fetch_chunk(self, limits, site_no, start, stop, log=None):
+        if self.partial_dir is not None and os.path.exists(self._partial_path(site_no, start, stop)):
+            return pd.read_parquet(self._partial_path(site_no, start, stop))
+
+        params = {'format': 'json', 'sites': site_no, 'parameterCd': '00060',
+                  'startDT': start.strftime("%Y-%m-%d"), 'endDT': stop.strftime("%Y-%m-%d")}
+        response = await self._request(limits, self.iv_url, params, log)
+
+        chunk = empty_discharge_frame()
+        if response is not None:
+            nwis_json = response.json()
+            series = nwis_json['value']['timeSeries']
+            if any(method['value'] for ts in series for method in ts['values']):
+                from hydrofunctions.hydrofunctions import extract_nwis_df
+                nwis_df, _ = extract_nwis_df(nwis_json, interpolate=False)
+                chunk = discharge_from_nwis_df(nwis_df, site_no)
+
+        if self.partial_dir is not None:
+            CreateFolder(self.partial_dir)
+            path = self._partial_path(site_no, start, stop)
+            chunk.to_parquet(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        return chunk
+
+    async def fetch_discharge(self, site_no, begin_date, end_date, log=None, limits=None):
+        if limits is None:
+            limits = _Limits(self.max_concurrency, self.requests_per_second)
+        chunks = date_chunks(begin_date, end_date, self.chunk_days)
+        if log is not None:
+            log(f"Fetching site {site_no} from NWIS in {len(chunks)} chunks, {self.max_concurrency} at a time")
+
+        # Let every chunk finish (and be saved) before reporting a failure, so a rerun can resume
+        results = await asyncio.gather(*[self._fetch_chunk(limits, site_no, start, stop, log)
+                                          for start, stop in chunks], return_exceptions=True)
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            raise failures[0]
+
+        frames = [frame for frame in results if not frame.empty]
+        if not frames:
+            return empty_discharge_frame()
+        discharge = pd.concat(frames)
+        discharge = discharge[~discharge.index.duplicated(keep='last')].sort_index()
+
+        if self.partial_dir is not None:
+            for start, stop in chunks:
+                os.remove(self._partial_path(site_no, start, stop))
+        return discharge
+
+    async def fetch_many(self, site_nos, begin_date, end_date, log=None):
+        limits = _Limits(self.max_concurrency, self.requests_per_second)
+        results = await asyncio.gather(*[self.fetch_discharge(site_no, begin_date, end_date, log, limits)
+                                          for site_no in site_nos], return_exceptions=True)
+        return dict(zip(site_nos, results))
+
+    async def fetch_site_info(self, site_no):
+        limits = _Limits(self.max_concurrency, self.requests_per_second)
+        params = {'format': 'rdb', 'sites': site_no, 'siteOutput': 'expanded', 'siteStatus': 'all'}
+        response = await self._request(limits, self.site_url, params)
+        if response is None:
+            raise ValueError(f"NWIS has no site information for site {site_no}.")
+        from hydrofunctions.usgs_rdb import read_rdb
+        _, table, _, _ = read_rdb(response.text)
+        return table
+
+    # Blocking entry points with the NWISFetcher interface
+    def discharge(self, site_no, begin_date, end_date, log=None):
+        return _run(self.fetch_discharge(site_no, begin_date, end_date, log))
+
+    # {site_no: discharge frame, or the exception that stopped that site}
+    def discharge_many(self, site_nos, begin_date, end_date, log=None):
+        return _run(self.fetch_many(list(site_nos), begin_date, end_date, log))
+
+    def site_info(self, site_no):
+        return _run(self.fetch_site_info(site_no))
+
+
+# Run a coroutine to completion, also when the calling thread already runs an event loop
+def _run(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result = {}
+
+    def runner():
+        try:
+            result['value'] = asyncio.run(coroutine)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
@@ -0,0 +1,298 @@
+# Headless multi-site pipeline:
+#   python -m app.batch sites.txt --config params.toml [--workers 4] [--force]
+#
+# sites.txt lists one USGS site number per line ('#' starts a comment). params.toml holds the
+# same inputs the Streamlit app asks for, see DEFAULT_CONFIG. Each site runs in its own process;
+# finished sites are recorded in USGS{site}/batch_progress.json and skipped on the next run
+# unless the parameters changed or --force is given.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import toml
+
+from .helpers import CreateFolder, log_progress, log_notifier, flush_logs
+from .instrumentation import start_report
+
+DEFAULT_CONFIG = {
+    'begin_date': '2010-01-01',
+    'end_date': '2023-01-01',
+    'output_folder': '.',
+    'cache_dir': None,          # defaults to <output_folder>/nwis_cache
+    'source_dir': None,         # read saved USGS{site} folders under this path instead of NWIS (offline runs)
+    'months': list(range(1, 13)),
+    'chunk_days': 366,          # length of the date slices requested from NWIS
+    'concurrent_requests': 1,   # more than 1 downloads each slice in smaller chunks, this many at a time
+    'prominence': 'std',        # a number, or 'std' to use the standard deviation of the discharge
+    'min_peak_gap_hours': 12,
+    'peaks_by_year': False,     # True reproduces the old per-calendar-year peak detection
+    'window_hours_before': 50,  # length of the event window around each peak, in hours
+    'window_hours_after': 50,
+    'auto_windows': False,      # True picks each window from the recession; the hours above are then the limits
+    'sigma': 10.0,              # a number, or 'auto' to pick each event's sigma with a sweep
+    'min_nse': 0.99,            # limits for sigma = 'auto'
+    'max_peak_attenuation': 0.05,
+    'baseflow': 'first',        # baseflow separation of the DUHs: 'first', 'linear' or 'constant_slope'
+    'baseflow_slope': None,     # cfs per hour, for baseflow = 'constant_slope'
+    'duh_peak_step': 0.01,      # overall DUH grid (time_grid.TimeGrid): spacing up to duh_peak_span times to peak,
+    'duh_peak_span': 5.0,
+    'duh_tail_points': 300,     # then this many log-spaced nodes per decade,
+    'duh_max_time': 'auto',     # up to the end of the longest event, or up to this many times to peak
+    'bootstrap_replicates': 1000,  # resamples of the events for the 5-95% bands of the overall DUH (0: no bands)
+    'save_plots': True,
+    'storage': 'csv',           # 'csv' files, or 'store' for the typed Parquet site store
+    'export_csv': False,        # with storage = 'store', also write the CSV files at the end
+    'track_memory': False,      # record each stage's peak memory in the timing report (slower)
+    'workers': os.cpu_count() or 1,
+}
+
+PROGRESS_FILE = "batch_progress.json"
+SUMMARY_FILE = "batch_summary.csv"
+
+
+def read_sites(sites_file):
+    sites = []
+    with open(sites_file) as f:
+        for line in f:
+            site_no = line.split('#', 1)[0].strip()
+            if site_no and site_no not in sites:
+                sites.append(site_no)
+    return sites
+
+
+# DEFAULT_CONFIG updated from a params.toml. A key that is not in DEFAULT_CONFIG is an error, so a
+# misspelt or outdated parameter is not silently replaced by its default.
+def load_config(config_file=None):
+    config = dict(DEFAULT_CONFIG)
+    if config_file is not None:
+        loaded = toml.load(config_file)
+        unknown = sorted(set(loaded) - set(DEFAULT_CONFIG))
+        if unknown:
+            raise ValueError(f"Unknown parameters in {config_file}: {', '.join(unknown)}")
+        config.update(loaded)
+    if config['cache_dir'] is None:
+        config['cache_dir'] = os.path.join(config['output_folder'], "nwis_cache")
+    return config
+
+
+# Fingerprint of the parameters that change a site's results (worker count does not)
+def config_fingerprint(config):
+    relevant = {key: value for key, value in config.items()
+                if key not in ('workers', 'save_plots', 'concurrent_requests', 'export_csv', 'track_memory')}
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _progress_path(config, site_no):
+    return os.path.join(config['output_folder'], f"USGS{site_no}", PROGRESS_FILE)
+
+
+def read_progress(config, site_no):
+    path = _progress_path(config, site_no)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_progress(config, site_no, progress):
+    path = _progress_path(config, site_no)
+    with open(path + ".tmp", "w") as f:
+        json.dump(progress, f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+
+
+# Run download, peak detection, event extraction, smoothing and DUH creation for one site
+def run_site(site_no, config):
+    # Each site already has its own process, so figures are drawn in place (or skipped)
+    from .rendering import Figures
+    figures = Figures('inline' if config['save_plots'] else 'off')
+
+    from .data_io import GetFlow
+    from .fetchers import LocalFetcher
+    from .async_fetcher import AsyncNWISFetcher
+    from .peak_detection import DetectAndSavePeaks
+    from .event_batch import process_all_events
+    from .smoothing import process_smoothed_files
+    from .duh_stack import DEFAULT_PERCENTILES
+    from .time_grid import TimeGrid
+    from .site_store import SiteStore, save_overall_duh, save_duh_bands
+    from .duh_bootstrap import bootstrap_duh_bands
+
+    started = time.time()
+    report = start_report(f"batch site {site_no}", config['track_memory'])
+    previous = read_progress(config, site_no)
+    progress = {'site_no': site_no, 'fingerprint': config_fingerprint(config), 'status': 'running', 'stages': {}}
+    USGS_data = os.path.join(config['output_folder'], f"USGS{site_no}")
+    CreateFolder(USGS_data)
+
+    def finish_stage(stage, **results):
+        progress['stages'][stage] = results
+        _write_progress(config, site_no, progress)
+
+    fetcher = None
+    if config['source_dir'] is not None:
+        fetcher = LocalFetcher(os.path.join(config['source_dir'], f"USGS{site_no}"))
+    elif config['concurrent_requests'] > 1:
+        fetcher = AsyncNWISFetcher(max_concurrency=config['concurrent_requests'],
+                                   partial_dir=os.path.join(config['cache_dir'], "partial"))
+
+    try:
+        # The full record is kept for event windows; the month filter only applies to peak detection
+        discharge_data, USGS_data, _ = GetFlow(site_no, config['begin_date'], config['end_date'],
+                                               config['output_folder'], list(range(1, 13)),
+                                               fetcher=fetcher, cache_dir=config['cache_dir'],
+                                               save_plot=config['save_plots'], chunk_days=config['chunk_days'],
+                                               storage=config['storage'], figures=figures,
+                                               notify=log_notifier(os.path.join(config['output_folder'], f"USGS{site_no}")))
+        discharge_filtered = discharge_data[discharge_data.index.month.isin(config['months'])]
+        finish_stage('download', records=len(discharge_data))
+
+        if config['prominence'] == 'std':
+            prominence_value = float(discharge_filtered['discharge_cfs'].std())
+        else:
+            prominence_value = float(config['prominence'])
+        peaks_df = DetectAndSavePeaks(discharge_filtered, prominence_value, USGS_data, site_no,
+                                      config['min_peak_gap_hours'], by_year=config['peaks_by_year'],
+                                      figures=figures)
+        finish_stage('peaks', prominence=prominence_value, peaks=len(peaks_df))
+
+        # Event files written by an earlier batch run of this site would otherwise leak into the overall DUH
+        previous_stages = (previous or {}).get('stages', {})
+        for filename in previous_stages.get('events', {}).get('files', []) + previous_stages.get('export', {}).get('files', []):
+            if os.path.exists(os.path.join(USGS_data, filename)):
+                os.remove(os.path.join(USGS_data, filename))
+        if config['storage'] == 'store':
+            SiteStore(USGS_data).clear_events()
+
+        if config['auto_windows']:
+            events = process_all_events(discharge_data, peaks_df, USGS_data, config['sigma'],
+                                        max_hours_before=config['window_hours_before'],
+                                        max_hours_after=config['window_hours_after'],
+                                        min_nse=config['min_nse'], max_peak_attenuation=config['max_peak_attenuation'],
+                                        storage=config['storage'], baseflow=config['baseflow'],
+                                        baseflow_slope=config['baseflow_slope'])
+        else:
+            events = process_all_events(discharge_data, peaks_df, USGS_data, config['sigma'],
+                                        config['window_hours_before'], config['window_hours_after'],
+                                        min_nse=config['min_nse'], max_peak_attenuation=config['max_peak_attenuation'],
+                                        storage=config['storage'], baseflow=config['baseflow'],
+                                        baseflow_slope=config['baseflow_slope'])
+        processed = events[events['Processed']]
+        event_files = [] if config['storage'] == 'store' else [name for row in processed.itertuples()
+                       for name in (f"Event_{row.Event}_{pd.Timestamp(row.Start_Date).year}.csv", f"S_Event_{row.Event}.csv")]
+        if config['storage'] != 'store':
+            event_files += [f"DUH_Event_{event_no}.csv" for event_no in processed.loc[processed['Has DUH'], 'Event']]
+        finish_stage('events', events=int(processed['Has DUH'].sum()), files=event_files,
+                     mean_nse=float(processed['NSE'].mean()) if len(processed) else None)
+
+        time_grid = TimeGrid(config['duh_peak_step'], config['duh_peak_span'], config['duh_tail_points'],
+                             None if config['duh_max_time'] == 'auto' else config['duh_max_time'])
+        overall_duh_df, matrix = process_smoothed_files(USGS_data, time_grid, DEFAULT_PERCENTILES,
+                                                        storage=config['storage'], notify=log_notifier(USGS_data),
+                                                        with_matrix=config['bootstrap_replicates'] > 0)
+        if not overall_duh_df.empty:
+            saved_as = save_overall_duh(USGS_data, overall_duh_df, config['storage'])
+            log_progress(USGS_data, f"Saved overall normalized hydrograph to {saved_as}")
+            if config['bootstrap_replicates'] > 0:
+                bands = bootstrap_duh_bands(matrix, overall_duh_df['Normalized Time'].to_numpy(),
+                                            config['bootstrap_replicates'])
+                saved_as = save_duh_bands(USGS_data, bands, config['storage'])
+                log_progress(USGS_data, f"Saved bootstrap bands of the overall DUH to {saved_as}")
+        finish_stage('overall_duh', saved=not overall_duh_df.empty)
+
+        if config['storage'] == 'store' and config['export_csv']:
+            finish_stage('export', files=SiteStore(USGS_data).export_csv(site_no))
+
+        progress['status'] = 'done'
+    except Exception as e:
+        progress['status'] = 'failed'
+        progress['error'] = f"{type(e).__name__}: {e}"
+        log_progress(USGS_data, f"Batch run failed for site {site_no}:\n{traceback.format_exc()}")
+
+    # Where the time went: USGS{site}/timing_report.json and .csv, plus the per-stage totals here
+    report.save(USGS_data)
+    progress['stage_seconds'] = {row.Stage: round(row.Seconds, 3) for row in report.summary().itertuples()}
+    progress['elapsed_s'] = round(time.time() - started, 2)
+    _write_progress(config, site_no, progress)
+    flush_logs()
+    return progress
+
+
+def summarize(progress):
+    stages = progress.get('stages', {})
+    stage_seconds = progress.get('stage_seconds', {})
+    return {
+        'site_no': progress['site_no'],
+        'status': progress['status'],
+        'records': stages.get('download', {}).get('records'),
+        'prominence': stages.get('peaks', {}).get('prominence'),
+        'peaks': stages.get('peaks', {}).get('peaks'),
+        'events': stages.get('events', {}).get('events'),
+        'mean_nse': stages.get('events', {}).get('mean_nse'),
+        'elapsed_s': progress.get('elapsed_s'),
+        'slowest_stage': max(stage_seconds, key=stage_seconds.get) if stage_seconds else '',
+        'error': progress.get('error', ''),
+    }
+
+
+def run_batch(sites, config, force=False):
+    CreateFolder(config['output_folder'])
+    fingerprint = config_fingerprint(config)
+
+    results = {}
+    pending = []
+    for site_no in sites:
+        progress = read_progress(config, site_no)
+        if not force and progress and progress['status'] == 'done' and progress['fingerprint'] == fingerprint:
+            print(f"[{site_no}] already done, skipping")
+            results[site_no] = progress
+        else:
+            pending.append(site_no)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=min(config['workers'], len(pending))) as executor:
+            futures = {executor.submit(run_site, site_no, config): site_no for site_no in pending}
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                site_no = futures[future]
+                try:
+                    results[site_no] = future.result()
+                except Exception as e:
+                    # The worker process itself died; the site can simply be rerun
+                    results[site_no] = {'site_no': site_no, 'status': 'failed', 'error': f"{type(e).__name__}: {e}"}
+                print(f"[{done_count}/{len(pending)}] {site_no}: {results[site_no]['status']}")
+
+    summary = pd.DataFrame([summarize(results[site_no]) for site_no in sites])
+    summary.to_csv(os.path.join(config['output_folder'], SUMMARY_FILE), index=False)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.batch",
+                                     description="Build normalized hydrographs for many USGS sites without the UI.")
+    parser.add_argument("sites", help="Text file with one USGS site number per line")
+    parser.add_argument("--config", help="TOML file with the pipeline parameters")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (overrides the config)")
+    parser.add_argument("--force", action="store_true", help="Rerun sites that already finished")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config(args.config)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.workers is not None:
+        config['workers'] = args.workers
+
+    summary = run_batch(read_sites(args.sites), config, force=args.force)
+    print(summary.to_string(index=False))
+    return 0 if (summary['status'] == 'done').all() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import os
+import json
+import pandas as pd
+from .helpers import CreateFolder
+from .fetchers import empty_discharge_frame, slice_by_dates
+
+# On-disk layout of the discharge cache:
+#   <cache_dir>/<site_no>/<year>.parquet   15-minute discharge and qualifiers for one UTC year
+#   <cache_dir>/<site_no>/coverage.json    inclusive date intervals already requested from the source
+
+COVERAGE_FILE = "coverage.json"
+
+
+def _site_folder(cache_dir, site_no):
+    return os.path.join(cache_dir, str(site_no))
+
+
+def _read_coverage(folder):
+    path = os.path.join(folder, COVERAGE_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in json.load(f)]
+
+
+def _write_coverage(folder, intervals):
+    with open(os.path.join(folder, COVERAGE_FILE), "w") as f:
+        json.dump([[start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")] for start, end in intervals], f)
+
+
+# Merge overlapping or touching day intervals into a sorted, disjoint list
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + pd.Timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Return the pieces of [begin, end] that are not covered by the given intervals
+def missing_intervals(covered, begin, end):
+    missing = []
+    cursor = begin
+    for start, end_covered in merge_intervals(covered):
+        if end_covered < cursor:
+            continue
+        if start > end:
+            break
+        if start > cursor:
+            missing.append((cursor, start - pd.Timedelta(days=1)))
+        cursor = max(cursor, end_covered + pd.Timedelta(days=1))
+    if cursor <= end:
+        missing.append((cursor, end))
+    return missing
+
+
+# Rows are filed by UTC year, whatever offset the source reports them in
+def _store_years(folder, frame):
+    frame = frame.tz_convert('UTC')
+    for year, group in frame.groupby(frame.index.year):
+        path = os.path.join(folder, f"{year}.parquet")
+        if os.path.exists(path):
+            group = pd.concat([pd.read_parquet(path), group])
+            group = group[~group.index.duplicated(keep='last')]
+        group.sort_index().to_parquet(path)
+
+
+def _load_years(folder, first_year, last_year):
+    frames = []
+    for year in range(first_year, last_year + 1):
+        path = os.path.join(folder, f"{year}.parquet")
+        if os.path.exists(path):
+            frames.append(pd.read_parquet(path))
+    if not frames:
+        return empty_discharge_frame()
+    return pd.concat(frames)
+
+
+# Fetcher wrapper that keeps a per-site, per-year Parquet cache and only asks the
+# wrapped fetcher for the date intervals that have not been requested before
+class CachedFetcher:
+    def __init__(self, fetcher, cache_dir):
+        self.fetcher = fetcher
+        self.cache_dir = cache_dir
+
+    def discharge(self, site_no, begin_date, end_date, log=None):
+        folder = _site_folder(self.cache_dir, site_no)
+        CreateFolder(folder)
+
+        begin = pd.Timestamp(begin_date).normalize()
+        end = pd.Timestamp(end_date).normalize()
+        covered = _read_coverage(folder)
+
+        # Today's values are still provisional and incomplete, so never mark them as cached
+        last_final_day = pd.Timestamp.now().normalize() - pd.Timedelta(days=1)
+
+        for start, stop in missing_intervals(covered, begin, end):
+            if log is not None:
+                log(f"Cache miss for site {site_no}: fetching {start.date()} to {stop.date()}")
+            fetched = self.fetcher.discharge(site_no, start.date(), stop.date(), log=log)
+            if not fetched.empty:
+                _store_years(folder, fetched)
+            if start <= last_final_day:
+                covered.append((start, min(stop, last_final_day)))
+                _write_coverage(folder, merge_intervals(covered))
+
+        cached = _load_years(folder, begin.year, end.year)
+        return slice_by_dates(cached, begin, end)
+
+    def site_info(self, site_no):
+        path = os.path.join(_site_folder(self.cache_dir, site_no), "site_info.parquet")
+        if os.path.exists(path):
+            return pd.read_parquet(path)
+        site_info_df = self.fetcher.site_info(site_no)
+        CreateFolder(os.path.dirname(path))
+        site_info_df.to_parquet(path)
+        return site_info_df
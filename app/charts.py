@@ -0,0 +1,149 @@
+import numpy as np
+import streamlit as st
+from plotly import graph_objects as go
+from .instrumentation import timed
+from .downsampling import downsample_indices, downsampled_title, DEFAULT_POINT_BUDGET
+
+# UI layer of the Streamlit app: interactive Plotly charts drawn into the page and the notify
+# callback that shows the compute modules' messages there. The compute modules (data_io,
+# peak_detection, smoothing, event_batch, ...) only need NumPy, pandas and SciPy; they import this
+# module lazily, when asked to draw.
+
+
+# notify(level, message) for the compute modules (see helpers.notify_message)
+def streamlit_notify(level, message):
+    if level == 'error':
+        st.error(message)
+    elif level == 'warning':
+        st.warning(message)
+    elif level == 'success':
+        st.success(message)
+    else:
+        st.write(message)
+
+
+# Function to plot a storm hydrograph using Plotly (max_points=None sends every sample)
+@timed('plotting', rows_arg='storm_hydrograph')
+def plot_hydrograph(storm_hydrograph, max_points=DEFAULT_POINT_BUDGET):
+    storm_hydrograph = storm_hydrograph.reset_index()
+    total_points = len(storm_hydrograph)
+    keep = downsample_indices(storm_hydrograph['datetimeUTC'], storm_hydrograph['discharge_cfs'], max_points)
+    storm_hydrograph = storm_hydrograph.iloc[keep].copy()
+    storm_hydrograph['hover_text'] = (
+        storm_hydrograph.index.astype(str) + ': ' +
+        storm_hydrograph['datetimeUTC'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    )
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=storm_hydrograph['datetimeUTC'],
+        y=storm_hydrograph['discharge_cfs'],
+        mode='lines',
+        name='Discharge',
+        text=storm_hydrograph['hover_text'],
+        hoverinfo='text+y'
+    ))
+
+    fig.update_layout(
+        xaxis=dict(title='Date and Time', showgrid=True),
+        yaxis=dict(title='Discharge (cfs)'),
+        title=downsampled_title('Storm Hydrograph', len(keep), total_points)
+    )
+
+    st.plotly_chart(fig)
+
+
+@timed('plotting', rows_arg='event_data')
+def plot_smoothed_hydrograph(event_data, smoothed, sigma, max_points=DEFAULT_POINT_BUDGET):
+    # Both traces share the sample positions picked from the original data
+    keep = downsample_indices(event_data['datetimeUTC'], event_data['discharge_cfs'], max_points)
+    keep = np.union1d(keep, np.argmax(smoothed))
+    times = event_data['datetimeUTC'].iloc[keep]
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=times, y=event_data['discharge_cfs'].iloc[keep], mode='lines', name='Original Data'))
+    fig.add_trace(go.Scatter(x=times, y=np.asarray(smoothed)[keep], mode='lines',
+                             name=f'Smoothed with sigma={sigma}', line=dict(color='red')))
+    fig.update_layout(
+        title=downsampled_title("Original and Smoothed Hydrograph", len(keep), len(event_data)),
+        xaxis_title="Date",
+        yaxis_title="Discharge (cfs)",
+        legend_title="Legend",
+        font=dict(family="Courier New, monospace", size=12, color="RebeccaPurple")
+    )
+    st.plotly_chart(fig)
+
+# NSE and peak attenuation against sigma, with the chosen sigma marked
+@timed('plotting', rows_arg='sweep')
+def plot_sigma_sweep(sweep, chosen_sigma):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=sweep['Sigma'], y=sweep['NSE'], mode='lines', name='NSE'))
+    fig.add_trace(go.Scatter(x=sweep['Sigma'], y=sweep['Peak Attenuation'], mode='lines', name='Peak attenuation',
+                             yaxis='y2', line=dict(color='red')))
+    fig.add_vline(x=chosen_sigma, line_dash='dash', annotation_text=f"sigma={chosen_sigma}")
+    fig.update_layout(
+        title="Smoothing Sweep",
+        xaxis_title="Sigma",
+        yaxis=dict(title="NSE"),
+        yaxis2=dict(title="Peak attenuation", overlaying='y', side='right', tickformat='.1%'),
+        legend_title="Legend"
+    )
+    st.plotly_chart(fig)
+
+# bands (duh_bootstrap.bootstrap_duh_bands) are drawn as a shaded confidence band around the overall DUH
+@timed('plotting', rows_arg='all_interpolated_duhs')
+def plot_duhs(overall_duh_df, all_interpolated_duhs, common_time_axis, output_folder, max_points=DEFAULT_POINT_BUDGET,
+              bands=None):
+    fig = go.Figure()
+
+    for index, duh in enumerate(all_interpolated_duhs):
+        keep = downsample_indices(common_time_axis, duh, max_points)
+        fig.add_trace(go.Scatter(x=common_time_axis[keep], y=duh[keep], mode='lines', name=f'Event DUH {index+1}', opacity=0.5))
+
+    if bands is not None:
+        lower, upper = [column for column in bands.columns if column.startswith('Bootstrap')][:2]
+        keep = downsample_indices(bands['Normalized Time'], bands[upper], max_points)
+        fig.add_trace(go.Scatter(x=bands['Normalized Time'].iloc[keep], y=bands[upper].iloc[keep], mode='lines',
+                                 line=dict(width=0), showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=bands['Normalized Time'].iloc[keep], y=bands[lower].iloc[keep], mode='lines',
+                                 line=dict(width=0), fill='tonexty', fillcolor='rgba(255, 0, 0, 0.2)',
+                                 name=f"Overall DUH {lower.split()[1]}-{upper.split()[1]} bootstrap band"))
+
+    if overall_duh_df is not None:
+        keep = downsample_indices(overall_duh_df['Normalized Time'], overall_duh_df['Normalized Discharge'], max_points)
+        fig.add_trace(go.Scatter(
+            x=overall_duh_df['Normalized Time'].iloc[keep],
+            y=overall_duh_df['Normalized Discharge'].iloc[keep],
+            mode='lines',
+            name='Overall DUH',
+            line=dict(color='red', width=2)
+        ))
+
+    fig.update_layout(
+        title='Overall and Event Dimensionless Unit Hydrographs',
+        xaxis_title='Normalized Time',
+        yaxis_title='Normalized Discharge',
+        legend_title="Legend"
+    )
+    st.plotly_chart(fig)
+
+
+# Peak count against prominence (log scale), with the chosen prominence marked
+@timed('plotting', rows_arg='curve')
+def plot_peak_count_curve(curve, prominence_value, filtered_count=None):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=curve['Prominence'], y=curve['Peaks'], mode='lines', name='Peaks',
+                             line=dict(shape='hv')))
+    # A trace rather than add_vline: annotations on log axes need log coordinates
+    label = f"prominence={prominence_value:.2f}"
+    if filtered_count is not None:
+        label += f" ({filtered_count} peaks kept)"
+    fig.add_trace(go.Scatter(x=[prominence_value, prominence_value], y=[1, max(int(curve['Peaks'].max()), 1)],
+                             mode='lines', name=label, line=dict(color='red', dash='dash')))
+    fig.update_layout(
+        title="Peaks by Prominence",
+        xaxis=dict(title="Prominence (cfs)", type='log'),
+        yaxis=dict(title="Peaks at or above the prominence", type='log'),
+        legend_title="Legend"
+    )
+    st.plotly_chart(fig)
@@ -1,91 +1,226 @@
 # Directory: app/data_io.py
 
 import os
+import hashlib
+from functools import partial
+import numpy as np
 import pandas as pd
-import hydrofunctions as hf
-from hydrofunctions.exceptions import HydroNoDataError
-from .helpers import CreateFolder
+from pandas.api.types import union_categoricals
 from .plotting import plot_discharge_hydrograph
-from .helpers import CreateFolder, log_progress
-import streamlit as st
-
-
-
-
-def GetFlow(site_no, begin_date, end_date, output_folder, user_months):
+from .helpers import CreateFolder, log_progress, run_in_background, notify_message
+from .fetchers import NWISFetcher, empty_discharge_frame
+from .cache import CachedFetcher
+from .site_store import SiteStore
+from .instrumentation import stage, timed
+
+
+
+
+# Rows hydrofunctions adds when it regularizes the series (Added 05/13/2025)
+EXCLUDED_QUALIFIERS = ['hf.upsampled', 'hf.missing']
+
+
+# Inclusive date slices to request between begin_date and end_date. With user_months, only the
+# runs of selected months are requested (padded by a day on each side because NWIS days are in
+# local time while the month filter uses UTC). Each run is split into slices of chunk_days.
+def ingestion_slices(begin_date, end_date, user_months=None, chunk_days=366):
+    begin = pd.Timestamp(begin_date).normalize()
+    end = pd.Timestamp(end_date).normalize()
+    one_day = pd.Timedelta(days=1)
+
+    if user_months is None or set(user_months) >= set(range(1, 13)):
+        runs = [(begin, end)]
+    else:
+        runs = []
+        for month_start in pd.date_range(begin.replace(day=1), end, freq='MS'):
+            if month_start.month not in user_months:
+                continue
+            run_start = max(month_start - one_day, begin)
+            run_end = min(month_start + pd.offsets.MonthEnd(1) + one_day, end)
+            if runs and run_start <= runs[-1][1] + one_day:
+                runs[-1] = (runs[-1][0], run_end)
+            else:
+                runs.append((run_start, run_end))
+
+    slices = []
+    for run_start, run_end in runs:
+        start = run_start
+        while start <= run_end:
+            stop = min(start + pd.Timedelta(days=chunk_days - 1), run_end)
+            slices.append((start, stop))
+            start = stop + one_day
+    return slices
+
+
+# float32 discharge and categorical qualifiers: roughly a third of the memory of float64 + object
+def compact_discharge(frame):
+    return pd.DataFrame({
+        'discharge_cfs': frame['discharge_cfs'].to_numpy(dtype=np.float32),
+        'qualifiers': pd.Categorical(frame['qualifiers']),
+    }, index=frame.index)
+
+
+def concat_discharge(chunks):
+    chunks = [chunk for chunk in chunks if not chunk.empty]
+    if not chunks:
+        return compact_discharge(empty_discharge_frame())
+
+    index = chunks[0].index.append([chunk.index for chunk in chunks[1:]])
+    discharge = pd.DataFrame({
+        'discharge_cfs': np.concatenate([chunk['discharge_cfs'].to_numpy(dtype=np.float32) for chunk in chunks]),
+        'qualifiers': union_categoricals([pd.Categorical(chunk['qualifiers']) for chunk in chunks]),
+    }, index=index)
+    discharge = discharge[~discharge.index.duplicated(keep='last')]
+    if not discharge.index.is_monotonic_increasing:
+        discharge = discharge.sort_index()
+    return discharge
+
+
+# Content signature of a discharge record: row count, first and last time and a checksum of the
+# times and values. Memoized results are keyed on it, so downloading the same range again after
+# NWIS revised provisional values does not return results computed from the old values.
+def discharge_signature(discharge):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(discharge.index.asi8).tobytes())
+    digest.update(np.ascontiguousarray(discharge['discharge_cfs'].to_numpy(dtype=np.float32)).tobytes())
+    if discharge.empty:
+        return 0, None, None, digest.hexdigest()
+    return len(discharge), str(discharge.index[0]), str(discharge.index[-1]), digest.hexdigest()
+
+
+# Download the record slice by slice, keeping only compact, month-filtered chunks in memory.
+# progress(done, total) is called after every slice.
+def ingest_discharge(fetcher, site_no, begin_date, end_date, user_months=None, chunk_days=366, log=None,
+                     progress=None):
+    chunks = []
+    slices = list(ingestion_slices(begin_date, end_date, user_months, chunk_days))
+    for done, (start, stop) in enumerate(slices, start=1):
+        chunk = fetcher.discharge(site_no, start.date(), stop.date(), log=log)
+        chunk = chunk[~chunk['qualifiers'].isin(EXCLUDED_QUALIFIERS)]
+        if user_months is not None:
+            chunk = chunk[chunk.index.month.isin(user_months)]
+        if not chunk.empty:
+            chunks.append(compact_discharge(chunk))
+        if progress is not None:
+            progress(done, len(slices))
+    return concat_discharge(chunks)
+
+
+# Download a site's record and save it. Returns (month-filtered discharge, site folder, discharge
+# write): with background=True the discharge CSV or store is written by a background task and the
+# third value is its future, to wait on before reading the file back; otherwise it is None. The
+# hydrograph figure goes to `figures` (a rendering.Figures, the process default when None).
+def GetFlow(site_no, begin_date, end_date, output_folder, user_months, fetcher=None, cache_dir=None,
+            save_csv=True, save_plot=True, background=False, chunk_days=366, filter_months_on_ingest=False,
+            storage='csv', notify=None, progress=None, figures=None):
     USGS_data = os.path.join(output_folder, f'USGS{site_no}')
     CreateFolder(USGS_data)
 
-    try:
-        discharge = hf.NWIS(site_no, 'iv', begin_date, end_date)
-        log_progress(USGS_data, f"Raw NWIS columns: {discharge.df().columns.tolist()}")
+    # Download from NWIS unless another source (e.g. a LocalFetcher over saved data) is given
+    if fetcher is None:
+        fetcher = NWISFetcher()
+    if cache_dir is not None:
+        fetcher = CachedFetcher(fetcher, cache_dir)
 
-    except HydroNoDataError:
+    try:
+        with stage('download') as timing:
+            raw_data = ingest_discharge(fetcher, site_no, begin_date, end_date,
+                                        user_months if filter_months_on_ingest else None, chunk_days,
+                                        log=partial(log_progress, USGS_data), progress=progress)
+            timing.rows = len(raw_data)
+    except ValueError as e:
+        # Raised when the site has no streamflow (parameter 00060) columns
+        notify_message(notify, 'error', str(e))
+        log_progress(USGS_data, str(e))
+        raise
+
+    if raw_data.empty:
         msg = f"No data available for site {site_no} between {begin_date} and {end_date}."
-        st.error(msg)
+        notify_message(notify, 'error', msg)
         log_progress(USGS_data, msg)
-        raise  # Let the app stop as before
-
-
-    # Get the actual discharge column (parameter 00060)
-    # Identify available columns
-    columns = discharge.df().columns.tolist()
-    log_progress(USGS_data, f"Raw NWIS columns: {columns}")
-
-    # Safely extract the discharge columns (parameter 00060 = streamflow)
-    discharge_cols = [col for col in columns if ':00060:' in col and 'qualifiers' not in col]
-    qualifier_cols = [col for col in columns if ':00060:' in col and 'qualifiers' in col]
-
-    # If not found, notify user and stop
-    if not discharge_cols or not qualifier_cols:
-        msg = (
-            f"No streamflow data (parameter 00060) found for site {site_no}. "
-            f"Available columns: {columns}"
-        )
-        st.error(msg)
-        log_progress(USGS_data, msg)
-        raise ValueError(msg)
-
-    # Use the first matching column
-    discharge_column = discharge_cols[0]
-    qualifier_column = qualifier_cols[0]
-    log_progress(USGS_data, f"Using discharge column: {discharge_column}")
-
-
-    raw_data = pd.DataFrame({
-        'discharge_cfs': discharge.df()[discharge_column],
-        'qualifiers': discharge.df()[qualifier_column]
-    })
-
-
-    # Filter out rows with "hf.upsampled" or "hf.missing" qualifiers (Added 05/13/2025)
-    raw_data = raw_data[~raw_data['qualifiers'].isin(['hf.upsampled', 'hf.missing'])]
+        from hydrofunctions.exceptions import HydroNoDataError
+        raise HydroNoDataError(msg)  # Let the app stop as before
 
 
     log_progress(USGS_data, f"Started data download for site {site_no}")
 
-    site_info = hf.site_file(site_no)
-    site_info_df = pd.DataFrame(site_info.table)
+    with stage('site info'):
+        site_info_df = fetcher.site_info(site_no)
+    site_info_df.to_csv(os.path.join(USGS_data, f"site_{site_no}_info.csv"))
 
-    raw_data.to_csv(os.path.join(USGS_data, f"USGS_Discharge_{site_no}.csv"))
+    log_progress(USGS_data, f"Saved site info CSV for site {site_no}")
 
+    # The CSV export and the full-period figure are side outputs; the frame itself is returned directly
+    side_outputs = []
+    if storage == 'store':
+        side_outputs.append(("discharge store", save_discharge_store, raw_data, site_no, USGS_data))
+    elif save_csv:
+        side_outputs.append(("discharge CSV", save_discharge_csv, raw_data, site_no, USGS_data))
+    if save_plot:
+        side_outputs.append(("discharge hydrograph", plot_discharge_hydrograph, raw_data, site_no, USGS_data, figures))
+
+    discharge_written = None
+    for description, func, *args in side_outputs:
+        if not background:
+            func(*args)
+            continue
+        future = run_in_background(USGS_data, description, func, *args)
+        if func is not plot_discharge_hydrograph:
+            discharge_written = future
+
+    return raw_data[raw_data.index.month.isin(user_months)], USGS_data, discharge_written
+
+
+# Write the discharge CSV through a temporary file so readers never see a partial export
+@timed('save discharge', rows_arg='raw_data')
+def save_discharge_csv(raw_data, site_no, USGS_data):
+    csv_path = os.path.join(USGS_data, f"USGS_Discharge_{site_no}.csv")
+    raw_data.to_csv(csv_path + ".tmp")
+    os.replace(csv_path + ".tmp", csv_path)
     log_progress(USGS_data, f"Saved discharge CSV for site {site_no}")
 
-    site_info_df.to_csv(os.path.join(USGS_data, f"site_{site_no}_info.csv"))
 
-    log_progress(USGS_data, f"Saved site info CSV for site {site_no}")
+@timed('save discharge', rows_arg='raw_data')
+def save_discharge_store(raw_data, site_no, USGS_data):
+    SiteStore(USGS_data).put_discharge(raw_data)
+    log_progress(USGS_data, f"Saved discharge for site {site_no} to the site store")
+
 
-    plot_discharge_hydrograph(raw_data, site_no, USGS_data)
+# The saved discharge record of a site: the site store's table or the USGS_Discharge CSV
+def discharge_path(USGS_data, site_no, storage='csv'):
+    if storage == 'store':
+        return SiteStore(USGS_data).path('discharge')
+    return os.path.join(USGS_data, f"USGS_Discharge_{site_no}.csv")
 
-    discharge_data = pd.read_csv(os.path.join(USGS_data, f"USGS_Discharge_{site_no}.csv"))
-    discharge_data['datetimeUTC'] = pd.to_datetime(discharge_data['datetimeUTC'])
-    discharge_data.set_index('datetimeUTC', inplace=True)
 
-    return discharge_data[discharge_data.index.month.isin(user_months)], USGS_data
+# Read either kind of saved discharge record into the compact layout
+def read_discharge_file(discharge_file, user_months=None):
+    with stage('load discharge') as timing:
+        if discharge_file.endswith(".parquet"):
+            discharge = pd.read_parquet(discharge_file)
+            if user_months is not None:
+                discharge = discharge[discharge.index.month.isin(user_months)]
+        else:
+            discharge = read_discharge_csv(discharge_file, user_months)
+        timing.rows = len(discharge)
+    return discharge
 
-def read_data(peaks_file, discharge_file):
+
+def read_data(peaks_file, discharge_file, user_months=None):
     peaks_df = pd.read_csv(peaks_file)
-    discharge_data = pd.read_csv(discharge_file)
-    discharge_data['datetimeUTC'] = pd.to_datetime(discharge_data['datetimeUTC'])
-    discharge_data.set_index('datetimeUTC', inplace=True)
+    discharge_data = read_discharge_file(discharge_file, user_months)
     return peaks_df, discharge_data
+
+
+# Read a USGS_Discharge CSV in chunks into the compact layout, dropping excluded months per chunk
+def read_discharge_csv(discharge_file, user_months=None, chunksize=200_000):
+    chunks = []
+    reader = pd.read_csv(discharge_file, chunksize=chunksize,
+                         dtype={'discharge_cfs': np.float32, 'qualifiers': 'category'})
+    for chunk in reader:
+        chunk['datetimeUTC'] = pd.to_datetime(chunk['datetimeUTC'])
+        chunk.set_index('datetimeUTC', inplace=True)
+        if user_months is not None:
+            chunk = chunk[chunk.index.month.isin(user_months)]
+        chunks.append(chunk)
+    return concat_discharge(chunks)
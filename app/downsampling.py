@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+# Default number of points sent to the browser for one Plotly trace
+DEFAULT_POINT_BUDGET = 2000
+
+
+# Numeric positions for the x axis (datetimes as int64 nanoseconds, tz-aware or not)
+def x_positions(x, n):
+    if x is None:
+        return np.arange(n, dtype=float)
+    if isinstance(x, (pd.Series, pd.Index)) and isinstance(x.dtype, pd.DatetimeTZDtype):
+        x = x.tz_convert(None) if isinstance(x, pd.Index) else x.dt.tz_convert(None)
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').view('int64').astype(float)
+    return x.astype(float)
+
+
+# Largest-Triangle-Three-Buckets: positions of n_out points that keep the visual shape of the line
+def lttb_indices(x, y, n_out):
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # First and last points are always kept; the rest is split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    anchor = 0
+    for bucket in range(n_out - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_start, next_stop = edges[bucket + 1], edges[bucket + 2]
+            mean_x = x[next_start:next_stop].mean()
+            mean_y = y[next_start:next_stop].mean()
+        else:
+            mean_x, mean_y = x[n - 1], y[n - 1]
+
+        area = np.abs((x[anchor] - mean_x) * (y[start:stop] - y[anchor])
+                      - (x[anchor] - x[start:stop]) * (mean_y - y[anchor]))
+        anchor = start + int(np.argmax(area))
+        selected[bucket + 1] = anchor
+
+    return selected
+
+
+# Positions of the minimum and maximum sample of each of n_columns equal-width x columns
+def minmax_indices(x, y, n_columns):
+    n = len(y)
+    if n <= 2 * n_columns:
+        return np.arange(n)
+    span = x[-1] - x[0]
+    if span <= 0:
+        return np.arange(n)
+    column = np.minimum(((x - x[0]) / span * n_columns).astype(np.int64), n_columns - 1)
+
+    # Sorting by (column, value) puts each column's minimum first and maximum last
+    order = np.lexsort((y, column))
+    starts = np.flatnonzero(np.r_[True, column[order][1:] != column[order][:-1]])
+    ends = np.r_[starts[1:], len(order)] - 1
+    return np.unique(np.concatenate([order[starts], order[ends]]))
+
+
+# Positions (into the original arrays) of at most ~max_points samples to draw. Missing values are
+# skipped and the global maximum and minimum are always kept, so peaks stay exact. With
+# max_points=None every position is returned (full resolution).
+def downsample_indices(x, y, max_points=DEFAULT_POINT_BUDGET, method='lttb'):
+    y = np.asarray(y, dtype=float)
+    if max_points is None or len(y) <= max_points:
+        return np.arange(len(y))
+
+    valid = np.flatnonzero(~np.isnan(y))
+    if len(valid) == 0:
+        return valid
+    positions = x_positions(x, len(y))[valid]
+    values = y[valid]
+
+    if method == 'lttb':
+        picked = lttb_indices(positions, values, max_points)
+    elif method == 'minmax':
+        picked = minmax_indices(positions, values, max(1, max_points // 2))
+    else:
+        raise ValueError(f"Unknown downsampling method '{method}', expected 'lttb' or 'minmax'")
+
+    extremes = [int(np.argmax(values)), int(np.argmin(values))]
+    return valid[np.union1d(picked, extremes)]
+
+
+# Convenience wrapper returning the downsampled x and y themselves
+def downsample(x, y, max_points=DEFAULT_POINT_BUDGET, method='lttb'):
+    keep = downsample_indices(x, y, max_points, method)
+    x_values = np.arange(len(y)) if x is None else x
+    if isinstance(x_values, (pd.Series, pd.Index)):
+        x_values = x_values[keep] if isinstance(x_values, pd.Index) else x_values.iloc[keep]
+    else:
+        x_values = np.asarray(x_values)[keep]
+    y_values = y.iloc[keep] if isinstance(y, pd.Series) else np.asarray(y)[keep]
+    return x_values, y_values
+
+
+# Chart title noting when a trace is drawn from fewer points than the data has
+def downsampled_title(title, shown_points, total_points):
+    if shown_points >= total_points:
+        return title
+    return f"{title} ({shown_points:,} of {total_points:,} points shown)"
@@ -0,0 +1,330 @@
+import os
+import re
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy.interpolate import Akima1DInterpolator
+from .normalization import akima_on_grid, ragged_offsets
+from .time_grid import TimeGrid, event_end
+from .helpers import CreateFolder
+
+# Percentile bands reported next to the mean and median overall DUH
+DEFAULT_PERCENTILES = (5, 25, 75, 95)
+
+# DUH_Event_N.csv files, or DUH_Event_N entries of a site store
+_DUH_FILE = re.compile(r"^DUH_Event_(\d+)(\.csv)?$")
+
+
+# DUH_Event_*.csv files in a folder, ordered by event number
+def list_duh_files(directory):
+    matches = [(int(match.group(1)), name) for name in os.listdir(directory)
+               for match in [_DUH_FILE.match(name)] if match and match.group(2)]
+    return [name for _, name in sorted(matches)]
+
+
+# Read every DUH event file once, keeping only the two columns as float arrays
+def load_duh_events(directory):
+    events = []
+    for filename in list_duh_files(directory):
+        duh = pd.read_csv(os.path.join(directory, filename), usecols=['Normalized Time', 'Normalized Discharge'])
+        events.append((filename,
+                       duh['Normalized Time'].to_numpy(dtype=float),
+                       duh['Normalized Discharge'].to_numpy(dtype=float)))
+    return events
+
+
+# Akima interpolation of one event evaluated directly on the grid; NaN outside the event's time span
+def interpolate_event(normalized_time, normalized_discharge, common_time_axis):
+    valid = ~(np.isnan(normalized_time) | np.isnan(normalized_discharge))
+    time, discharge = normalized_time[valid], normalized_discharge[valid]
+    order = np.argsort(time, kind='stable')
+    time, discharge = time[order], discharge[order]
+    unique = np.r_[True, np.diff(time) > 0][:len(time)]
+    time, discharge = time[unique], discharge[unique]
+
+    if len(time) < 2:
+        return None
+    return Akima1DInterpolator(time, discharge)(common_time_axis, extrapolate=False)
+
+
+# Interpolate all events into one (events x grid) float32 matrix in a single vectorized pass
+# (normalization.akima_on_grid). Returns the matrix and the names of the events that were stacked,
+# in row order.
+def stack_duhs(events, common_time_axis):
+    if not events:
+        return np.empty((0, len(common_time_axis)), dtype=np.float32), []
+    offsets = ragged_offsets([len(normalized_time) for _, normalized_time, _ in events])
+    matrix, usable = akima_on_grid(offsets, np.concatenate([normalized_time for _, normalized_time, _ in events]),
+                                   np.concatenate([discharge for _, _, discharge in events]), common_time_axis)
+    return matrix[usable], [name for (name, _, _), stacked in zip(events, usable) if stacked]
+
+
+# Mean, median, percentile bands and event count at every grid point of a DUH stack
+def summarize_duh_stack(matrix, common_time_axis, percentiles=DEFAULT_PERCENTILES):
+    counts = np.sum(~np.isnan(matrix), axis=0)
+    sums = np.nansum(matrix, axis=0, dtype=np.float64)
+    sums_of_squares = np.nansum(np.square(matrix, dtype=np.float64), axis=0)
+    return _summary_frame(common_time_axis, sums, sums_of_squares, counts, matrix, percentiles)
+
+
+def _summary_frame(common_time_axis, sums, sums_of_squares, counts, matrix, percentiles):
+    summary = {'Normalized Time': common_time_axis}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        safe_counts = np.where(counts > 0, counts, np.nan)
+        mean = sums / safe_counts
+        variance = np.maximum(sums_of_squares / safe_counts - mean ** 2, 0.0)
+    summary['Normalized Discharge'] = mean
+    summary['Std Normalized Discharge'] = np.sqrt(variance)
+
+    if percentiles is not None:
+        covered = counts > 0
+        stats = np.full((len(percentiles) + 1, len(common_time_axis)), np.nan)
+        if covered.any():
+            stats[:, covered] = np.nanpercentile(matrix[:, covered].astype(np.float64), [50, *percentiles], axis=0)
+        summary['Median Normalized Discharge'] = stats[0]
+        for row, percentile in enumerate(percentiles, start=1):
+            summary[f'P{percentile:02d} Normalized Discharge'] = stats[row]
+
+    summary['Event Count'] = counts
+    return pd.DataFrame(summary)
+
+
+# Running aggregate of the interpolated event DUHs, saved next to overall_duh.csv. STATE_FILE holds
+# the per-grid-point sum, sum of squares and count, the last normalized time of every event and a
+# manifest of the event files (content hash, size and mtime), so adding, changing or removing an
+# event only costs the interpolation of that event and an O(grid) update of the sums. Each event's
+# interpolated row is written once to its own file in ROWS_FOLDER (named by event and content hash)
+# and only read back when a caller asks for the percentile bands or the stacked matrix
+# (summarize_duh_state), or to take the event out of the sums. With a time_grid.TimeGrid the grid follows the longest event: it
+# gains or loses nodes at its end, which only pads or trims the sums; rows are padded or cut to the
+# grid when they are read.
+STATE_FILE = "overall_duh_state.npz"
+ROWS_FOLDER = "overall_duh_rows"
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _empty_state(directory, common_time_axis):
+    return {
+        'directory': directory,
+        'grid': np.asarray(common_time_axis, dtype=np.float64),
+        'sum': np.zeros(len(common_time_axis)),
+        'sumsq': np.zeros(len(common_time_axis)),
+        'count': np.zeros(len(common_time_axis), dtype=np.int64),
+        'manifest': {},   # filename -> (hash, size, mtime_ns)
+        'ends': {},       # filename -> last normalized time of the event
+    }
+
+
+# The saved state when it was made on the given grid (an array, or a grid of this TimeGrid's
+# nodes), an empty one otherwise
+def load_duh_state(directory, common_time_axis):
+    empty_grid = common_time_axis.axis() if isinstance(common_time_axis, TimeGrid) else common_time_axis
+    path = os.path.join(directory, STATE_FILE)
+    if not os.path.exists(path):
+        return _empty_state(directory, empty_grid)
+
+    with np.load(path) as saved:
+        # A different grid means every row has to be interpolated again
+        if isinstance(common_time_axis, TimeGrid):
+            same_grid = common_time_axis.holds(saved['grid'])
+        else:
+            same_grid = saved['grid'].shape == np.shape(common_time_axis) and np.array_equal(saved['grid'],
+                                                                                             common_time_axis)
+        if not same_grid:
+            return _empty_state(directory, empty_grid)
+        names = saved['names'].tolist()
+        state = {
+            'directory': directory,
+            'grid': saved['grid'],
+            'sum': saved['sum'],
+            'sumsq': saved['sumsq'],
+            'count': saved['count'],
+            'manifest': {name: (file_hash, int(size), int(mtime)) for name, file_hash, size, mtime
+                         in zip(names, saved['hashes'].tolist(), saved['sizes'], saved['mtimes'])},
+            'ends': dict(zip(names, saved['ends'].tolist())),
+        }
+    return state
+
+
+def save_duh_state(state):
+    names = list(state['manifest'])
+    path = os.path.join(state['directory'], STATE_FILE)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, grid=state['grid'], sum=state['sum'], sumsq=state['sumsq'], count=state['count'],
+                 names=np.array(names, dtype=str),
+                 hashes=np.array([state['manifest'][name][0] for name in names], dtype=str),
+                 sizes=np.array([state['manifest'][name][1] for name in names], dtype=np.int64),
+                 mtimes=np.array([state['manifest'][name][2] for name in names], dtype=np.int64),
+                 ends=np.array([state['ends'][name] for name in names], dtype=np.float64))
+    os.replace(path + ".tmp", path)
+
+
+def _row_path(state, name):
+    return os.path.join(state['directory'], ROWS_FOLDER, f"{name}.{state['manifest'][name][0]}.npy")
+
+
+# An event's row on the state's grid: nodes added since it was written are past the event's end
+def _read_row(state, name):
+    row = np.load(_row_path(state, name))[:len(state['grid'])]
+    return np.r_[row, np.full(len(state['grid']) - len(row), np.nan, dtype=np.float32)]
+
+
+# Take an event out of the sums; returns its row file, to be deleted once the state is saved
+def _remove_row(state, name):
+    row = _read_row(state, name)
+    path = _row_path(state, name)
+    state['manifest'].pop(name)
+    state['ends'].pop(name)
+    valid = ~np.isnan(row)
+    state['sum'][valid] -= row[valid]
+    state['sumsq'][valid] -= np.square(row[valid], dtype=np.float64)
+    state['count'][valid] -= 1
+    # Clear rounding residue where no events are left
+    state['sum'][state['count'] == 0] = 0.0
+    state['sumsq'][state['count'] == 0] = 0.0
+    return path
+
+
+def _add_row(state, name, row, manifest_entry, end):
+    valid = ~np.isnan(row)
+    state['sum'][valid] += row[valid]
+    state['sumsq'][valid] += np.square(row[valid], dtype=np.float64)
+    state['count'][valid] += 1
+    state['manifest'][name] = manifest_entry
+    state['ends'][name] = end
+    path = _row_path(state, name)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, row)
+    os.replace(path + ".tmp", path)
+
+
+# Move the state onto `grid`, which shares its first nodes with the state's grid: the sums are cut
+# or padded at the end. The nodes that are cut lie past the end of every event left.
+def _resize_state(state, grid):
+    kept = min(len(grid), len(state['grid']))
+    added = len(grid) - kept
+    state['grid'] = np.asarray(grid, dtype=np.float64)
+    for key in ('sum', 'sumsq', 'count'):
+        state[key] = np.r_[state[key][:kept], np.zeros(added, dtype=state[key].dtype)]
+
+
+def _read_duh_file(path):
+    duh = pd.read_csv(path, usecols=['Normalized Time', 'Normalized Discharge'])
+    return duh['Normalized Time'].to_numpy(dtype=float), duh['Normalized Discharge'].to_numpy(dtype=float)
+
+
+# (name, quick key, content hash, loader) for every DUH_Event file. The quick key (size, mtime)
+# lets unchanged files be skipped without reading them.
+def _file_entries(directory):
+    for name in list_duh_files(directory):
+        path = os.path.join(directory, name)
+        stat = os.stat(path)
+        yield name, (stat.st_size, stat.st_mtime_ns), lambda path=path: _file_hash(path), \
+            lambda path=path: _read_duh_file(path)
+
+
+# Same for events that are already in memory (e.g. read from a site store); hashed by content
+def _array_entries(events):
+    for name, normalized_time, normalized_discharge in events:
+        content_hash = hashlib.sha1(np.ascontiguousarray(normalized_time).tobytes()
+                                    + np.ascontiguousarray(normalized_discharge).tobytes()).hexdigest()
+        yield name, None, lambda content_hash=content_hash: content_hash, \
+            lambda time=normalized_time, discharge=normalized_discharge: (time, discharge)
+
+
+# Bring the running state in line with the DUH_Event files currently in the folder, or with the
+# given (name, normalized time, normalized discharge) events. common_time_axis is a fixed grid or a
+# time_grid.TimeGrid, whose grid is fitted to the events. The state file is kept in directory.
+# Returns the state and a dict listing the added, changed, removed and failed events.
+def update_duh_state(directory, common_time_axis, events=None):
+    state = load_duh_state(directory, common_time_axis)
+    changes = {'added': [], 'changed': [], 'removed': [], 'failed': []}
+    touched = False
+    obsolete = []
+
+    rows_folder = os.path.join(directory, ROWS_FOLDER)
+    if not state['manifest'] and os.path.isdir(rows_folder):
+        # Rows of a state that is made again from scratch
+        shutil.rmtree(rows_folder)
+    CreateFolder(rows_folder)
+
+    entries = list(_file_entries(directory) if events is None else _array_entries(events))
+    current = [name for name, _, _, _ in entries]
+    for name in [name for name in state['manifest'] if name not in current]:
+        obsolete.append(_remove_row(state, name))
+        changes['removed'].append(name)
+
+    # New and modified events are read first: with a TimeGrid their ends decide the grid
+    pending = []
+    for name, quick_key, content_hash, load in entries:
+        known = state['manifest'].get(name)
+        # Size and mtime unchanged: trust the stored row without re-reading the file
+        if known is not None and quick_key is not None and known[1:] == quick_key:
+            continue
+        file_hash = content_hash()
+        manifest_entry = (file_hash,) + (quick_key if quick_key is not None else (0, 0))
+        if known is not None and known[0] == file_hash:
+            if known != manifest_entry:
+                state['manifest'][name] = manifest_entry
+                touched = True
+            continue
+        pending.append((name, known is not None, manifest_entry, load()))
+
+    for name, known, _, _ in pending:
+        if known:
+            obsolete.append(_remove_row(state, name))
+    if isinstance(common_time_axis, TimeGrid):
+        ends = list(state['ends'].values()) + [event_end(*loaded) for _, _, _, loaded in pending]
+        grid = common_time_axis.axis(max(ends, default=0.0))
+        if not np.array_equal(grid, state['grid']):
+            _resize_state(state, grid)
+            touched = True
+
+    for name, known, manifest_entry, (normalized_time, normalized_discharge) in pending:
+        values = interpolate_event(normalized_time, normalized_discharge, state['grid'])
+        if values is None:
+            changes['failed'].append(name)
+            continue
+        _add_row(state, name, values.astype(np.float32), manifest_entry,
+                 event_end(normalized_time, normalized_discharge))
+        changes['changed' if known else 'added'].append(name)
+
+    if touched or any(changes.values()) or not os.path.exists(os.path.join(directory, STATE_FILE)):
+        save_duh_state(state)
+    # A changed event's new row is in a new file; the old one goes once the saved state no longer names it
+    for path in obsolete:
+        if os.path.exists(path):
+            os.remove(path)
+    return state, changes
+
+
+# Event names of a running state in row order
+def duh_state_names(state):
+    return sorted(state['manifest'], key=lambda name: int(_DUH_FILE.match(name).group(1)))
+
+
+# The (events x grid) matrix of a running state's rows, read from ROWS_FOLDER, and the event names
+# in row order
+def load_duh_rows(state):
+    names = duh_state_names(state)
+    matrix = (np.stack([_read_row(state, name) for name in names]) if names
+              else np.empty((0, len(state['grid'])), dtype=np.float32))
+    return matrix, names
+
+
+# Overall DUH table from a running state. The mean, Std and count come from the sums alone; the rows
+# are only read for percentile bands or when with_matrix is set. Returns (summary, matrix or None,
+# names).
+def summarize_duh_state(state, percentiles=None, with_matrix=False):
+    if percentiles is None and not with_matrix:
+        matrix, names = None, duh_state_names(state)
+    else:
+        matrix, names = load_duh_rows(state)
+    summary = _summary_frame(state['grid'], state['sum'], state['sumsq'], state['count'], matrix, percentiles)
+    return summary, matrix if with_matrix else None, names
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter1d
+from .events import EventWindows, recession_windows, ragged_positions
+from .normalization import normalize_events, ragged_offsets
+from .helpers import log_progress
+from .instrumentation import stage
+from .site_store import SiteStore, save_event, save_smoothed, save_duh
+from .sigma_sweep import best_sigma, DEFAULT_MIN_NSE, DEFAULT_MAX_PEAK_ATTENUATION
+
+# "Process all events" mode: every peak is cut, smoothed and normalized in one pass over the record,
+# then the Event_*, S_Event_* and DUH_Event_* files (or site store rows) are written together. The files are the same as
+# the ones saved one event at a time from the app.
+
+
+# Per-event reductions of a flat array (events are consecutive, non-empty runs of the array)
+def _event_sums(values, event_ids, n_events):
+    return np.bincount(event_ids, weights=values, minlength=n_events)
+
+
+# The app smooths an event as read back from its Event CSV: float64 parsed from the shortest text
+# of each float32 value (7.74, not 7.7399997711). Windows of a float32 record are taken the same way,
+# so both paths give the same S_Event and DUH files.
+def _as_read_back(values):
+    if values.dtype == np.float32:
+        return values.astype(str).astype(np.float64)
+    return values.astype(np.float64)
+
+
+# Smoothing, NSE, peak difference and DUH for all windows at once. sigma is one value or one per
+# window; baseflow and baseflow_slope pick the baseflow separation (normalization.BASEFLOW_METHODS).
+# Returns flat arrays over the concatenated windows plus one row of statistics per event.
+def smooth_and_normalize(discharge, times_ns, starts, stops, sigma, baseflow='first', baseflow_slope=None):
+    n_events = len(starts)
+    event_ids, positions = ragged_positions(starts, stops)
+    observed64 = _as_read_back(discharge[positions])
+    firsts = np.r_[0, np.cumsum(stops - starts)[:-1]]
+    sigmas = np.broadcast_to(np.asarray(sigma, dtype=float), (n_events,))
+
+    # Each window is filtered on its own so scipy's edge handling applies at the window edges,
+    # just as in apply_gaussian_smoothing
+    smoothed64 = np.empty(observed64.shape, np.float64)
+    for first, length, event_sigma in zip(firsts, stops - starts, sigmas):
+        smoothed64[first:first + length] = gaussian_filter1d(observed64[first:first + length], sigma=event_sigma)
+
+    counts = np.bincount(event_ids, minlength=n_events)
+    means = _event_sums(observed64, event_ids, n_events) / counts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nse = 1 - (_event_sums((smoothed64 - observed64) ** 2, event_ids, n_events)
+                   / _event_sums((observed64 - means[event_ids]) ** 2, event_ids, n_events))
+    peak_diff = np.abs(np.maximum.reduceat(observed64, firsts) - np.maximum.reduceat(smoothed64, firsts))
+
+    # DUH: flow above the baseflow, scaled by its peak; time scaled by the time to peak
+    normalized_discharge, normalized_time, duh_stats = normalize_events(
+        ragged_offsets(counts), times_ns[positions], smoothed64, baseflow, baseflow_slope)
+
+    stats = pd.DataFrame({'Points': counts, 'Sigma': sigmas, 'NSE': nse, 'Peak Difference': peak_diff,
+                          'Time to Peak (hours)': duh_stats['Time to Peak (hours)'].to_numpy(),
+                          'Has DUH': duh_stats['Has DUH'].to_numpy()})
+    return smoothed64, normalized_discharge, normalized_time, firsts, stats
+
+
+# Cut, smooth and normalize every peak in peaks_df and write the event files into USGS_data.
+# With hours_before/hours_after the windows have fixed lengths; otherwise they are chosen by
+# recession_windows from the max_hours_* limits and recession_fraction. sigma='auto' picks each
+# event's sigma with a sweep limited by min_nse and max_peak_attenuation. progress(done, total) is
+# called while the files are written. With storage='store' the results go to the site store
+# instead of CSV files. baseflow and baseflow_slope pick the baseflow separation of the DUHs.
+# Returns one summary row per event.
+def process_all_events(discharge_data, peaks_df, USGS_data, sigma, hours_before=None, hours_after=None,
+                       max_hours_before=72, max_hours_after=240, recession_fraction=0.05, progress=None,
+                       min_nse=DEFAULT_MIN_NSE, max_peak_attenuation=DEFAULT_MAX_PEAK_ATTENUATION, storage='csv',
+                       baseflow='first', baseflow_slope=None):
+    event_windows = EventWindows(discharge_data)
+    discharge_data = event_windows.discharge_data
+    peak_dates = peaks_df['Peak_Date'] if len(peaks_df) else []
+
+    with stage('event windows', rows=len(peak_dates)):
+        if hours_before is not None and hours_after is not None:
+            peaks = event_windows.locate(peak_dates)
+            starts = np.full(len(peaks), -1, dtype=np.int64)
+            stops = np.full(len(peaks), -1, dtype=np.int64)
+            found = peaks >= 0
+            starts[found], stops[found] = event_windows.bounds(peaks[found], hours_before, hours_after)
+        else:
+            windows = recession_windows(event_windows, peak_dates, max_hours_before, max_hours_after, recession_fraction)
+            peaks, starts, stops = (windows[column].to_numpy() for column in ('peak', 'start', 'stop'))
+
+    event_numbers = np.arange(1, len(peaks) + 1)
+    usable = (peaks >= 0) & (stops - starts >= 2)
+    no_dates = pd.Series(pd.NaT, index=range(len(peaks)), dtype=discharge_data.index.dtype)
+    summary = pd.DataFrame({'Event': event_numbers, 'Peak_Date': list(peak_dates), 'Processed': usable,
+                            'Start_Date': no_dates, 'End_Date': no_dates.copy(), 'Points': 0, 'Sigma': np.nan, 'NSE': np.nan,
+                            'Peak Difference': np.nan, 'Time to Peak (hours)': np.nan, 'Has DUH': False})
+
+    if usable.any():
+        discharge = discharge_data['discharge_cfs'].to_numpy()
+        if sigma == 'auto':
+            sigma = [best_sigma(discharge[start:stop], min_nse=min_nse, max_peak_attenuation=max_peak_attenuation)[0]
+                     for start, stop in zip(starts[usable], stops[usable])]
+        with stage('smoothing and DUH normalization', rows=int((stops[usable] - starts[usable]).sum())):
+            smoothed, normalized_discharge, normalized_time, firsts, stats = smooth_and_normalize(
+                discharge, event_windows.times, starts[usable], stops[usable], sigma, baseflow, baseflow_slope)
+        summary.loc[usable, stats.columns] = stats.to_numpy()
+        summary.loc[usable, 'Start_Date'] = discharge_data.index[starts[usable]]
+        summary.loc[usable, 'End_Date'] = discharge_data.index[stops[usable] - 1]
+        summary = summary.astype({'Points': int, 'Sigma': float, 'NSE': float, 'Peak Difference': float,
+                                  'Time to Peak (hours)': float, 'Has DUH': bool})
+
+        lengths = stops[usable] - starts[usable]
+        with stage('save events', rows=int(lengths.sum())):
+            hydrographs, duhs = [], []
+            for done, (event_no, start, stop, first, length, has_duh) in enumerate(
+                    zip(event_numbers[usable], starts[usable], stops[usable], firsts, lengths, stats['Has DUH']), start=1):
+                storm_hydrograph = discharge_data.iloc[start:stop]
+                smoothed_data = storm_hydrograph.reset_index()
+                smoothed_data['smoothed_discharge_cfs'] = smoothed[first:first + length]
+                duh = (normalized_discharge[first:first + length], normalized_time[first:first + length])
+
+                if storage == 'store':
+                    # Collected and written to the site store in one go below
+                    hydrographs.append((event_no, smoothed_data))
+                    if has_duh:
+                        duhs.append((event_no,) + duh)
+                else:
+                    save_event(USGS_data, event_no, storm_hydrograph)
+                    save_smoothed(USGS_data, event_no, smoothed_data)
+                    if has_duh:
+                        save_duh(USGS_data, event_no, *duh)
+                if progress is not None:
+                    progress(done, int(usable.sum()))
+
+            store = SiteStore(USGS_data)
+            store.put_hydrographs(hydrographs)
+            store.put_duhs(duhs)
+
+    log_progress(USGS_data, f"Processed {int(usable.sum())} of {len(summary)} events in one pass "
+                            f"({'fixed' if hours_before is not None and hours_after is not None else 'recession-based'} windows).")
+    return summary
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+NS_PER_HOUR = 3_600_000_000_000
+
+
+# Function to get a subset of discharge data around a specified peak date
+def get_storm_hydrograph(discharge_data, peak_date, window_size_before, window_size_after):
+    if peak_date in discharge_data.index:
+        peak_idx = discharge_data.index.get_loc(peak_date)
+    else:
+        print(f"Peak date {peak_date} not found in discharge data.")
+        return None
+
+    start = max(peak_idx - window_size_before, 0)
+    end = min(peak_idx + window_size_after, len(discharge_data))
+    return discharge_data.iloc[start:end]
+
+
+# Datetimes (tz-aware, naive UTC or strings) as int64 UTC nanoseconds
+def utc_nanoseconds(values):
+    try:
+        times = pd.to_datetime(values, utc=True)
+    except ValueError:
+        # Strings in different layouts, e.g. with and without a time or an offset
+        times = pd.to_datetime(values, utc=True, format='mixed')
+    return pd.DatetimeIndex(times).as_unit('ns').asi8
+
+
+# Cuts event windows out of one discharge record. The sorted int64 time array is built once, after
+# which locating a peak and the edges of its window are binary searches. Windows are given in hours,
+# so a gap in the record shortens the window instead of stretching it over more days.
+class EventWindows:
+    def __init__(self, discharge_data):
+        if not discharge_data.index.is_monotonic_increasing:
+            discharge_data = discharge_data.sort_index()
+        self.discharge_data = discharge_data
+        self.times = utc_nanoseconds(discharge_data.index)
+
+    # Position of the sample closest to each peak date, or -1 when none lies within tolerance_hours
+    def locate(self, peak_dates, tolerance_hours=1.0):
+        targets = utc_nanoseconds(np.atleast_1d(peak_dates))
+        if len(self.times) == 0:
+            return np.full(len(targets), -1, dtype=np.int64)
+
+        right = np.clip(np.searchsorted(self.times, targets), 0, len(self.times) - 1)
+        left = np.maximum(right - 1, 0)
+        nearest = np.where(np.abs(self.times[left] - targets) <= np.abs(self.times[right] - targets), left, right)
+        if tolerance_hours is not None:
+            too_far = np.abs(self.times[nearest] - targets) > tolerance_hours * NS_PER_HOUR
+            nearest = np.where(too_far, -1, nearest)
+        return nearest.astype(np.int64)
+
+    # Start and stop positions of the windows around the given peak positions. The window lengths
+    # may be single values or one value per peak.
+    def bounds(self, peak_positions, hours_before, hours_after):
+        peak_times = self.times[peak_positions]
+        before = (np.asarray(hours_before, dtype=float) * NS_PER_HOUR).astype(np.int64)
+        after = (np.asarray(hours_after, dtype=float) * NS_PER_HOUR).astype(np.int64)
+        starts = np.searchsorted(self.times, peak_times - before, side='left')
+        stops = np.searchsorted(self.times, peak_times + after, side='right')
+        return starts, stops
+
+    def _found_bounds(self, peak_dates, hours_before, hours_after, tolerance_hours):
+        positions = self.locate(peak_dates, tolerance_hours)
+        found = positions >= 0
+        before = np.broadcast_to(np.asarray(hours_before, dtype=float), positions.shape)[found]
+        after = np.broadcast_to(np.asarray(hours_after, dtype=float), positions.shape)[found]
+        starts, stops = self.bounds(positions[found], before, after)
+        return found, starts, stops
+
+    # One event window as a frame, or None when the peak date is not in the record
+    def window(self, peak_date, hours_before, hours_after, tolerance_hours=1.0):
+        events = self.windows([peak_date], hours_before, hours_after, tolerance_hours)
+        return events[0]
+
+    # Event windows for many peaks in one call. Every window is a positional slice of the record,
+    # so no discharge values are copied; entries are None for peaks that could not be located.
+    def windows(self, peak_dates, hours_before, hours_after, tolerance_hours=1.0):
+        found, starts, stops = self._found_bounds(peak_dates, hours_before, hours_after, tolerance_hours)
+        events = iter([self.discharge_data.iloc[start:stop] for start, stop in zip(starts, stops)])
+        return [next(events) if ok else None for ok in found]
+
+    # Discharge values of each window as views into a single array, for numeric work without frames
+    def value_windows(self, peak_dates, hours_before, hours_after, tolerance_hours=1.0,
+                      column='discharge_cfs'):
+        values = self.discharge_data[column].to_numpy()
+        found, starts, stops = self._found_bounds(peak_dates, hours_before, hours_after, tolerance_hours)
+        views = iter([values[start:stop] for start, stop in zip(starts, stops)])
+        return [next(views) if ok else None for ok in found]
+
+
+# Flattened positions of many [start, stop) ranges, with the range number of every position
+def ragged_positions(starts, stops):
+    lengths = np.maximum(np.asarray(stops) - np.asarray(starts), 0)
+    ranges = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.repeat(np.asarray(starts) - (np.cumsum(lengths) - lengths), lengths)
+    return ranges, np.arange(lengths.sum()) + offsets
+
+
+# First position of every range in a flat array sorted by range number
+def _range_firsts(sorted_ranges):
+    return np.flatnonzero(np.r_[True, sorted_ranges[1:] != sorted_ranges[:-1]])
+
+
+# Event windows picked from the hydrograph itself instead of fixed lengths. An event starts at the
+# lowest flow in the max_hours_before leading up to its peak (the antecedent baseflow, latest sample
+# when several tie) and never before the previous peak. It ends on the recession, at the first sample
+# that falls back to baseflow + recession_fraction * (peak - baseflow); if the flow never gets that low
+# within max_hours_after or before the next event starts, it ends at the lowest flow in that span.
+# Returns a frame with one row per peak holding the peak, start and stop positions into the record
+# (-1 where the peak could not be located).
+def recession_windows(event_windows, peak_dates, max_hours_before=72, max_hours_after=240,
+                      recession_fraction=0.05, tolerance_hours=1.0, column='discharge_cfs'):
+    discharge = event_windows.discharge_data[column].to_numpy(dtype=float)
+    peaks = event_windows.locate(peak_dates, tolerance_hours)
+    found = np.flatnonzero(peaks >= 0)
+    starts = np.full(len(peaks), -1, dtype=np.int64)
+    stops = np.full(len(peaks), -1, dtype=np.int64)
+
+    if len(found):
+        order = found[np.argsort(peaks[found], kind='stable')]
+        peak_positions = peaks[order]
+        lookback, lookahead = event_windows.bounds(peak_positions, max_hours_before, max_hours_after)
+
+        # Rising limb: latest minimum between the lookback edge (or the previous peak) and the peak
+        lookback = np.maximum(lookback, np.r_[0, peak_positions[:-1] + 1])
+        lookback = np.minimum(lookback, peak_positions)
+        ranges, positions = ragged_positions(lookback, peak_positions + 1)
+        sort = np.lexsort((-positions, discharge[positions], ranges))
+        event_starts = positions[sort][_range_firsts(ranges[sort])]
+
+        # Recession: stop at the next event's start at the latest
+        lookahead = np.minimum(lookahead, np.r_[event_starts[1:] + 1, len(discharge)])
+        lookahead = np.maximum(lookahead, peak_positions + 1)
+        event_stops = peak_positions + 1
+        ranges, positions = ragged_positions(peak_positions + 1, lookahead)
+        if len(positions):
+            baseflow = discharge[event_starts]
+            threshold = baseflow + recession_fraction * (discharge[peak_positions] - baseflow)
+            sort = np.lexsort((positions, discharge[positions], ranges))
+            lowest = positions[sort][_range_firsts(ranges[sort])]
+            event_stops[np.unique(ranges)] = lowest + 1
+
+            receded = discharge[positions] <= threshold[ranges]
+            receded_ranges, first = np.unique(ranges[receded], return_index=True)
+            event_stops[receded_ranges] = positions[receded][first] + 1
+
+        starts[order], stops[order] = event_starts, event_stops
+
+    return pd.DataFrame({'peak': peaks, 'start': starts, 'stop': stops})
@@ -0,0 +1,84 @@
+import os
+import pandas as pd
+
+
+# Empty discharge frame with the same layout every fetcher returns
+def empty_discharge_frame():
+    index = pd.DatetimeIndex([], tz='UTC', name='datetimeUTC')
+    return pd.DataFrame({'discharge_cfs': pd.Series(dtype=float, index=index),
+                         'qualifiers': pd.Series(dtype=object, index=index)})
+
+
+# Keep only the rows between the start of begin_date and the end of end_date (UTC days)
+def slice_by_dates(frame, begin_date, end_date):
+    start = pd.Timestamp(begin_date).normalize().tz_localize('UTC')
+    stop = pd.Timestamp(end_date).normalize().tz_localize('UTC') + pd.Timedelta(days=1)
+    return frame[(frame.index >= start) & (frame.index < stop)]
+
+
+# Pick the streamflow (parameter 00060) value and qualifier columns out of a hydrofunctions frame
+def discharge_from_nwis_df(nwis_df, site_no, log=None):
+    columns = nwis_df.columns.tolist()
+    if log is not None:
+        log(f"Raw NWIS columns: {columns}")
+
+    # Safely extract the discharge columns (parameter 00060 = streamflow)
+    discharge_cols = [col for col in columns if ':00060:' in col and 'qualifiers' not in col]
+    qualifier_cols = [col for col in columns if ':00060:' in col and 'qualifiers' in col]
+
+    if not discharge_cols or not qualifier_cols:
+        raise ValueError(
+            f"No streamflow data (parameter 00060) found for site {site_no}. "
+            f"Available columns: {columns}"
+        )
+
+    # Use the first matching column
+    if log is not None:
+        log(f"Using discharge column: {discharge_cols[0]}")
+
+    raw_data = pd.DataFrame({
+        'discharge_cfs': nwis_df[discharge_cols[0]],
+        'qualifiers': nwis_df[qualifier_cols[0]]
+    })
+    raw_data.index.name = 'datetimeUTC'
+    return raw_data
+
+
+# Fetcher that downloads instantaneous values and site info from USGS NWIS. hydrofunctions is
+# imported on first use, so fetchers over saved data work without it.
+class NWISFetcher:
+    def discharge(self, site_no, begin_date, end_date, log=None):
+        import hydrofunctions as hf
+        from hydrofunctions.exceptions import HydroNoDataError
+        try:
+            nwis = hf.NWIS(site_no, 'iv', str(begin_date), str(end_date))
+        except HydroNoDataError:
+            return empty_discharge_frame()
+
+        return discharge_from_nwis_df(nwis.df(), site_no, log)
+
+    def site_info(self, site_no):
+        import hydrofunctions as hf
+        return pd.DataFrame(hf.site_file(site_no).table)
+
+
+# Offline stand-in that serves a previously saved USGS{site_no} folder (e.g. tests/USGS05125039)
+class LocalFetcher:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def discharge(self, site_no, begin_date, end_date, log=None):
+        path = os.path.join(self.directory, f"USGS_Discharge_{site_no}.csv")
+        if not os.path.exists(path):
+            return empty_discharge_frame()
+
+        raw_data = pd.read_csv(path, dtype={'qualifiers': object})
+        raw_data['datetimeUTC'] = pd.to_datetime(raw_data['datetimeUTC'])
+        raw_data.set_index('datetimeUTC', inplace=True)
+        if log is not None:
+            log(f"Loaded discharge for site {site_no} from {path}")
+        return slice_by_dates(raw_data, begin_date, end_date)
+
+    def site_info(self, site_no):
+        return pd.read_csv(os.path.join(self.directory, f"site_{site_no}_info.csv"), index_col=0,
+                           dtype={'site_no': str})
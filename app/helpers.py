@@ -1,5 +1,11 @@
 import os
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from .instrumentation import current_report, use_report
 
 
 # Function to create a folder at the given path if it does not exist
@@ -7,8 +13,128 @@ def CreateFolder(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
+
+# Log files are kept open and buffered instead of being reopened for every message. A background
+# thread writes buffered lines out every LOG_FLUSH_SECONDS and closes files that have had no message
+# for LOG_IDLE_SECONDS (an open file cannot be moved or deleted on Windows). At most MAX_OPEN_LOGS
+# are open at once; the least recently used one is closed first. flush_logs() writes everything
+# out right away, e.g. at the end of a batch site or a job.
+LOG_FLUSH_SECONDS = 2.0
+LOG_IDLE_SECONDS = 10.0
+MAX_OPEN_LOGS = 8
+
+
+class _LogWriter:
+    def __init__(self):
+        # log file -> (open file, time of its last message), least recently used first
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def write(self, log_file, line):
+        with self.lock:
+            entry = self.files.pop(log_file, None)
+            if entry is not None:
+                f = entry[0]
+            else:
+                if len(self.files) >= MAX_OPEN_LOGS:
+                    _, (oldest, _) = self.files.popitem(last=False)
+                    oldest.close()
+                f = open(log_file, "a")
+            f.write(line)
+            self.files[log_file] = (f, time.monotonic())
+            # A worker process of the batch runner inherits the object but not the thread
+            if self.flusher is None or not self.flusher.is_alive():
+                self.flusher = threading.Thread(target=self._run, name="nuhg-log-flush", daemon=True)
+                self.flusher.start()
+
+    # Flush every LOG_FLUSH_SECONDS until no log file is left open
+    def _run(self):
+        while True:
+            time.sleep(LOG_FLUSH_SECONDS)
+            with self.lock:
+                self._flush()
+                if not self.files:
+                    self.flusher = None
+                    return
+
+    def _flush(self):
+        now = time.monotonic()
+        for log_file, (f, last_write) in list(self.files.items()):
+            if now - last_write >= LOG_IDLE_SECONDS:
+                f.close()
+                del self.files[log_file]
+            else:
+                f.flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            for f, _ in self.files.values():
+                f.close()
+            self.files.clear()
+
+
+_log_writer = _LogWriter()
+atexit.register(_log_writer.close)
+
+
 def log_progress(folder_path, message):
     log_file = os.path.join(folder_path, "nuhg_log.txt")
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(log_file, "a") as f:
-        f.write(f"[{timestamp}] {message}\n")
\ No newline at end of file
+    _log_writer.write(log_file, f"[{timestamp}] {message}\n")
+
+
+# Messages meant for the user are passed to a notify(level, message) callback, level being 'info',
+# 'success', 'warning' or 'error'. The app shows them on the page (charts.streamlit_notify); the
+# batch runner writes them to the site's log (log_notifier). Without a callback they are dropped.
+NOTIFY_LEVELS = ('info', 'success', 'warning', 'error')
+
+
+def notify_message(notify, level, message):
+    if notify is not None:
+        notify(level, message)
+
+
+def log_notifier(folder_path):
+    def notify(level, message):
+        log_progress(folder_path, message if level in ('info', 'success') else f"{level.capitalize()}: {message}")
+    return notify
+
+
+# Write out buffered log lines, e.g. at the end of a run. Worker processes of the batch runner
+# do not run atexit handlers, so they call this themselves.
+def flush_logs():
+    _log_writer.flush()
+
+
+# Shared worker threads for side outputs (CSV exports, figures) that should not block the caller
+_background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="nuhg-background")
+
+
+def run_in_background(folder_path, description, func, *args, **kwargs):
+    # Stages timed in the task are recorded in the timing report of the run that queued it
+    def task(report=current_report()):
+        with use_report(report):
+            return func(*args, **kwargs)
+
+    future = _background_executor.submit(task)
+
+    # Log lines of the task (and its failure) are written out when it ends
+    def _finish(done):
+        if done.exception() is not None:
+            log_progress(folder_path, f"Background task failed ({description}): {done.exception()}")
+        flush_logs()
+
+    future.add_done_callback(_finish)
+    return future
+
+
+# Block until one background task (a future from run_in_background, or None for nothing) has
+# finished. Returns False when it failed; the failure is already in the folder's log, so it is
+# not raised again.
+def wait_for_background_task(future):
+    return future is None or future.exception() is None
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+import tracemalloc
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+
+# Stage timings for one run (one batch site, or one app session). Code inside `with stage(name):`
+# or in a function decorated with @timed(name) is recorded in the report made active for the
+# calling thread with start_report()/use_report(); without an active report nothing is recorded.
+# Background tasks (helpers.run_in_background) record into the report of the run that queued them.
+#
+# Each record has the wall time, the rows (samples or events) processed when known and, when the
+# report tracks memory, the peak traced memory above the stage's starting point. tracemalloc sees
+# the whole process, so stages running at the same time in other threads count towards each
+# other's peaks. Tracking memory slows allocation-heavy code down, so it is off by default.
+# A stage nested in another (plotting inside 'save peaks') is counted in both.
+
+RECORD_COLUMNS = ['run', 'stage', 'started_s', 'seconds', 'rows', 'peak_mb']
+
+_local = threading.local()
+_memory_lock = threading.Lock()
+_open_memory_records = []
+_started_tracing = False
+# Reports that have memory tracking on (see set_memory_tracking)
+_tracking_reports = weakref.WeakSet()
+
+
+class StageRecord:
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.seconds = None
+        self.peak_mb = None
+        self.base_bytes = 0
+        self.peak_bytes = 0
+
+
+class TimingReport:
+    def __init__(self, label="", track_memory=False):
+        self.label = label
+        self.track_memory = track_memory
+        self.started = time.time()
+        self.run = 1
+        self.records = []
+        self.lock = threading.Lock()
+
+    # Start the next run of a report kept across runs (an app session, where every rerun is a run)
+    def new_run(self):
+        self.run += 1
+
+    def add(self, record, started):
+        with self.lock:
+            self.records.append({'run': self.run, 'stage': record.name, 'started_s': round(started - self.started, 4),
+                                 'seconds': record.seconds, 'rows': record.rows, 'peak_mb': record.peak_mb})
+
+    def frame(self, run=None):
+        with self.lock:
+            records = list(self.records)
+        frame = pd.DataFrame(records, columns=RECORD_COLUMNS).astype({'seconds': float, 'rows': 'Int64',
+                                                                       'peak_mb': float})
+        return frame if run is None else frame[frame['run'] == run]
+
+    # One row per stage: calls, total seconds, share of the timed total, rows, rows per second, peak memory
+    def summary(self, run=None):
+        frame = self.frame(run)
+        grouped = frame.groupby('stage', sort=False)
+        summary = pd.DataFrame({
+            'Calls': grouped.size(),
+            'Seconds': grouped['seconds'].sum(),
+            'Rows': grouped['rows'].sum(min_count=1),
+            'Peak Memory (MB)': grouped['peak_mb'].max(),
+        })
+        summary['Share'] = summary['Seconds'] / summary['Seconds'].sum() if len(summary) else []
+        summary['Rows per Second'] = summary['Rows'] / summary['Seconds'].where(summary['Seconds'] > 0)
+        summary = summary.sort_values('Seconds', ascending=False).rename_axis('Stage').reset_index()
+        return summary[['Stage', 'Calls', 'Seconds', 'Share', 'Rows', 'Rows per Second', 'Peak Memory (MB)']]
+
+    # Write <name>.json (run details, per-stage summary and every record) and <name>.csv (the records)
+    def save(self, folder, name="timing_report"):
+        json_path = os.path.join(folder, f"{name}.json")
+        csv_path = os.path.join(folder, f"{name}.csv")
+        report = {
+            'label': self.label,
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'elapsed_s': round(time.time() - self.started, 3),
+            'track_memory': self.track_memory,
+            'stages': json.loads(self.summary().to_json(orient='records')),
+            'records': json.loads(self.frame().to_json(orient='records')),
+        }
+        with open(json_path + ".tmp", "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(json_path + ".tmp", json_path)
+        self.frame().to_csv(csv_path, index=False)
+        return json_path, csv_path
+
+
+def current_report():
+    return getattr(_local, 'report', None)
+
+
+def set_report(report):
+    _local.report = report
+
+
+# Make a new report the calling thread's active one
+def start_report(label="", track_memory=False):
+    report = TimingReport(label, track_memory)
+    set_report(report)
+    set_memory_tracking(track_memory, report)
+    return report
+
+
+# Make an existing report (or None) active for the duration of a block
+@contextmanager
+def use_report(report):
+    previous = current_report()
+    _local.report = report
+    try:
+        yield report
+    finally:
+        _local.report = previous
+
+
+# Turn memory tracking on or off for one report (an app session's, or a batch site's). tracemalloc
+# traces the whole process, so it runs while any live report has it on: one session turning it off
+# does not stop it in the middle of another session's stages, and a session that is gone no longer
+# counts. Only tracing this module started is stopped.
+def set_memory_tracking(enabled, report):
+    global _started_tracing
+    with _memory_lock:
+        if enabled:
+            _tracking_reports.add(report)
+        else:
+            _tracking_reports.discard(report)
+        if len(_tracking_reports) and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        elif not len(_tracking_reports) and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+# Fold the traced peak so far into every open stage, so resetting it for a new stage loses nothing
+def _update_open_peaks():
+    _, peak = tracemalloc.get_traced_memory()
+    for record in _open_memory_records:
+        record.peak_bytes = max(record.peak_bytes, peak)
+
+
+@contextmanager
+def stage(name, rows=None):
+    record = StageRecord(name, rows)
+    report = current_report()
+    if report is None:
+        yield record
+        return
+
+    track_memory = report.track_memory and tracemalloc.is_tracing()
+    if track_memory:
+        with _memory_lock:
+            _update_open_peaks()
+            tracemalloc.reset_peak()
+            record.base_bytes = record.peak_bytes = tracemalloc.get_traced_memory()[0]
+            _open_memory_records.append(record)
+
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = round(time.perf_counter() - start, 6)
+        if track_memory:
+            with _memory_lock:
+                _update_open_peaks()
+                _open_memory_records.remove(record)
+            record.peak_mb = round((record.peak_bytes - record.base_bytes) / 1e6, 3)
+        report.add(record, started)
+
+
+# Decorator form of stage(); rows_arg names the argument whose len() is the number of rows processed
+def timed(name, rows_arg=None):
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_report() is None:
+                return func(*args, **kwargs)
+            rows = None
+            if rows_arg is not None:
+                value = signature.bind_partial(*args, **kwargs).arguments.get(rows_arg)
+                rows = len(value) if hasattr(value, '__len__') else None
+            with stage(name, rows):
+                return func(*args, **kwargs)
+
+        return wrapper
+    return decorator
@@ -0,0 +1,350 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from .helpers import log_progress, notify_message, flush_logs
+from .instrumentation import current_report, use_report
+
+# Background jobs for the app's long actions (download, peak detection, overall DUH), so a Streamlit
+# session is not frozen while they run and several sessions on one server can work at once.
+#
+# A JobQueue runs tasks on a pool of worker threads and keeps a table of the jobs in SQLite:
+#   jobs          id, session, kind, label, site_key, status, progress (0-1), message, error,
+#                 created / started / finished (epoch seconds), claimed
+#   job_messages  the notify(level, message) messages of every job, in order
+# Status goes queued -> running -> done, failed or cancelled. The SQLite file lets any session
+# read progress while the workers write it; results and partial results are Python objects
+# (data frames) and stay in memory until the submitting session claims them.
+#
+# A task is func(job, *args, **kwargs). It reports through the Job it is given:
+#   job.notify(level, message)      a message for the user (helpers.notify_message levels)
+#   job.progress(done, total, text) progress of the task
+#   job.partial(name, value)        an intermediate result the session can show before the end
+# Jobs with the same site_key (the USGS{site} folder) run one after another, so two sessions never
+# write the same site folder at the same time; other sites run in parallel. A job waiting for its
+# site does not hold a worker thread.
+#
+#   queue = JobQueue("nuhg_jobs.sqlite")
+#   job_id = queue.submit(session, 'download', download_task, site_no, ..., site_key=USGS_data)
+#   queue.job(job_id)['progress'], queue.partials(job_id), queue.claim(job_id)
+
+JOBS_FILE = "nuhg_jobs.sqlite"
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+DEFAULT_JOB_WORKERS = 4
+# Unclaimed results (e.g. of a closed browser tab) are dropped this long after their job finished
+RESULT_SECONDS = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    session TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    label TEXT,
+    site_key TEXT,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    claimed INTEGER NOT NULL DEFAULT 0,
+    instance TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_session ON jobs (session, created);
+CREATE TABLE IF NOT EXISTS job_messages (
+    job_id TEXT NOT NULL,
+    posted REAL NOT NULL,
+    level TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_messages_by_job ON job_messages (job_id, posted);
+"""
+
+
+# What a running task sees of its job
+class Job:
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.id = job_id
+
+    def notify(self, level, message):
+        self.queue._post(self.id, level, message)
+
+    def progress(self, done, total=1, text=None):
+        fraction = min(max(done / total, 0.0), 1.0) if total else 1.0
+        if text is None:
+            self.queue._update(self.id, progress=fraction)
+        else:
+            self.queue._update(self.id, progress=fraction, message=text)
+
+    def partial(self, name, value):
+        self.queue._set_partial(self.id, name, value)
+
+
+# The same interface for running a task in the calling thread (the app with background jobs
+# switched off): messages go to notify, progress and partial results are dropped
+class InlineJob:
+    def __init__(self, notify=None):
+        self.id = None
+        self._notify = notify
+
+    def notify(self, level, message):
+        notify_message(self._notify, level, message)
+
+    def progress(self, done, total=1, text=None):
+        pass
+
+    def partial(self, name, value):
+        pass
+
+
+class JobQueue:
+    def __init__(self, db_path=JOBS_FILE, max_workers=DEFAULT_JOB_WORKERS):
+        self.db_path = db_path
+        self.instance = uuid.uuid4().hex
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nuhg-job")
+        self._lock = threading.Lock()
+        self._finished = {}
+        self._results = {}
+        self._partials = {}
+        # Jobs waiting for the running job of their site, per site_key
+        self._site_queues = {}
+
+        folder = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(folder, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            # Jobs of an earlier server process cannot finish any more
+            db.execute("UPDATE jobs SET status = 'failed', error = 'The app was restarted before the job finished.', "
+                       "finished = ? WHERE status IN ('queued', 'running') AND instance != ?",
+                       (time.time(), self.instance))
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    # Set columns of a job, only if it still has one of the given statuses; True if it was changed
+    def _update(self, job_id, statuses=None, **columns):
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        query, params = f"UPDATE jobs SET {assignments} WHERE id = ?", [*columns.values(), job_id]
+        if statuses is not None:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            params.extend(statuses)
+        with closing(self._connect()) as db, db:
+            return db.execute(query, params).rowcount > 0
+
+    def _post(self, job_id, level, message):
+        with closing(self._connect()) as db, db:
+            db.execute("INSERT INTO job_messages (job_id, posted, level, message) VALUES (?, ?, ?, ?)",
+                       (job_id, time.time(), level, str(message)))
+
+    def _set_partial(self, job_id, name, value):
+        with self._lock:
+            self._partials.setdefault(job_id, {})[name] = value
+
+    # Queue func(job, *args, **kwargs) for a session. Returns the job id.
+    def submit(self, session, kind, func, *args, label=None, site_key=None, **kwargs):
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as db, db:
+            db.execute("INSERT INTO jobs (id, session, kind, label, site_key, status, created, instance) "
+                       "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                       (job_id, session, kind, label or kind, site_key, time.time(), self.instance))
+        self._prune()
+        done = threading.Event()
+
+        # Stages timed in the job go to the timing report of the session that submitted it
+        def run(report=current_report()):
+            try:
+                # A job cancelled while it was queued is skipped
+                if self._update(job_id, statuses=('queued',), status='running', started=time.time(), message=None):
+                    with use_report(report):
+                        result = func(Job(self, job_id), *args, **kwargs)
+                    with self._lock:
+                        self._results[job_id] = result
+                    self._update(job_id, status='done', progress=1.0, finished=time.time())
+            except Exception as e:
+                self._update(job_id, status='failed', error=f"{type(e).__name__}: {e}", finished=time.time())
+            finally:
+                # The job's log lines are written out now, not at some later rerun
+                flush_logs()
+                done.set()
+                if site_key is not None:
+                    self._start_next(site_key)
+
+        waiting = False
+        with self._lock:
+            self._finished[job_id] = done
+            if site_key is None:
+                self._executor.submit(run)
+            elif site_key in self._site_queues:
+                # Another job of this site is running; this one starts when it is done
+                self._site_queues[site_key].append(run)
+                waiting = True
+            else:
+                self._site_queues[site_key] = deque()
+                self._executor.submit(run)
+        if waiting:
+            self._update(job_id, statuses=('queued',), message="Waiting for another job on this site")
+        return job_id
+
+    def _start_next(self, site_key):
+        with self._lock:
+            if self._site_queues[site_key]:
+                self._executor.submit(self._site_queues[site_key].popleft())
+            else:
+                del self._site_queues[site_key]
+
+    def job(self, job_id):
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    # Jobs of a session (or of every session), newest first
+    def jobs(self, session=None, active_only=False):
+        query, params = "SELECT * FROM jobs", []
+        conditions = []
+        if session is not None:
+            conditions.append("session = ?")
+            params.append(session)
+        if active_only:
+            conditions.append("status IN ('queued', 'running')")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with closing(self._connect()) as db:
+            return [dict(row) for row in db.execute(query + " ORDER BY created DESC", params)]
+
+    # (posted, level, message) of a job's messages, oldest first
+    def messages(self, job_id):
+        with closing(self._connect()) as db:
+            return [tuple(row) for row in db.execute("SELECT posted, level, message FROM job_messages "
+                                                      "WHERE job_id = ? ORDER BY posted, rowid", (job_id,))]
+
+    def partials(self, job_id):
+        with self._lock:
+            return dict(self._partials.get(job_id, {}))
+
+    # Finished jobs of a session whose results have not been claimed yet, oldest first
+    def unclaimed(self, session):
+        with closing(self._connect()) as db:
+            statuses = ", ".join("?" * len(FINISHED_STATUSES))
+            return [dict(row) for row in db.execute(
+                f"SELECT * FROM jobs WHERE session = ? AND claimed = 0 AND status IN ({statuses}) ORDER BY created",
+                (session, *FINISHED_STATUSES))]
+
+    # The result of a finished job (None for a failed or cancelled one), handed over once
+    def claim(self, job_id):
+        self._update(job_id, claimed=1)
+        with self._lock:
+            self._partials.pop(job_id, None)
+            self._finished.pop(job_id, None)
+            return self._results.pop(job_id, None)
+
+    # Cancel a job that has not started yet; running jobs are left to finish
+    def cancel(self, job_id):
+        return self._update(job_id, statuses=('queued',), status='cancelled', finished=time.time())
+
+    # Block until a job has finished and return its row
+    def wait(self, job_id, timeout=None):
+        with self._lock:
+            finished = self._finished.get(job_id)
+        if finished is not None and not finished.wait(timeout):
+            raise TimeoutError(f"Job {job_id} did not finish within {timeout} s.")
+        return self.job(job_id)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    # Drop results nobody claimed within RESULT_SECONDS; their jobs are marked claimed
+    def _prune(self):
+        cutoff = time.time() - RESULT_SECONDS
+        with closing(self._connect()) as db, db:
+            stale = [row[0] for row in db.execute("SELECT id FROM jobs WHERE finished < ? AND claimed = 0 "
+                                                  "AND instance = ?", (cutoff, self.instance))]
+            db.executemany("UPDATE jobs SET claimed = 1 WHERE id = ?", [(job_id,) for job_id in stale])
+        with self._lock:
+            for job_id in stale:
+                self._results.pop(job_id, None)
+                self._partials.pop(job_id, None)
+                self._finished.pop(job_id, None)
+
+
+# Jobs the app submits. Each returns what the session keeps.
+
+# GetFlow for the download form; returns (discharge_filtered, USGS_data, discharge_key,
+# discharge_written): the key identifies the downloaded data for the memoized peak detection and
+# discharge_written is the future of the discharge file being written in the background. Without
+# a fetcher, parallel_requests > 1 downloads with an AsyncNWISFetcher. Figures go to `figures`, the
+# rendering.Figures of the session that submitted the job.
+def download_task(job, site_no, begin_date, end_date, output_folder, months, storage='csv', parallel_requests=1,
+                  fetcher=None, figures=None):
+    from .data_io import GetFlow, discharge_signature
+    from .async_fetcher import AsyncNWISFetcher
+
+    # Downloads are cached per site and year so overlapping ranges are only fetched once
+    cache_dir = os.path.join(output_folder, "nwis_cache")
+    own_fetcher = None
+    if fetcher is None and parallel_requests > 1:
+        # Its connection pool is closed when the download is over
+        fetcher = own_fetcher = AsyncNWISFetcher(max_concurrency=parallel_requests,
+                                                 partial_dir=os.path.join(cache_dir, "partial"))
+    try:
+        discharge_filtered, USGS_data, discharge_written = GetFlow(
+            site_no, begin_date, end_date, output_folder, months, fetcher=fetcher, cache_dir=cache_dir,
+            background=True, storage=storage, notify=job.notify, figures=figures,
+            progress=lambda done, total: job.progress(done, total, f"Downloaded {done} of {total} date slices"))
+    finally:
+        if own_fetcher is not None:
+            own_fetcher.close()
+    discharge_key = (site_no, str(begin_date), str(end_date), tuple(months), discharge_signature(discharge_filtered))
+    return discharge_filtered, USGS_data, discharge_key, discharge_written
+
+
+# DetectAndSavePeaks in its two steps, so the peaks are shown before the figures are drawn;
+# returns the filtered peaks
+def detect_peaks_task(job, discharge_filtered, prominence_value, USGS_data, site_no, min_peak_gap_hours,
+                      by_year=False, figures=None):
+    from .peak_detection import find_filtered_peaks, save_filtered_peaks
+
+    job.progress(0, 2, "Detecting peaks")
+    all_peaks_df, filtered_df = find_filtered_peaks(discharge_filtered, prominence_value, min_peak_gap_hours, by_year)
+    job.partial('peaks', filtered_df)
+    job.progress(1, 2, f"Saving {len(filtered_df)} peaks and their figures")
+    return save_filtered_peaks(discharge_filtered, all_peaks_df, filtered_df, prominence_value, USGS_data, site_no,
+                               min_peak_gap_hours, figures)
+
+
+# process_smoothed_files, then the overall DUH and its bootstrap bands saved next to the events;
+# returns (overall_duh_df, interpolated DUHs, bands), with an empty overall DUH when there was
+# nothing to combine
+def overall_duh_task(job, event_files_directory, storage='csv'):
+    from .smoothing import process_smoothed_files
+    from .duh_stack import DEFAULT_PERCENTILES
+    from .duh_bootstrap import bootstrap_duh_bands
+    from .site_store import save_overall_duh, save_duh_bands
+
+    job.progress(0, 3, "Interpolating the event DUHs")
+    overall_duh_df, matrix = process_smoothed_files(event_files_directory, percentiles=DEFAULT_PERCENTILES,
+                                                    storage=storage, notify=job.notify, with_matrix=True)
+    if overall_duh_df.empty:
+        return overall_duh_df, matrix, None
+    job.partial('overall_duh', overall_duh_df)
+
+    job.progress(1, 3, "Saving the overall DUH")
+    saved_as = save_overall_duh(event_files_directory, overall_duh_df, storage)
+    log_progress(event_files_directory, f"Saved overall normalized hydrograph to {saved_as}")
+
+    # 5-95% bands of the overall DUH from bootstrap resampling of the events
+    job.progress(2, 3, "Bootstrapping the confidence bands")
+    bands = bootstrap_duh_bands(matrix, overall_duh_df['Normalized Time'].to_numpy())
+    saved_as = save_duh_bands(event_files_directory, bands, storage)
+    log_progress(event_files_directory, f"Saved bootstrap bands of the overall DUH to {saved_as}")
+    log_progress(event_files_directory, "Normalized Hydrographs processed successfully.")
+    return overall_duh_df, matrix, bands
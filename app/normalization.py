@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+# DUH normalization of many events at once. Events are ragged: `offsets` (length events + 1) marks
+# where each event starts in flat arrays of sample times and smoothed discharges, so event e is
+# times[offsets[e]:offsets[e + 1]]. Everything below works on the flat arrays in NumPy, without a
+# per-event loop:
+#
+#   normalize_events    baseflow separation, time to peak, normalized discharge and normalized time
+#   akima_on_grid       the events' Akima interpolations (as in duh_stack.interpolate_event) evaluated
+#                       on a common grid, one row per event
+#   events_on_grid      both, from smoothed events straight to the (events x grid) DUH matrix
+#
+# Baseflow separation (the flow under the line is removed before normalizing):
+#   'first'           the first sample's flow, held constant (the original method)
+#   'linear'          a straight line from the first sample to the last sample of the event
+#   'constant_slope'  a line rising from the first sample at baseflow_slope cfs per hour
+BASEFLOW_METHODS = ('first', 'linear', 'constant_slope')
+
+
+# Offsets of consecutive events with the given lengths
+def ragged_offsets(lengths):
+    return np.r_[0, np.cumsum(lengths)].astype(np.int64)
+
+
+# Event number of every sample
+def _event_ids(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+# Baseflow under every sample for the given separation method
+def baseflow(offsets, minutes, discharge, method='first', baseflow_slope=None):
+    event_ids = _event_ids(offsets)
+    firsts, lasts = offsets[:-1], offsets[1:] - 1
+    start_flow = discharge[firsts][event_ids]
+
+    if method == 'first':
+        return start_flow
+    if method == 'linear':
+        duration = minutes[lasts][event_ids]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rise = np.where(duration > 0, (discharge[lasts][event_ids] - start_flow) / duration, 0.0)
+        return start_flow + rise * minutes
+    if method == 'constant_slope':
+        if baseflow_slope is None:
+            raise ValueError("Constant-slope baseflow separation needs baseflow_slope (cfs per hour).")
+        return start_flow + baseflow_slope * minutes / 60
+    raise ValueError(f"Unknown baseflow method {method!r}; expected one of {', '.join(BASEFLOW_METHODS)}.")
+
+
+# DUH of every (non-empty) event. times are datetime64 values or int64 nanoseconds, discharge the
+# smoothed flow.
+# Returns flat normalized discharge and normalized time arrays (same layout as the input) and one
+# row of statistics per event. Events whose storm flow never rises above the baseflow, or that peak
+# on their first sample, get NaN/inf values and Has DUH = False.
+def normalize_events(offsets, times, discharge, method='first', baseflow_slope=None):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    times = np.asarray(times)
+    times = times.astype('datetime64[ns]').view('int64') if times.dtype.kind == 'M' else times.astype(np.int64)
+    discharge = np.asarray(discharge, dtype=np.float64)
+    event_ids = _event_ids(offsets)
+    firsts = offsets[:-1]
+
+    minutes = (times - times[firsts][event_ids]) / 60e9
+    base = baseflow(offsets, minutes, discharge, method, baseflow_slope)
+    storm = np.maximum(discharge - base, 0)
+
+    # Peak: the first sample holding the event's largest storm flow (NaN samples sort last)
+    peak_flow = np.fmax.reduceat(storm, firsts) if len(firsts) else np.empty(0)
+    sort = np.lexsort((-storm, event_ids))
+    time_to_peak = minutes[sort[firsts]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized_discharge = storm / peak_flow[event_ids]
+        normalized_time = minutes / time_to_peak[event_ids]
+
+    stats = pd.DataFrame({'Points': np.diff(offsets), 'Base Flow': base[firsts], 'Peak Storm Flow': peak_flow,
+                          'Time to Peak (hours)': time_to_peak / 60,
+                          'Has DUH': (peak_flow > 0) & (time_to_peak > 0)})
+    return normalized_discharge, normalized_time, stats
+
+
+# Akima interpolation of every event evaluated on common_time_axis (ascending), matching
+# scipy's Akima1DInterpolator(time, discharge)(common_time_axis, extrapolate=False) event by event:
+# NaN samples are dropped, samples are put in time order and repeated times keep their first
+# sample. Returns an (events x grid) float32 matrix, NaN outside each event's time span, and a
+# mask of the events that had at least two distinct samples (the other rows are all NaN).
+def akima_on_grid(offsets, normalized_time, normalized_discharge, common_time_axis):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_events = len(offsets) - 1
+    grid = np.asarray(common_time_axis, dtype=np.float64)
+    matrix = np.full((n_events, len(grid)), np.nan, dtype=np.float32)
+
+    x = np.asarray(normalized_time, dtype=np.float64)
+    y = np.asarray(normalized_discharge, dtype=np.float64)
+    event_ids = _event_ids(offsets)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y, event_ids = x[valid], y[valid], event_ids[valid]
+    if not np.all((np.diff(x) >= 0) | (np.diff(event_ids) != 0)):
+        order = np.lexsort((x, event_ids))
+        x, y, event_ids = x[order], y[order], event_ids[order]
+    unique = np.r_[True, (np.diff(x) > 0) | (np.diff(event_ids) != 0)][:len(x)]
+    x, y, event_ids = x[unique], y[unique], event_ids[unique]
+
+    counts = np.bincount(event_ids, minlength=n_events)
+    usable = counts >= 2
+    keep = usable[event_ids]
+    x, y, event_ids = x[keep], y[keep], event_ids[keep]
+    if not len(x):
+        return matrix, usable
+
+    counts = counts[usable]
+    events = np.flatnonzero(usable)
+    starts = ragged_offsets(counts)[:-1]
+    local_ids = np.repeat(np.arange(len(events)), counts)
+    point_in_event = np.arange(len(x)) - starts[local_ids]
+
+    # Interval slopes, padded with two extrapolated slopes on each side of every event:
+    # padded[pads[e] + 2 + k] is the slope of interval k of event e
+    pads = ragged_offsets(counts + 3)[:-1]
+    interval = np.flatnonzero(np.diff(local_ids) == 0)
+    slopes = np.diff(y)[interval] / np.diff(x)[interval]
+    padded = np.zeros(int((counts + 3).sum()))
+    padded[pads[local_ids[interval]] + 2 + point_in_event[interval]] = slopes
+    last = pads + counts + 2
+    padded[pads + 1] = 2 * padded[pads + 2] - padded[pads + 3]
+    padded[pads] = 2 * padded[pads + 1] - padded[pads + 2]
+    padded[last - 1] = 2 * padded[last - 2] - padded[last - 3]
+    padded[last] = 2 * padded[last - 1] - padded[last - 2]
+
+    # Akima slope at every sample from the four surrounding interval slopes
+    base = pads[local_ids] + point_in_event
+    m0, m1, m2, m3 = padded[base], padded[base + 1], padded[base + 2], padded[base + 3]
+    f1, f2 = np.abs(m3 - m2), np.abs(m1 - m0)
+    f12 = f1 + f2
+    largest = np.maximum.reduceat(f12, starts)[local_ids]
+    defined = f12 > 1e-9 * largest
+    tangents = 0.5 * (m3 + m0)
+    tangents[defined] = m1[defined] + f2[defined] / f12[defined] * (m2[defined] - m1[defined])
+    # Two samples: a straight line
+    two_points = (counts == 2)[local_ids]
+    tangents[two_points] = padded[pads[local_ids[two_points]] + 2]
+
+    # Grid points covered by every interval: those from its first sample up to (not including) the
+    # next sample, and for an event's last interval also a grid point lying exactly on the last sample
+    before = np.searchsorted(grid, x, side='left')
+    lasts = starts + counts - 1
+    covered = np.r_[np.diff(before), 0]
+    covered[lasts] = 0
+    covered[lasts - 1] = np.searchsorted(grid, x[lasts], side='right') - before[lasts - 1]
+    left = np.repeat(np.arange(len(x)), covered)
+    per_event = np.add.reduceat(covered, starts)
+    query_positions = np.arange(len(left)) - np.repeat(ragged_offsets(per_event)[:-1] - before[starts], per_event)
+    query_events = np.repeat(np.arange(len(events)), per_event)
+
+    # Cubic Hermite segment of every interval, with the coefficients of scipy's CubicHermiteSpline
+    # (the entry of an event's last sample is unused)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        width = np.r_[np.diff(x), 1.0]
+        slope = np.r_[np.diff(y), 0.0] / width
+        t = (tangents + np.r_[tangents[1:], 0.0] - 2 * slope) / width
+        c0 = t / width
+        c1 = (slope - tangents) / width - t
+
+    d = grid[query_positions] - x[left]
+    values = ((c0[left] * d + c1[left]) * d + tangents[left]) * d + y[left]
+    matrix.reshape(-1)[events[query_events] * len(grid) + query_positions] = values
+    return matrix, usable
+
+
+# Smoothed events straight to DUH rows on the common grid. Returns the (events x grid) float32
+# matrix, NaN outside each event's span and for events without a DUH, and the per-event statistics
+# of normalize_events with an 'On Grid' column.
+def events_on_grid(offsets, times, discharge, common_time_axis, method='first', baseflow_slope=None):
+    normalized_discharge, normalized_time, stats = normalize_events(offsets, times, discharge, method, baseflow_slope)
+    has_duh = stats['Has DUH'].to_numpy()
+    keep = has_duh[_event_ids(np.asarray(offsets, dtype=np.int64))]
+    matrix = np.full((len(stats), len(common_time_axis)), np.nan, dtype=np.float32)
+    rows, on_grid = akima_on_grid(ragged_offsets(stats['Points'].to_numpy()[has_duh]), normalized_time[keep],
+                                  normalized_discharge[keep], common_time_axis)
+    matrix[np.flatnonzero(has_duh)] = rows
+    stats['On Grid'] = False
+    stats.loc[has_duh, 'On Grid'] = on_grid
+    return matrix, stats
@@ -1,16 +1,16 @@
 import os
+import numpy as np
 import pandas as pd
-from scipy.signal import find_peaks
-import matplotlib.pyplot as plt
-from matplotlib.dates import DateFormatter
-import streamlit as st
-from .helpers import log_progress
+from scipy.signal import find_peaks, peak_prominences
+from .helpers import log_progress, notify_message
+from .instrumentation import timed
 from datetime import timedelta
 from .plotting import plot_discharge_hydrograph_with_filtered_peaks
+from .rendering import submit_figure, line_figure_spec
 
 
 
-def plot_hydrographs_with_peaks(data, prominence_value, USGS_data, site_no):
+def plot_hydrographs_with_peaks(data, prominence_value, USGS_data, site_no, figures=None):
     years = data.index.year.unique()
     first_legend_added = False
     peaks_info = []
@@ -19,23 +19,15 @@ def plot_hydrographs_with_peaks(data, prominence_value, USGS_data, site_no):
         yearly_data = data.loc[data.index.year == year].dropna(subset=['discharge_cfs'])
         peaks, _ = find_peaks(yearly_data['discharge_cfs'], prominence=prominence_value)
 
-        fig, ax = plt.subplots(figsize=(12, 6))
-        ax.plot(yearly_data.index, yearly_data['discharge_cfs'], label=f"Discharge {year}", color='blue')
-        ax.plot(yearly_data.index[peaks], yearly_data['discharge_cfs'].iloc[peaks], 'ro',
-                label='Peak' if not first_legend_added else "")
-
-        if not first_legend_added:
-            ax.legend(loc='best', edgecolor='k')
-            first_legend_added = True
-
-        ax.set_title(f"Discharge Hydrograph with Peaks for {year}")
-        ax.set_xlabel("Date")
-        ax.set_ylabel('Discharge (cfs)')
-        ax.xaxis.set_major_formatter(DateFormatter("%b %d"))
-        plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
-        plt.tight_layout()
-        plt.savefig(os.path.join(USGS_data, f"Discharge_{site_no}_Hydrograph_with_Peaks_{year}.png"))
-        plt.close(fig)
+        submit_figure(line_figure_spec(
+            os.path.join(USGS_data, f"Discharge_{site_no}_Hydrograph_with_Peaks_{year}.png"),
+            f"Discharge Hydrograph with Peaks for {year}",
+            [(yearly_data.index, yearly_data['discharge_cfs'], '-', dict(label=f"Discharge {year}", color='blue')),
+             (yearly_data.index[peaks], yearly_data['discharge_cfs'].iloc[peaks], 'ro',
+              dict(label='Peak' if not first_legend_added else ""))],
+            legend=dict(loc='best', edgecolor='k') if not first_legend_added else None,
+        ), log_folder=USGS_data, figures=figures)
+        first_legend_added = True
 
         peak_dates = yearly_data.index[peaks]
         peaks_df = pd.DataFrame({
@@ -48,11 +40,9 @@ def plot_hydrographs_with_peaks(data, prominence_value, USGS_data, site_no):
 
     return peaks_info
 
-def DetectAndSavePeaks(discharge_filtered, prominence_value, USGS_data, site_no, min_peak_gap_hours):
-    log_progress(USGS_data, f"Starting peak detection for site {site_no} with prominence value {prominence_value}")
-    log_progress(USGS_data, f"Discharge stats — min: {discharge_filtered['discharge_cfs'].min()}, max: {discharge_filtered['discharge_cfs'].max()}, mean: {discharge_filtered['discharge_cfs'].mean()}")
-
-    # First detect peaks
+# Original detection: find_peaks separately for each calendar year. "Index" is the position within
+# that year, and storms crossing Dec 31 are split between two groups.
+def detect_peaks_by_year(discharge_filtered, prominence_value):
     peaks_info = []
     for year, group in discharge_filtered.groupby(discharge_filtered.index.year):
         peak_indices, _ = find_peaks(group['discharge_cfs'], prominence=prominence_value)
@@ -62,48 +52,123 @@ def DetectAndSavePeaks(discharge_filtered, prominence_value, USGS_data, site_no,
         year_peaks["Peak_Date"] = group.iloc[peak_indices].index  # ✅ This line fixes the error
         peaks_info.append(year_peaks)
 
+    return pd.concat(peaks_info)
+
+
+# Single find_peaks pass over the whole record. Missing values and time gaps longer than
+# max_gap_hours (e.g. months excluded by the month filter) split the record into segments by
+# placing a +inf wall between them: a wall is higher than any peak, so prominences are computed
+# within each segment exactly as if it were detected on its own. "Index" is the position in the
+# full record.
+def detect_peaks_whole_record(discharge_filtered, prominence_value, max_gap_hours=2):
+    signal, gap_positions = walled_signal(discharge_filtered, max_gap_hours)
+
+    # Prominences are only computed for real peaks: a wall has nothing higher on either side, so
+    # computing its prominence would scan the whole record (quadratic in the number of walls)
+    peak_positions = local_maxima(signal)
+    peak_positions = peak_positions[peak_prominences(signal, peak_positions)[0] >= prominence_value]
+    return peaks_frame(discharge_filtered, record_positions(peak_positions, gap_positions))
+
+
+# The discharge as floats with a +inf wall inserted before every gap and in place of missing values.
+# Returns the signal and the record positions the walls were inserted at.
+def walled_signal(discharge_filtered, max_gap_hours=2):
+    values = discharge_filtered['discharge_cfs'].to_numpy(dtype=float)
+    times = discharge_filtered.index.to_numpy(dtype='datetime64[ns]').view('int64')
+
+    gap_positions = np.flatnonzero(np.diff(times) > pd.Timedelta(hours=max_gap_hours).value) + 1
+    signal = np.insert(values, gap_positions, np.inf)
+    signal[np.isnan(signal)] = np.inf
+    return signal, gap_positions
+
+
+# Positions of the local maxima of a walled signal, walls excluded
+def local_maxima(signal):
+    peak_positions, _ = find_peaks(signal)
+    return peak_positions[np.isfinite(signal[peak_positions])]
+
+
+# Map positions in the walled signal back to positions in the record
+def record_positions(peak_positions, gap_positions):
+    return peak_positions - np.searchsorted(gap_positions + np.arange(len(gap_positions)), peak_positions,
+                                            side='right')
+
+
+# Peak rows of the record at the given positions, with the Index, Year and Peak_Date columns
+def peaks_frame(discharge_filtered, peak_indices):
+    all_peaks_df = discharge_filtered.iloc[peak_indices].copy()
+    all_peaks_df["Index"] = peak_indices
+    all_peaks_df["Year"] = all_peaks_df.index.year
+    all_peaks_df["Peak_Date"] = all_peaks_df.index
+    return all_peaks_df
+
+
+# Sequential peak filter over int64 timestamps (ns) and discharges. A peak is kept when it is at
+# least min_gap_ns after the last kept peak and its discharge differs from that peak by more than
+# `similarity` (relative). Returns the positions of the kept peaks.
+def filter_similar_peaks(times_ns, values, min_gap_ns, similarity=0.01):
+    times = np.asarray(times_ns, dtype=np.int64).tolist()
+    discharges = np.asarray(values, dtype=float).tolist()
+    if not times:
+        return np.empty(0, dtype=np.int64)
+
+    # Plain Python scalars in a tight loop; each step only depends on the last kept peak
+    kept = [0]
+    last_time = times[0]
+    last_value = discharges[0]
+    for position in range(1, len(times)):
+        current_value = discharges[position]
+        if (times[position] - last_time >= min_gap_ns
+                and abs(current_value - last_value) / max(last_value, 1e-6) > similarity):
+            kept.append(position)
+            last_time = times[position]
+            last_value = current_value
+
+    return np.asarray(kept, dtype=np.int64)
+
+
+# Peak detection and the time + discharge similarity filter, without any file output.
+# Returns every detected peak and the filtered peaks.
+@timed('peak detection', rows_arg='discharge_filtered')
+def find_filtered_peaks(discharge_filtered, prominence_value, min_peak_gap_hours, by_year=False, max_gap_hours=2):
+    # First detect peaks
+    if by_year:
+        all_peaks_df = detect_peaks_by_year(discharge_filtered, prominence_value)
+    else:
+        all_peaks_df = detect_peaks_whole_record(discharge_filtered, prominence_value, max_gap_hours)
 
-    all_peaks_df = pd.concat(peaks_info)
+    return filter_peaks(all_peaks_df, min_peak_gap_hours)
 
 
-    # Log how many raw peaks were found
-    log_progress(USGS_data, f"Initial peak detection found {len(all_peaks_df)} peaks for site {site_no}")
-
+# Sort detected peaks by time and apply the time + discharge similarity filter.
+# Returns the sorted peaks and the filtered peaks.
+def filter_peaks(all_peaks_df, min_peak_gap_hours):
     # Convert Peak_Date to datetime (if not already)
     all_peaks_df['Peak_Date'] = pd.to_datetime(all_peaks_df['Peak_Date'])
 
     # Sort peaks by time
     all_peaks_df = all_peaks_df.sort_values(by='Peak_Date').reset_index(drop=True)
 
-       
-    # Initialize filtered list
-    filtered_peaks = []
-    last_kept_time = None
-    last_kept_value = None
-
-
-    # Loop through peaks and apply time + discharge similarity filter
-    for _, row in all_peaks_df.iterrows():
-        current_time = row['Peak_Date']
-        current_value = row['discharge_cfs']  # ✅ Correct column name
+    # Apply the time + discharge similarity filter on plain arrays
+    keep = filter_similar_peaks(all_peaks_df['Peak_Date'].to_numpy(dtype='datetime64[ns]').view('int64'),
+                                all_peaks_df['discharge_cfs'].to_numpy(dtype=float),
+                                pd.Timedelta(timedelta(hours=min_peak_gap_hours)).value)
+    filtered_df = all_peaks_df.iloc[keep]
 
+    return all_peaks_df, filtered_df
 
-        if last_kept_time is None:
-            filtered_peaks.append(row)
-            last_kept_time = current_time
-            last_kept_value = current_value
-            continue
 
-        time_diff = current_time - last_kept_time
-        value_diff = abs(current_value - last_kept_value) / max(last_kept_value, 1e-6)
+# Log, save and plot the result of find_filtered_peaks; the figure goes to `figures`
+# (a rendering.Figures, the process default when None)
+@timed('save peaks', rows_arg='filtered_df')
+def save_filtered_peaks(discharge_filtered, all_peaks_df, filtered_df, prominence_value, USGS_data, site_no,
+                        min_peak_gap_hours, figures=None):
+    log_progress(USGS_data, f"Starting peak detection for site {site_no} with prominence value {prominence_value}")
+    log_progress(USGS_data, f"Discharge stats — min: {discharge_filtered['discharge_cfs'].min()}, max: {discharge_filtered['discharge_cfs'].max()}, mean: {discharge_filtered['discharge_cfs'].mean()}")
 
-        if time_diff >= timedelta(hours=min_peak_gap_hours) and value_diff > 0.01:
-            filtered_peaks.append(row)
-            last_kept_time = current_time
-            last_kept_value = current_value
+    # Log how many raw peaks were found
+    log_progress(USGS_data, f"Initial peak detection found {len(all_peaks_df)} peaks for site {site_no}")
 
-    # Convert list back to DataFrame
-    filtered_df = pd.DataFrame(filtered_peaks)
     filtered_csv_path = os.path.join(USGS_data, f"Peaks_{site_no}_All_Years.csv")
 
     # Save the filtered peaks to CSV
@@ -114,7 +179,7 @@ def DetectAndSavePeaks(discharge_filtered, prominence_value, USGS_data, site_no,
         log_progress(USGS_data, f"No peaks to save for site {site_no}. Skipping CSV export.")
 
     # Plot the hydrograph with filtered peaks
-    plot_discharge_hydrograph_with_filtered_peaks(discharge_filtered, filtered_df, site_no, USGS_data)
+    plot_discharge_hydrograph_with_filtered_peaks(discharge_filtered, filtered_df, site_no, USGS_data, figures)
 
     # Log results
     removed_count = len(all_peaks_df) - len(filtered_df)
@@ -123,22 +188,34 @@ def DetectAndSavePeaks(discharge_filtered, prominence_value, USGS_data, site_no,
 
     return filtered_df
 
-def update_peaks_data(peaks_file, indices_to_keep):
+
+def DetectAndSavePeaks(discharge_filtered, prominence_value, USGS_data, site_no, min_peak_gap_hours,
+                       by_year=False, max_gap_hours=2, figures=None):
+    all_peaks_df, filtered_df = find_filtered_peaks(discharge_filtered, prominence_value, min_peak_gap_hours,
+                                                    by_year, max_gap_hours)
+    return save_filtered_peaks(discharge_filtered, all_peaks_df, filtered_df, prominence_value, USGS_data, site_no,
+                               min_peak_gap_hours, figures)
+
+# Keep only the peaks whose Index is listed in indices_to_keep ("500, 705, 2706"). Returns the
+# updated peaks, or None when the input or the file could not be used.
+def update_peaks_data(peaks_file, indices_to_keep, notify=None):
     try:
-        st.write("Updating Peaks Data...")
+        notify_message(notify, 'info', "Updating Peaks Data...")
         selected_indices = [int(idx.strip()) for idx in indices_to_keep.split(',')]
         peaks_df = pd.read_csv(peaks_file)
         updated_df = peaks_df[peaks_df['Index'].isin(selected_indices)]
         updated_df.to_csv(peaks_file, index=False)
-        st.success("Peaks data updated successfully. Check the updated file.")
-        st.write("Updated file saved to:", peaks_file)
+        notify_message(notify, 'success', "Peaks data updated successfully. Check the updated file.")
+        notify_message(notify, 'info', f"Updated file saved to: {peaks_file}")
 
         # Log the number of peaks kept
         log_progress(os.path.dirname(peaks_file), f"Updated peaks file with {len(updated_df)} peaks based on user input.")
+        return updated_df
 
     except ValueError as e:
-        st.error(f"Invalid input for indices. Please enter comma-separated integers: {e}")
+        notify_message(notify, 'error', f"Invalid input for indices. Please enter comma-separated integers: {e}")
     except Exception as e:
-        st.error(f"An error occurred while updating the file: {e}")
+        notify_message(notify, 'error', f"An error occurred while updating the file: {e}")
+    return None
 
 
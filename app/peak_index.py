@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import peak_prominences
+from .instrumentation import timed
+from .peak_detection import walled_signal, local_maxima, record_positions, peaks_frame, filter_peaks
+
+# Prominence index for trying many prominence values on one record. Every local maximum of the
+# record and its prominence are computed once (the same walls and prominences as
+# detect_peaks_whole_record) and kept sorted by prominence, so the peaks at or above a prominence
+# are a prefix of the index: finding them is one binary search, and only those k peaks are then
+# put in time order and passed through the time + discharge similarity filter.
+#
+#   index = PeakIndex(discharge_filtered)
+#   all_peaks_df, filtered_df = index.query(prominence_value, min_peak_gap_hours)
+#
+# query() gives the same peaks as find_filtered_peaks(..., by_year=False).
+
+
+class PeakIndex:
+    @timed('prominence index', rows_arg='discharge_filtered')
+    def __init__(self, discharge_filtered, max_gap_hours=2):
+        self.discharge_filtered = discharge_filtered
+        self.max_gap_hours = max_gap_hours
+
+        signal, gap_positions = walled_signal(discharge_filtered, max_gap_hours)
+        peak_positions = local_maxima(signal)
+        prominences = peak_prominences(signal, peak_positions)[0]
+
+        # Highest prominence first; ties stay in time order
+        order = np.argsort(-prominences, kind='stable')
+        self.prominences = prominences[order]
+        self.positions = record_positions(peak_positions, gap_positions)[order]
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Number of local maxima with prominence >= prominence_value
+    def peak_count(self, prominence_value):
+        return int(np.searchsorted(-self.prominences, -prominence_value, side='right'))
+
+    # Record positions (in time order) of the peaks with prominence >= prominence_value
+    def peak_positions(self, prominence_value):
+        return np.sort(self.positions[:self.peak_count(prominence_value)])
+
+    # Every peak with prominence >= prominence_value and the peaks left by the similarity filter,
+    # laid out like find_filtered_peaks
+    @timed('peak detection')
+    def query(self, prominence_value, min_peak_gap_hours):
+        return filter_peaks(peaks_frame(self.discharge_filtered, self.peak_positions(prominence_value)),
+                            min_peak_gap_hours)
+
+    # Peak count against prominence, at n_points prominences spaced evenly on a log scale between
+    # the smallest and the largest prominence in the index
+    def count_curve(self, n_points=200):
+        positive = self.prominences[self.prominences > 0]
+        if not len(positive):
+            return pd.DataFrame({'Prominence': pd.Series(dtype=float), 'Peaks': pd.Series(dtype=np.int64)})
+        prominence_values = np.unique(np.geomspace(positive[-1], positive[0], n_points))
+        counts = np.searchsorted(-self.prominences, -prominence_values, side='right')
+        return pd.DataFrame({'Prominence': prominence_values, 'Peaks': counts.astype(np.int64)})
@@ -0,0 +1,243 @@
+# Regional grouping of sites by the shape of their overall DUH:
+#   python -m app.regional OUTPUT_FOLDER [--clusters 6] [--method kmeans|hierarchical]
+#
+# Every USGS{site} folder under OUTPUT_FOLDER with an overall DUH (overall_duh.csv, or the site
+# store) becomes one row of a site-by-feature array. The features are computed for all sites at
+# once on a shared grid, and clustering and nearest-neighbour queries work on the standardized
+# features: features and k-means of 10,000 sites take about 1.2 s once the files are read.
+
+import os
+import re
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.cluster.vq import kmeans2
+from scipy.spatial import cKDTree
+
+from .instrumentation import timed
+from .site_store import SiteStore
+from .time_grid import TimeGrid
+
+# Shape features of an overall DUH, in units of the time to peak (the peak level is the curve's maximum):
+#   Peak Time           time of the maximum
+#   Peak Discharge      the maximum of the mean DUH
+#   Rise Time           from the first time above 10% of the peak to the peak
+#   Recession Time      from the peak to the last time above 10% of the peak
+#   W50, W75            time spent above 50% and 75% of the peak (first up-crossing to last down-crossing)
+#   Skew                skewness of the DUH taken as a distribution over time
+FEATURES = ('Peak Time', 'Peak Discharge', 'Rise Time', 'Recession Time', 'W50', 'W75', 'Skew')
+CLUSTER_METHODS = ('kmeans', 'hierarchical')
+INDEX_FILE = "regional_duh_index.npz"
+CLUSTERS_FILE = "regional_clusters.csv"
+
+_SITE_FOLDER = re.compile(r"^USGS(\w+)$")
+
+
+# (site numbers, grids, mean DUHs) of every site folder under output_folder with an overall DUH
+def load_site_duhs(output_folder):
+    sites, grids, curves = [], [], []
+    for name in sorted(os.listdir(output_folder)):
+        match = _SITE_FOLDER.match(name)
+        folder = os.path.join(output_folder, name)
+        if not match or not os.path.isdir(folder):
+            continue
+        path = os.path.join(folder, "overall_duh.csv")
+        if os.path.exists(path):
+            duh = pd.read_csv(path, usecols=['Normalized Time', 'Normalized Discharge'])
+        else:
+            duh = SiteStore(folder).get_overall_duh()
+            if duh is None:
+                continue
+        sites.append(match.group(1))
+        grids.append(duh['Normalized Time'].to_numpy(dtype=np.float64))
+        curves.append(duh['Normalized Discharge'].to_numpy(dtype=np.float64))
+    return sites, grids, curves
+
+
+# One (sites x grid) matrix from per-site curves, NaN where a site has no value. When every grid is
+# a run of time_grid's nodes (TimeGrid() by default) the curves are copied in place; otherwise they
+# are all interpolated onto time_grid up to the longest site. Sites on another grid, such as the
+# 10,001-point np.arange(0, 10.001, 0.001) grid of older runs, are never stacked on it as they are:
+# a few thousand of them would take gigabytes in shape_features.
+def stack_site_curves(grids, curves, time_grid=None):
+    if not grids:
+        return np.empty(0), np.empty((0, 0))
+    time_grid = time_grid or TimeGrid()
+    longest = max(grids, key=len)
+    if time_grid.holds(longest) and all(np.array_equal(grid, longest[:len(grid)]) for grid in grids):
+        matrix = np.full((len(grids), len(longest)), np.nan)
+        for row, curve in enumerate(curves):
+            matrix[row, :len(curve)] = curve
+        return longest, matrix
+
+    common = time_grid.axis(max(grid[-1] for grid in grids if len(grid)))
+    matrix = np.full((len(grids), len(common)), np.nan)
+    for row, (grid, curve) in enumerate(zip(grids, curves)):
+        valid = ~np.isnan(curve)
+        if valid.sum() >= 2:
+            matrix[row] = np.interp(common, grid[valid], curve[valid], left=np.nan, right=np.nan)
+    return common, matrix
+
+
+# First time each curve reaches `levels` (one per curve) and last time it is still at or above it,
+# with linear interpolation between grid points. Curves that start or end above the level give the
+# first or last grid point.
+def _crossing_times(grid, curves, levels):
+    above = curves >= levels[:, None]
+    rows = np.arange(len(curves))
+    first = np.argmax(above, axis=1)
+    last = len(grid) - 1 - np.argmax(above[:, ::-1], axis=1)
+
+    before = np.maximum(first - 1, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = (levels - curves[rows, before]) / (curves[rows, first] - curves[rows, before])
+    up = np.where(first > 0, grid[before] + np.nan_to_num(fraction) * (grid[first] - grid[before]), grid[first])
+
+    after = np.minimum(last + 1, len(grid) - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = (curves[rows, last] - levels) / (curves[rows, last] - curves[rows, after])
+    down = np.where(after > last, grid[last] + np.nan_to_num(fraction) * (grid[after] - grid[last]), grid[last])
+    return up, down
+
+
+# Shape features (FEATURES) of every row of a (sites x grid) matrix of mean DUHs on `grid`, as a
+# (sites x features) float64 array; rows without a value are NaN
+@timed('DUH shape features', rows_arg='curves')
+def shape_features(grid, curves):
+    grid = np.asarray(grid, dtype=np.float64)
+    curves = np.asarray(curves, dtype=np.float64)
+    features = np.full((len(curves), len(FEATURES)), np.nan)
+    has_values = np.any(curves > 0, axis=1) if curves.size else np.zeros(len(curves), dtype=bool)
+    if not has_values.any() or len(grid) < 2:
+        return features
+    # Where a site has no value its DUH is taken as 0
+    curves = np.nan_to_num(curves[has_values])
+
+    peak = np.argmax(curves, axis=1)
+    peak_discharge = curves[np.arange(len(curves)), peak]
+    rise_start, recession_end = _crossing_times(grid, curves, 0.1 * peak_discharge)
+    up50, down50 = _crossing_times(grid, curves, 0.5 * peak_discharge)
+    up75, down75 = _crossing_times(grid, curves, 0.75 * peak_discharge)
+
+    # Trapezoid weights of the (possibly uneven) grid
+    weights = np.r_[np.diff(grid), 0] / 2 + np.r_[0, np.diff(grid)] / 2
+    mass = curves @ weights
+    mean = (curves @ (weights * grid)) / mass
+    centered = grid[None, :] - mean[:, None]
+    variance = np.sum(curves * weights * centered ** 2, axis=1) / mass
+    third = np.sum(curves * weights * centered ** 3, axis=1) / mass
+
+    features[has_values] = np.column_stack([
+        grid[peak], peak_discharge, grid[peak] - rise_start, recession_end - grid[peak],
+        down50 - up50, down75 - up75, third / variance ** 1.5])
+    return features
+
+
+# Site-by-feature index of overall DUH shapes, with clustering and nearest-neighbour queries on the
+# standardized features (each feature scaled to zero mean and unit spread across the sites)
+#
+#   index = DuhShapeIndex.from_output_folder(output_folder)
+#   labels = index.cluster(6)
+#   index.nearest('05125039', 5)
+class DuhShapeIndex:
+    def __init__(self, sites, features):
+        self.sites = np.asarray(sites, dtype=str)
+        self.features = np.asarray(features, dtype=np.float64)
+        usable = np.all(np.isfinite(self.features), axis=1)
+        self.sites, self.features = self.sites[usable], self.features[usable]
+        self.positions = {site_no: row for row, site_no in enumerate(self.sites.tolist())}
+
+        center = self.features.mean(axis=0) if len(self.features) else np.zeros(len(FEATURES))
+        spread = self.features.std(axis=0) if len(self.features) else np.ones(len(FEATURES))
+        self.standardized = (self.features - center) / np.where(spread > 0, spread, 1.0)
+        self._tree = None
+
+    def __len__(self):
+        return len(self.sites)
+
+    @classmethod
+    def from_curves(cls, sites, grids, curves):
+        grid, matrix = stack_site_curves(grids, curves)
+        return cls(sites, shape_features(grid, matrix))
+
+    @classmethod
+    def from_output_folder(cls, output_folder):
+        return cls.from_curves(*load_site_duhs(output_folder))
+
+    def to_frame(self):
+        frame = pd.DataFrame(self.features, columns=list(FEATURES))
+        frame.insert(0, 'site_no', self.sites)
+        return frame
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, sites=self.sites, features=self.features, feature_names=np.array(FEATURES))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            if tuple(saved['feature_names'].tolist()) != FEATURES:
+                raise ValueError(f"{path} was made with different shape features; build the index again.")
+            return cls(saved['sites'], saved['features'])
+
+    # Cluster label (0 .. n_clusters - 1) of every site. 'kmeans' is seeded k-means, 'hierarchical'
+    # Ward linkage cut into n_clusters groups (it holds all pairwise distances: about 200 MB for
+    # 7,000 sites, so use k-means for larger sets).
+    @timed('DUH clustering')
+    def cluster(self, n_clusters, method='kmeans', seed=0):
+        if method not in CLUSTER_METHODS:
+            raise ValueError(f"Unknown clustering method {method!r}; expected one of {', '.join(CLUSTER_METHODS)}.")
+        n_clusters = min(n_clusters, len(self))
+        if n_clusters < 2:
+            return np.zeros(len(self), dtype=np.int64)
+        if method == 'kmeans':
+            _, labels = kmeans2(self.standardized, n_clusters, minit='++', seed=seed)
+            return labels.astype(np.int64)
+        labels = fcluster(linkage(self.standardized, method='ward'), n_clusters, criterion='maxclust')
+        return labels.astype(np.int64) - 1
+
+    # The k sites with the most similar DUH shape to site_no (itself excluded), closest first
+    def nearest(self, site_no, k=5):
+        if site_no not in self.positions:
+            raise KeyError(f"Site {site_no} is not in the index.")
+        return self.nearest_to(self.standardized[self.positions[site_no]], k, exclude=self.positions[site_no])
+
+    # The k sites closest to a point of standardized features
+    def nearest_to(self, standardized_features, k=5, exclude=None):
+        if self._tree is None:
+            self._tree = cKDTree(self.standardized)
+        count = min(k + (exclude is not None), len(self))
+        distances, rows = self._tree.query(standardized_features, k=max(count, 1))
+        distances, rows = np.atleast_1d(distances)[:count], np.atleast_1d(rows)[:count]
+        keep = rows != exclude
+        return pd.DataFrame({'site_no': self.sites[rows[keep]][:k], 'Distance': distances[keep][:k]})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.regional",
+                                     description="Group USGS sites by the shape of their overall DUH.")
+    parser.add_argument("output_folder", help="Folder holding the USGS{site} folders (the batch output_folder)")
+    parser.add_argument("--clusters", type=int, default=6, help="Number of groups")
+    parser.add_argument("--method", choices=CLUSTER_METHODS, default='kmeans', help="Clustering method")
+    args = parser.parse_args(argv)
+
+    index = DuhShapeIndex.from_output_folder(args.output_folder)
+    if not len(index):
+        print(f"No overall DUHs found under {args.output_folder}")
+        return 1
+    index.save(os.path.join(args.output_folder, INDEX_FILE))
+    clusters = index.to_frame()
+    clusters['Cluster'] = index.cluster(args.clusters, args.method)
+    clusters.to_csv(os.path.join(args.output_folder, CLUSTERS_FILE), index=False)
+    print(clusters.groupby('Cluster')[list(FEATURES)].mean().assign(Sites=clusters['Cluster'].value_counts())
+          .to_string())
+    print(f"Wrote {INDEX_FILE} and {CLUSTERS_FILE} for {len(index)} sites")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .helpers import log_progress
+from .downsampling import minmax_indices, x_positions
+
+# How saved matplotlib figures are produced:
+#   'process' - queued and rendered by a pool of worker processes (Agg backend)
+#   'inline'  - rendered immediately in the calling process
+#   'defer'   - kept until render_deferred() is called, e.g. when the user asks for them
+#   'off'     - never rendered (headless runs that only need the numbers)
+RENDER_MODES = ('process', 'inline', 'defer', 'off')
+#
+# The mode belongs to a Figures object, which also holds the figures deferred under it. The app keeps
+# one per session, so sessions do not change each other's mode or see each other's deferred figures,
+# and the batch runner one per site; the functions that save figures take it as `figures`. Without
+# one they use a process-wide default, set with set_render_mode() (e.g. by the tests).
+
+# Pixel columns of a 12 x 6 inch figure at matplotlib's default 100 dpi
+DEFAULT_PIXEL_COLUMNS = 1200
+
+_executor = None
+_pending = []
+
+
+class Figures:
+    def __init__(self, mode='process'):
+        self.lock = threading.Lock()
+        self.deferred = {}
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        if mode not in RENDER_MODES:
+            raise ValueError(f"Unknown render mode '{mode}', expected one of {RENDER_MODES}")
+        self.mode = mode
+
+    # Queue a figure according to the render mode
+    def submit(self, spec, log_folder=None):
+        mode = self.mode
+        if mode == 'off':
+            return None
+        if mode == 'defer':
+            with self.lock:
+                self.deferred[spec['path']] = spec
+            return None
+        if mode == 'process':
+            try:
+                future = _get_executor().submit(render_line_figure, spec)
+                if log_folder is not None:
+                    future.add_done_callback(lambda done: _log_failure(done, spec['path'], log_folder))
+                _pending[:] = [pending for pending in _pending if not pending.done()]
+                _pending.append(future)
+                return future
+            except (BrokenProcessPool, OSError, RuntimeError) as e:
+                # Fall back to rendering here if worker processes are unavailable
+                _shutdown_executor()
+                if log_folder is not None:
+                    log_progress(log_folder, f"Figure worker pool unavailable ({e}); rendering inline.")
+        return render_line_figure(spec)
+
+    def deferred_figures(self):
+        with self.lock:
+            return sorted(self.deferred)
+
+    # Render figures held back in 'defer' mode (all of them, or only the requested paths)
+    def render_deferred(self, paths=None):
+        with self.lock:
+            specs = [self.deferred.pop(path, None) for path in (list(self.deferred) if paths is None else paths)]
+        return [render_line_figure(spec) for spec in specs if spec is not None]
+
+
+_default_figures = Figures()
+
+
+# The Figures to save into: the given one, or the process-wide default
+def figures_or_default(figures=None):
+    return _default_figures if figures is None else figures
+
+
+def set_render_mode(mode):
+    _default_figures.set_mode(mode)
+
+
+def get_render_mode():
+    return _default_figures.mode
+
+
+# Plain NumPy values for pickling; tz-aware datetimes become naive UTC, which matplotlib also assumes
+def _plain_array(values):
+    if isinstance(values, (pd.Series, pd.Index)) and isinstance(values.dtype, pd.DatetimeTZDtype):
+        values = values.tz_convert(None) if isinstance(values, pd.Index) else values.dt.tz_convert(None)
+    return np.asarray(values)
+
+
+# Reduce a line to the min and max sample of every pixel column, in time order. The drawn
+# line looks the same as the full-resolution one, including every peak and trough.
+def minmax_decimate(x, y, n_columns=DEFAULT_PIXEL_COLUMNS):
+    x = _plain_array(x)
+    y = np.asarray(y, dtype=float)
+    valid = ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    keep = minmax_indices(x_positions(x, len(y)), y, n_columns)
+    return x[keep], y[keep]
+
+
+# Figure spec: a plain dict so it can be pickled to a worker process
+#   {'path', 'title', 'xlabel', 'ylabel', 'date_format', 'legend': dict or None,
+#    'lines': [(x, y, fmt, plot_kwargs), ...]}
+def line_figure_spec(path, title, lines, xlabel="Date", ylabel="Discharge (cfs)", date_format="%b %d",
+                     legend=None, n_columns=DEFAULT_PIXEL_COLUMNS, decimate=(0,)):
+    spec_lines = []
+    for number, (x, y, fmt, kwargs) in enumerate(lines):
+        if number in decimate:
+            x, y = minmax_decimate(x, y, n_columns)
+        spec_lines.append((_plain_array(x), _plain_array(y), fmt, kwargs))
+    return {'path': path, 'title': title, 'xlabel': xlabel, 'ylabel': ylabel,
+            'date_format': date_format, 'legend': legend, 'lines': spec_lines}
+
+
+def _init_worker():
+    # Workers never show figures, so they only need the non-interactive backend
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+# Draw with the object-oriented API only, so rendering never touches pyplot state
+def render_line_figure(spec):
+    from matplotlib.figure import Figure
+    from matplotlib.dates import DateFormatter
+
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    for x, y, fmt, kwargs in spec['lines']:
+        ax.plot(x, y, fmt, **kwargs)
+
+    ax.set_title(spec['title'])
+    ax.set_xlabel(spec['xlabel'])
+    ax.set_ylabel(spec['ylabel'])
+    if spec['legend'] is not None:
+        ax.legend(**spec['legend'])
+    ax.xaxis.set_major_formatter(DateFormatter(spec['date_format']))
+    for label in ax.xaxis.get_majorticklabels():
+        label.set_rotation(45)
+    fig.tight_layout()
+    fig.savefig(spec['path'])
+    return spec['path']
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=max(1, min(4, (os.cpu_count() or 1) - 1)),
+                                        initializer=_init_worker)
+    return _executor
+
+
+# Queue a figure according to the render mode of `figures` (the default's when None)
+def submit_figure(spec, log_folder=None, figures=None):
+    return figures_or_default(figures).submit(spec, log_folder)
+
+
+def _log_failure(done, path, log_folder):
+    if done.exception() is not None:
+        log_progress(log_folder, f"Failed to render {os.path.basename(path)}: {done.exception()}")
+
+
+def _shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def deferred_figures():
+    return _default_figures.deferred_figures()
+
+
+def render_deferred(paths=None):
+    return _default_figures.render_deferred(paths)
+
+
+# Block until every queued figure has been written
+def wait_for_figures():
+    while _pending:
+        _pending.pop().result()
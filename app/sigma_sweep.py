@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from scipy.ndimage import gaussian_filter1d
+from .instrumentation import timed
+
+# Sigma values tried when none are given (in samples, like the smoothing slider)
+DEFAULT_SIGMAS = np.arange(0.5, 50.01, 0.5)
+
+# Default constraints for choose_sigma: the smoothed hydrograph must still explain this much of the
+# variance (NSE) and keep at least (1 - max attenuation) of the observed peak
+DEFAULT_MIN_NSE = 0.99
+DEFAULT_MAX_PEAK_ATTENUATION = 0.05
+
+
+# Every sigma's smoothed hydrograph as one row of a (sigmas x samples) array
+def smooth_stack(discharge, sigmas=DEFAULT_SIGMAS):
+    discharge = np.asarray(discharge, dtype=np.float64)
+    stack = np.empty((len(sigmas), len(discharge)))
+    for row, sigma in enumerate(sigmas):
+        stack[row] = gaussian_filter1d(discharge, sigma=sigma)
+    return stack
+
+
+# NSE, peak difference and relative peak attenuation of every smoothed row against the observations
+def sweep_sigmas(discharge, sigmas=DEFAULT_SIGMAS):
+    observed = np.asarray(discharge, dtype=np.float64)
+    sigmas = np.asarray(sigmas, dtype=float)
+    stack = smooth_stack(observed, sigmas)
+
+    denominator = np.sum(np.square(observed - observed.mean()))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nse = 1 - np.sum(np.square(stack - observed), axis=1) / denominator
+        peak_diff = np.abs(observed.max() - stack.max(axis=1))
+        attenuation = (observed.max() - stack.max(axis=1)) / observed.max()
+    return pd.DataFrame({'Sigma': sigmas, 'NSE': nse, 'Peak Difference': peak_diff, 'Peak Attenuation': attenuation})
+
+
+# The largest sigma (smoothest hydrograph) that still meets the NSE and peak attenuation limits.
+# When no sigma meets them, the one with the highest NSE is returned. Returns the sigma and its row.
+def choose_sigma(sweep, min_nse=DEFAULT_MIN_NSE, max_peak_attenuation=DEFAULT_MAX_PEAK_ATTENUATION):
+    ok = np.ones(len(sweep), dtype=bool)
+    if min_nse is not None:
+        ok &= (sweep['NSE'] >= min_nse).to_numpy()
+    if max_peak_attenuation is not None:
+        ok &= (sweep['Peak Attenuation'] <= max_peak_attenuation).to_numpy()
+
+    if ok.any():
+        row = sweep[ok]['Sigma'].idxmax()
+    else:
+        row = sweep['NSE'].fillna(-np.inf).idxmax()
+    return float(sweep.loc[row, 'Sigma']), sweep.loc[row]
+
+
+# Sweep and choose in one call for a single hydrograph
+@timed('sigma sweep', rows_arg='discharge')
+def best_sigma(discharge, sigmas=DEFAULT_SIGMAS, min_nse=DEFAULT_MIN_NSE,
+               max_peak_attenuation=DEFAULT_MAX_PEAK_ATTENUATION):
+    sweep = sweep_sigmas(discharge, sigmas)
+    sigma, _ = choose_sigma(sweep, min_nse, max_peak_attenuation)
+    return sigma, sweep
@@ -0,0 +1,352 @@
+import os
+import re
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+from .helpers import CreateFolder, log_progress
+
+# Bootstrap bands of the overall DUH (duh_bootstrap.py), written next to overall_duh.csv
+BANDS_FILE = "overall_duh_bands.csv"
+
+# Where a site's results are kept:
+#   'csv'   - one CSV per event, smoothed event and DUH (the original layout)
+#   'store' - one typed Parquet table per kind of result in USGS{site}/site_store, with CSV
+#             exports written only when asked for (SiteStore.export_csv)
+STORAGE_FORMATS = ('csv', 'store')
+
+STORE_FOLDER = "site_store"
+
+# Tables of the site store
+#   discharge.parquet    datetimeUTC index, discharge_cfs float32, qualifiers category
+#   events.parquet       event index: event_no, year, start, end, points, smoothed, has_duh
+#   hydrographs/         event_no int64, datetimeUTC, discharge_cfs float32, qualifiers category,
+#                        smoothed_discharge_cfs float32 (NaN until the event is smoothed)
+#   duhs/                event_no int64, normalized_time float32, normalized_discharge float32
+#   overall_duh.parquet  the overall DUH table
+#   overall_duh_bands.parquet  bootstrap bands of the overall DUH (duh_bootstrap.py)
+#
+# The event tables (hydrographs, duhs) are kept as one Parquet file per event (event_N.parquet), so
+# saving one event writes that event's file and the row of the small event index, not the whole
+# table.
+EVENT_TABLES = ('hydrographs', 'duhs')
+
+_EVENT_NAME = re.compile(r"^Event_(\d+)_")
+_PARTITION_NAME = re.compile(r"^event_(\d+)\.parquet$")
+
+# Writes to a site store hold the store's lock, so sessions saving events of the same site (e.g. an
+# event from the page while a job saves the others) do not overwrite each other's index rows
+_store_locks = {}
+_store_locks_guard = threading.Lock()
+
+
+def _store_lock(folder):
+    with _store_locks_guard:
+        return _store_locks.setdefault(os.path.abspath(folder), threading.Lock())
+
+
+# Event number from an Event_N_YYYY(.csv) name
+def event_number(event_name):
+    return int(_EVENT_NAME.match(event_name).group(1))
+
+
+class SiteStore:
+    def __init__(self, USGS_data):
+        self.USGS_data = USGS_data
+        self.folder = os.path.join(USGS_data, STORE_FOLDER)
+        self.lock = _store_lock(self.folder)
+
+    def path(self, table):
+        return os.path.join(self.folder, f"{table}.parquet")
+
+    # File of one event in an event table
+    def partition_path(self, table, event_no):
+        return os.path.join(self.folder, table, f"event_{event_no}.parquet")
+
+    # Event numbers stored in an event table, in order
+    def partitions(self, table):
+        folder = os.path.join(self.folder, table)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(int(match.group(1)) for name in os.listdir(folder)
+                      for match in [_PARTITION_NAME.match(name)] if match)
+
+    def has(self, table):
+        if table in EVENT_TABLES:
+            return bool(self.partitions(table))
+        return os.path.exists(self.path(table))
+
+    # An event table is read as one frame ordered by event number; event_numbers picks some events
+    def read(self, table, columns=None, event_numbers=None):
+        if table not in EVENT_TABLES:
+            if not self.has(table):
+                return None
+            return pd.read_parquet(self.path(table), columns=columns)
+        stored = self.partitions(table)
+        if not stored:
+            return None
+        wanted = stored if event_numbers is None else sorted(set(event_numbers) & set(stored))
+        frames = [pd.read_parquet(self.partition_path(table, event_no), columns=columns) for event_no in wanted]
+        if not frames:
+            return pd.read_parquet(self.partition_path(table, stored[0]), columns=columns).iloc[:0]
+        frame = pd.concat(frames, ignore_index=True)
+        if 'qualifiers' in frame:
+            frame['qualifiers'] = frame['qualifiers'].astype(str).astype('category')
+        return frame
+
+    # Written through a temporary file so readers never see a partial table
+    def write(self, table, frame):
+        CreateFolder(self.folder)
+        frame.to_parquet(self.path(table) + ".tmp", index=table == 'discharge')
+        os.replace(self.path(table) + ".tmp", self.path(table))
+
+    def _write_partition(self, table, event_no, frame):
+        path = self.partition_path(table, event_no)
+        CreateFolder(os.path.dirname(path))
+        frame.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+    # Discharge record
+
+    def put_discharge(self, raw_data):
+        self.write('discharge', pd.DataFrame({
+            'discharge_cfs': raw_data['discharge_cfs'].to_numpy(dtype=np.float32),
+            'qualifiers': pd.Categorical(raw_data['qualifiers']),
+        }, index=raw_data.index))
+
+    def get_discharge(self, user_months=None):
+        discharge = self.read('discharge')
+        if user_months is not None:
+            discharge = discharge[discharge.index.month.isin(user_months)]
+        return discharge
+
+    # Event hydrographs (raw and smoothed)
+
+    # hydrographs: [(event_no, frame indexed by datetimeUTC, or with a datetimeUTC column)]. The rows
+    # of those events are replaced; a smoothed_discharge_cfs column is kept when the frame has one.
+    def put_hydrographs(self, hydrographs):
+        if not hydrographs:
+            return
+        new_rows = []
+        for event_no, frame in hydrographs:
+            if 'datetimeUTC' not in frame:
+                frame = frame.reset_index()
+            if 'smoothed_discharge_cfs' in frame:
+                smoothed = frame['smoothed_discharge_cfs'].to_numpy(dtype=np.float32)
+            else:
+                smoothed = np.full(len(frame), np.nan, dtype=np.float32)
+            new_rows.append((event_no, pd.DataFrame({
+                'event_no': np.full(len(frame), event_no, dtype=np.int64),
+                'datetimeUTC': pd.to_datetime(frame['datetimeUTC'], utc=True).array,
+                'discharge_cfs': frame['discharge_cfs'].to_numpy(dtype=np.float32),
+                'qualifiers': pd.Categorical(frame['qualifiers'].astype(str).to_numpy()),
+                'smoothed_discharge_cfs': smoothed,
+            })))
+        with self.lock:
+            for event_no, rows in new_rows:
+                self._write_partition('hydrographs', event_no, rows)
+            has_duh = set(self.partitions('duhs'))
+            self._update_index(pd.DataFrame({
+                'event_no': np.array([event_no for event_no, _ in new_rows], dtype=np.int64),
+                'start': pd.DatetimeIndex([rows['datetimeUTC'].min() for _, rows in new_rows]),
+                'end': pd.DatetimeIndex([rows['datetimeUTC'].max() for _, rows in new_rows]),
+                'points': np.array([len(rows) for _, rows in new_rows], dtype=np.int64),
+                'smoothed': np.array([rows['smoothed_discharge_cfs'].notna().any() for _, rows in new_rows]),
+                'has_duh': np.array([event_no in has_duh for event_no, _ in new_rows]),
+            }))
+
+    def put_event(self, event_no, storm_hydrograph):
+        self.put_hydrographs([(event_no, storm_hydrograph)])
+
+    def put_smoothed(self, event_no, smoothed_data):
+        self.put_hydrographs([(event_no, smoothed_data)])
+
+    # Raw event hydrograph, laid out like a saved Event_*.csv read back with parse_dates
+    def get_event(self, event_no):
+        rows = self.read('hydrographs', event_numbers=[event_no])
+        event = rows[['datetimeUTC', 'discharge_cfs', 'qualifiers']].reset_index(drop=True)
+        event['qualifiers'] = event['qualifiers'].astype(str)
+        return event
+
+    # DUHs
+
+    # duhs: [(event_no, normalized_discharge, normalized_time)]
+    def put_duhs(self, duhs):
+        if not duhs:
+            return
+        with self.lock:
+            for event_no, normalized_discharge, normalized_time in duhs:
+                self._write_partition('duhs', event_no, pd.DataFrame({
+                    'event_no': np.full(len(normalized_time), event_no, dtype=np.int64),
+                    'normalized_time': np.asarray(normalized_time, dtype=np.float32),
+                    'normalized_discharge': np.asarray(normalized_discharge, dtype=np.float32),
+                }))
+            index = self.event_index()
+            if index['event_no'].isin([event_no for event_no, _, _ in duhs]).any():
+                index['has_duh'] |= index['event_no'].isin([event_no for event_no, _, _ in duhs])
+                self.write('events', index)
+
+    def put_duh(self, event_no, normalized_discharge, normalized_time):
+        self.put_duhs([(event_no, normalized_discharge, normalized_time)])
+
+    # DUH events in the (name, normalized time, normalized discharge) layout of duh_stack.load_duh_events
+    def duh_events(self):
+        duhs = self.read('duhs')
+        if duhs is None or duhs.empty:
+            return []
+        events = []
+        for event_no, rows in duhs.groupby('event_no', sort=True):
+            events.append((f"DUH_Event_{event_no}",
+                           rows['normalized_time'].to_numpy(dtype=float),
+                           rows['normalized_discharge'].to_numpy(dtype=float)))
+        return events
+
+    # Overall DUH
+
+    # The normalized time is the DUH grid and stays float64, so it reads back as the same nodes
+    def put_overall_duh(self, overall_duh_df):
+        self.write('overall_duh', overall_duh_df.astype({column: np.float32 for column in overall_duh_df.columns
+                                                         if column not in ('Event Count', 'Normalized Time')}))
+
+    def get_overall_duh(self):
+        return self.read('overall_duh')
+
+    def put_duh_bands(self, bands_df):
+        self.write('overall_duh_bands', bands_df.astype({column: np.float32 for column in bands_df.columns
+                                                         if column != 'Normalized Time'}))
+
+    def get_duh_bands(self):
+        return self.read('overall_duh_bands')
+
+    # Event index
+
+    def event_index(self):
+        index = self.read('events')
+        if index is None:
+            return pd.DataFrame({'event_no': pd.Series(dtype=np.int64), 'year': pd.Series(dtype=np.int64),
+                                 'start': pd.Series(dtype='datetime64[ns, UTC]'),
+                                 'end': pd.Series(dtype='datetime64[ns, UTC]'),
+                                 'points': pd.Series(dtype=np.int64), 'smoothed': pd.Series(dtype=bool),
+                                 'has_duh': pd.Series(dtype=bool)})
+        return index
+
+    # Names of the stored events, in the Event_N_YYYY form of the CSV files
+    def event_names(self):
+        return [f"Event_{row.event_no}_{row.year}" for row in self.event_index().itertuples()]
+
+    # Replace the index rows of the given events (one row per event, without the year)
+    def _update_index(self, rows):
+        rows.insert(1, 'year', rows['start'].dt.year.astype(np.int64))
+        index = self.event_index()
+        index = index[~index['event_no'].isin(rows['event_no'])]
+        index = pd.concat([index, rows], ignore_index=True) if not index.empty else rows
+        self.write('events', index.sort_values('event_no', kind='stable').reset_index(drop=True))
+
+    # Drop all event hydrographs and DUHs, e.g. before a batch run writes a fresh set
+    def clear_events(self):
+        with self.lock:
+            if self.has('events'):
+                os.remove(self.path('events'))
+            for table in EVENT_TABLES:
+                if os.path.isdir(os.path.join(self.folder, table)):
+                    shutil.rmtree(os.path.join(self.folder, table))
+
+    # Write the stored results as the CSV files of the 'csv' layout
+    def export_csv(self, site_no):
+        written = []
+        if self.has('discharge'):
+            self.get_discharge().to_csv(os.path.join(self.USGS_data, f"USGS_Discharge_{site_no}.csv"))
+            written.append(f"USGS_Discharge_{site_no}.csv")
+
+        for row in self.event_index().itertuples():
+            rows = self.read('hydrographs', event_numbers=[row.event_no])
+            event = rows[['datetimeUTC', 'discharge_cfs', 'qualifiers']]
+            event.to_csv(os.path.join(self.USGS_data, f"Event_{row.event_no}_{row.year}.csv"), index=False)
+            written.append(f"Event_{row.event_no}_{row.year}.csv")
+            if row.smoothed:
+                rows[['datetimeUTC', 'discharge_cfs', 'qualifiers', 'smoothed_discharge_cfs']].to_csv(
+                    os.path.join(self.USGS_data, f"S_Event_{row.event_no}.csv"), index=False)
+                written.append(f"S_Event_{row.event_no}.csv")
+
+        for name, normalized_time, normalized_discharge in self.duh_events():
+            pd.DataFrame({'Normalized Discharge': normalized_discharge, 'Normalized Time': normalized_time}
+                         ).to_csv(os.path.join(self.USGS_data, f"{name}.csv"), index=False)
+            written.append(f"{name}.csv")
+
+        if self.has('overall_duh'):
+            self.get_overall_duh().to_csv(os.path.join(self.USGS_data, "overall_duh.csv"), index=False)
+            written.append("overall_duh.csv")
+        if self.has('overall_duh_bands'):
+            self.get_duh_bands().to_csv(os.path.join(self.USGS_data, BANDS_FILE), index=False)
+            written.append(BANDS_FILE)
+
+        log_progress(self.USGS_data, f"Exported {len(written)} CSV files from the site store")
+        return written
+
+
+# Backend-neutral helpers used by the app, the batch runner and process_all_events
+
+def save_event(USGS_data, event_no, storm_hydrograph, storage='csv'):
+    if storage == 'store':
+        SiteStore(USGS_data).put_event(event_no, storm_hydrograph)
+        return f"Event_{event_no}_{storm_hydrograph.index[0].year}"
+    name = f"Event_{event_no}_{storm_hydrograph.index[0].year}.csv"
+    storm_hydrograph.to_csv(os.path.join(USGS_data, name))
+    return name
+
+
+def save_smoothed(USGS_data, event_no, smoothed_data, storage='csv'):
+    if storage == 'store':
+        SiteStore(USGS_data).put_smoothed(event_no, smoothed_data)
+        return f"S_Event_{event_no}"
+    name = f"S_Event_{event_no}.csv"
+    smoothed_data.to_csv(os.path.join(USGS_data, name), index=False)
+    return name
+
+
+def save_duh(USGS_data, event_no, normalized_discharge, normalized_time, storage='csv'):
+    if storage == 'store':
+        SiteStore(USGS_data).put_duh(event_no, normalized_discharge, normalized_time)
+        return f"DUH_Event_{event_no}"
+    name = f"DUH_Event_{event_no}.csv"
+    pd.DataFrame({'Normalized Discharge': normalized_discharge, 'Normalized Time': normalized_time}
+                 ).to_csv(os.path.join(USGS_data, name), index=False)
+    return name
+
+
+def save_overall_duh(USGS_data, overall_duh_df, storage='csv'):
+    if storage == 'store':
+        SiteStore(USGS_data).put_overall_duh(overall_duh_df)
+        return "site_store/overall_duh.parquet"
+    overall_duh_df.to_csv(os.path.join(USGS_data, "overall_duh.csv"), index=False)
+    return "overall_duh.csv"
+
+
+def save_duh_bands(USGS_data, bands_df, storage='csv'):
+    if storage == 'store':
+        SiteStore(USGS_data).put_duh_bands(bands_df)
+        return "site_store/overall_duh_bands.parquet"
+    bands_df.to_csv(os.path.join(USGS_data, BANDS_FILE), index=False)
+    return BANDS_FILE
+
+
+# Event_N_YYYY names available for smoothing, in event order
+def list_events(USGS_data, storage='csv'):
+    if storage == 'store':
+        return SiteStore(USGS_data).event_names()
+    names = [name for name in os.listdir(USGS_data) if _EVENT_NAME.match(name) and name.endswith(".csv")]
+    return sorted(names, key=event_number)
+
+
+# An event hydrograph with datetimeUTC as a column, whichever backend holds it
+def load_event(USGS_data, event_name, storage='csv'):
+    if storage == 'store':
+        return SiteStore(USGS_data).get_event(event_number(event_name))
+    return pd.read_csv(os.path.join(USGS_data, event_name), parse_dates=['datetimeUTC'])
+
+
+# The file whose signature changes when the event changes (for memoized readers)
+def event_source(USGS_data, event_name, storage='csv'):
+    if storage == 'store':
+        return SiteStore(USGS_data).partition_path('hydrographs', event_number(event_name))
+    return os.path.join(USGS_data, event_name)
@@ -1,36 +1,35 @@
-import os
 import numpy as np
 import pandas as pd
-import streamlit as st
 from scipy.ndimage import gaussian_filter1d
-from plotly import graph_objects as go
+from .duh_stack import load_duh_events, stack_duhs, summarize_duh_stack, update_duh_state, summarize_duh_state
+from .downsampling import DEFAULT_POINT_BUDGET
+from .normalization import normalize_events
+from .time_grid import TimeGrid, resolve_grid
+from .site_store import SiteStore
+from .helpers import notify_message
+from .instrumentation import stage, timed
 
 def nash_sutcliffe_efficiency(observed, simulated):
-    numerator = sum((simulated - observed) ** 2)
-    denominator = sum((observed - np.mean(observed)) ** 2)
+    observed = np.asarray(observed, dtype=np.float64)
+    simulated = np.asarray(simulated, dtype=np.float64)
+    numerator = np.sum(np.square(simulated - observed))
+    denominator = np.sum(np.square(observed - observed.mean()))
     return 1 - (numerator / denominator)
 
-def apply_gaussian_smoothing(event_data, sigma):
+# show_plot draws the original and smoothed hydrographs into the Streamlit page (see charts.py)
+@timed('smoothing', rows_arg='event_data')
+def apply_gaussian_smoothing(event_data, sigma, show_plot=True, max_points=DEFAULT_POINT_BUDGET, notify=None):
     try:
         if 'discharge_cfs' not in event_data:
-            st.error("Missing 'discharge_cfs' in data.")
+            notify_message(notify, 'error', "Missing 'discharge_cfs' in data.")
             return None, None, None
 
         discharge = event_data['discharge_cfs']
         smoothed = gaussian_filter1d(discharge, sigma=sigma)
 
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(x=event_data['datetimeUTC'], y=discharge, mode='lines', name='Original Data'))
-        fig.add_trace(go.Scatter(x=event_data['datetimeUTC'], y=smoothed, mode='lines',
-                                 name=f'Smoothed with sigma={sigma}', line=dict(color='red')))
-        fig.update_layout(
-            title="Original and Smoothed Hydrograph",
-            xaxis_title="Date",
-            yaxis_title="Discharge (cfs)",
-            legend_title="Legend",
-            font=dict(family="Courier New, monospace", size=12, color="RebeccaPurple")
-        )
-        st.plotly_chart(fig)
+        if show_plot:
+            from .charts import plot_smoothed_hydrograph
+            plot_smoothed_hydrograph(event_data, smoothed, sigma, max_points)
 
         nse = nash_sutcliffe_efficiency(discharge, smoothed)
         peak_diff = abs(np.max(discharge) - np.max(smoothed))
@@ -39,31 +38,30 @@ def apply_gaussian_smoothing(event_data, sigma):
         return event_data, nse, peak_diff
 
     except Exception as e:
-        st.error(f"An error occurred during Gaussian smoothing: {e}")
+        notify_message(notify, 'error', f"An error occurred during Gaussian smoothing: {e}")
         return None, None, None
 
-def create_dimensionless_unit_hydrograph(smoothed_data):
+# One event through the batch normalizer (normalization.normalize_events); baseflow is one of
+# normalization.BASEFLOW_METHODS. Returns the normalized discharge and time as Series on the
+# event's index, or empty Series when the flow never rises above the baseflow.
+@timed('DUH normalization', rows_arg='smoothed_data')
+def create_dimensionless_unit_hydrograph(smoothed_data, notify=None, baseflow='first', baseflow_slope=None):
     try:
-        smoothed_data['datetimeUTC'] = pd.to_datetime(smoothed_data['datetimeUTC'])
-        smoothed_data['minutes'] = (smoothed_data['datetimeUTC'] - smoothed_data['datetimeUTC'].iloc[0]).dt.total_seconds() / 60
-
         if 'smoothed_discharge_cfs' not in smoothed_data:
-            st.error("Missing 'smoothed_discharge_cfs' in data.")
+            notify_message(notify, 'error', "Missing 'smoothed_discharge_cfs' in data.")
             return pd.Series(), pd.Series()
 
-        base_flow = smoothed_data['smoothed_discharge_cfs'].iloc[0]
-        storm_hydrograph = smoothed_data['smoothed_discharge_cfs'] - base_flow
-        storm_hydrograph[storm_hydrograph < 0] = 0
-
-        peak_discharge = storm_hydrograph.max()
-        time_to_peak = smoothed_data['minutes'][storm_hydrograph.idxmax()]
-        normalized_discharge = storm_hydrograph / peak_discharge
-        normalized_time = smoothed_data['minutes'] / time_to_peak
-
-        return normalized_discharge, normalized_time
+        times = pd.DatetimeIndex(pd.to_datetime(smoothed_data['datetimeUTC'])).asi8
+        normalized_discharge, normalized_time, stats = normalize_events(
+            [0, len(smoothed_data)], times, smoothed_data['smoothed_discharge_cfs'].to_numpy(), baseflow, baseflow_slope)
+        if not stats['Has DUH'].iloc[0]:
+            notify_message(notify, 'warning', "The smoothed flow never rises above the baseflow; no DUH was made.")
+            return pd.Series(), pd.Series()
+        return (pd.Series(normalized_discharge, index=smoothed_data.index, name='smoothed_discharge_cfs'),
+                pd.Series(normalized_time, index=smoothed_data.index, name='minutes'))
 
     except Exception as e:
-        st.error(f"An error occurred while creating dimensionless unit hydrograph: {e}")
+        notify_message(notify, 'error', f"An error occurred while creating dimensionless unit hydrograph: {e}")
         return pd.Series(), pd.Series()
 
 def interpolate_duh(duh, common_time_axis, method='akima'):
@@ -74,52 +72,50 @@ def interpolate_duh(duh, common_time_axis, method='akima'):
         interpolated_duh = duh.reindex(common_time_axis).interpolate(method=method)
     return interpolated_duh.reset_index()
 
-def process_smoothed_files(directory):
-    common_time_axis = np.arange(0, 10.001, 0.001)
-    all_interpolated_duhs = []
-
-    for filename in os.listdir(directory):
-        if filename.startswith("DUH_Event_") and filename.endswith(".csv"):
-            st.write(f"Processing {filename}...")
-            duh = pd.read_csv(os.path.join(directory, filename))
-            interpolated_values = interpolate_duh(duh, common_time_axis)
-            if interpolated_values is not None and not interpolated_values.empty:
-                interpolated_array = interpolated_values['Normalized Discharge'].to_numpy()
-                if len(interpolated_array) < len(common_time_axis):
-                    interpolated_array = np.pad(interpolated_array, (0, len(common_time_axis) - len(interpolated_array)),
-                                                'constant', constant_values=np.nan)
-                all_interpolated_duhs.append(interpolated_array)
-            else:
-                st.write(f"Warning: Could not interpolate {filename}")
-
-    if not all_interpolated_duhs:
-        st.write("No valid DUH_Event files found or processed.")
-        return pd.DataFrame(), []
-
-    overall_duh = np.nanmean(np.array(all_interpolated_duhs), axis=0)
-    overall_duh_df = pd.DataFrame({'Normalized Time': common_time_axis, 'Normalized Discharge': overall_duh})
-
-    return overall_duh_df, all_interpolated_duhs
-
-def plot_duhs(overall_duh_df, all_interpolated_duhs, common_time_axis, output_folder):
-    fig = go.Figure()
-
-    for index, duh in enumerate(all_interpolated_duhs):
-        fig.add_trace(go.Scatter(x=common_time_axis, y=duh, mode='lines', name=f'Event DUH {index+1}', opacity=0.5))
-
-    if overall_duh_df is not None:
-        fig.add_trace(go.Scatter(
-            x=overall_duh_df['Normalized Time'],
-            y=overall_duh_df['Normalized Discharge'],
-            mode='lines',
-            name='Overall DUH',
-            line=dict(color='red', width=2)
-        ))
-
-    fig.update_layout(
-        title='Overall and Event Dimensionless Unit Hydrographs',
-        xaxis_title='Normalized Time',
-        yaxis_title='Normalized Discharge',
-        legend_title="Legend"
-    )
-    st.plotly_chart(fig)
+# DUH events come from the DUH_Event CSVs (storage='csv'), the site store ('store'), or the store when
+# it holds any DUHs and the CSVs otherwise ('auto'). Progress messages go to notify(level, message).
+# common_time_axis is a fixed grid or a time_grid.TimeGrid (by default TimeGrid()), which is fitted
+# to the events; the grid used is the 'Normalized Time' column of the overall DUH. Returns the
+# overall DUH and, with with_matrix, the (events x grid) matrix of interpolated DUHs (None
+# otherwise). Percentile bands (e.g. DEFAULT_PERCENTILES) and the matrix need every event's row, so
+# the incremental update only reads them when asked for.
+def process_smoothed_files(directory, common_time_axis=None, percentiles=None, incremental=True,
+                           storage='auto', notify=None, with_matrix=False):
+    if common_time_axis is None:
+        common_time_axis = TimeGrid()
+
+    store = SiteStore(directory)
+    if storage == 'auto':
+        storage = 'store' if store.has('duhs') else 'csv'
+    stored_events = store.duh_events() if storage == 'store' else None
+
+    if incremental:
+        # Only new or modified events are interpolated; the running state lives next to overall_duh.csv
+        with stage('DUH interpolation') as timing:
+            state, changes = update_duh_state(directory, common_time_axis, stored_events)
+            timing.rows = len(changes['added']) + len(changes['changed'])
+        for filename in changes['failed']:
+            notify_message(notify, 'warning', f"Could not interpolate {filename}")
+        if changes['added'] or changes['changed'] or changes['removed']:
+            notify_message(notify, 'info', f"Updated overall DUH: {len(changes['added'])} added, "
+                                           f"{len(changes['changed'])} changed, {len(changes['removed'])} removed.")
+        overall_duh_df, matrix, names = summarize_duh_state(state, percentiles, with_matrix)
+    else:
+        # All events are read once and interpolated into one (events x grid) float32 matrix
+        events = load_duh_events(directory) if stored_events is None else stored_events
+        grid = resolve_grid(common_time_axis, events)
+        with stage('DUH interpolation', rows=len(events)):
+            matrix, names = stack_duhs(events, grid)
+        for filename in sorted(set(name for name, _, _ in events) - set(names)):
+            notify_message(notify, 'warning', f"Could not interpolate {filename}")
+        overall_duh_df = summarize_duh_stack(matrix, grid, percentiles) if names else None
+        if not with_matrix:
+            matrix = None
+
+    if not names:
+        notify_message(notify, 'warning', "No valid DUH_Event files found or processed.")
+        return pd.DataFrame(), [] if with_matrix else None
+
+    notify_message(notify, 'info', f"Processed {len(names)} DUH_Event files.")
+    return overall_duh_df, matrix
+
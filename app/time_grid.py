@@ -0,0 +1,81 @@
+import numpy as np
+
+# Normalized-time grid of the overall DUH. Time is in units of the time to peak (the peak is at 1), so
+# the shape of every DUH is decided in the first few units and the rest is a slow recession. The
+# grid is an evenly spaced part from 0 to peak_span (peak_step apart) followed by a tail spaced
+# evenly on a log scale (tail_points_per_decade), and it ends at the first node at or past the end
+# of the longest event (or at max_time when one is given).
+#
+# The nodes do not depend on where the grid stops: a grid that reaches further only adds nodes at
+# the end. The running DUH state (duh_stack.update_duh_state) uses this to take in a longer event by
+# adding columns instead of interpolating every event again.
+#
+# The defaults give 592 nodes up to 10 times to peak, against 10,001 for the fixed
+# np.arange(0, 10.001, 0.001) grid used before. On the USGS05125039 events the DUHs read off the
+# nodes by linear interpolation stay within 1e-3 of their values on that grid.
+DEFAULT_PEAK_STEP = 0.01
+DEFAULT_PEAK_SPAN = 5.0
+DEFAULT_TAIL_POINTS_PER_DECADE = 300
+
+
+class TimeGrid:
+    def __init__(self, peak_step=DEFAULT_PEAK_STEP, peak_span=DEFAULT_PEAK_SPAN,
+                 tail_points_per_decade=DEFAULT_TAIL_POINTS_PER_DECADE, max_time=None):
+        if peak_step <= 0 or peak_span <= 0 or tail_points_per_decade <= 0:
+            raise ValueError("peak_step, peak_span and tail_points_per_decade must be positive.")
+        if max_time is not None and max_time <= 0:
+            raise ValueError("max_time must be positive.")
+        self.peak_step = float(peak_step)
+        self.peak_span = float(peak_span)
+        self.tail_points_per_decade = float(tail_points_per_decade)
+        self.max_time = None if max_time is None else float(max_time)
+
+    def __repr__(self):
+        return (f"TimeGrid(peak_step={self.peak_step}, peak_span={self.peak_span}, "
+                f"tail_points_per_decade={self.tail_points_per_decade}, max_time={self.max_time})")
+
+    # Grid nodes from 0 to the first node at or past `end` (max_time when set, whatever `end` is)
+    def axis(self, end=None):
+        end = self.max_time if self.max_time is not None else end
+        end = 0.0 if end is None or not np.isfinite(end) else max(float(end), 0.0)
+
+        dense_points = int(round(self.peak_span / self.peak_step))
+        if end <= self.peak_span:
+            return _round_nodes(np.arange(min(int(np.ceil(end / self.peak_step - 1e-9)), dense_points) + 1)
+                                * self.peak_step)
+        tail_points = int(np.ceil(np.log10(end / self.peak_span) * self.tail_points_per_decade - 1e-9))
+        tail = self.peak_span * 10 ** (np.arange(1, tail_points + 1) / self.tail_points_per_decade)
+        return _round_nodes(np.r_[np.arange(dense_points + 1) * self.peak_step, tail])
+
+    # Grid covering the given (name, normalized time, normalized discharge) events
+    def axis_for(self, events):
+        return self.axis(max((event_end(time, discharge) for _, time, discharge in events), default=0.0))
+
+    # True when `grid` is a run of this grid's nodes from 0, i.e. what axis() returns for some end
+    def holds(self, grid):
+        grid = np.asarray(grid, dtype=np.float64)
+        return len(grid) > 0 and np.array_equal(grid, self.axis(grid[-1]) if self.max_time is None else self.axis())
+
+
+# Nodes rounded to 12 significant digits, so they read back unchanged from overall_duh.csv with
+# any CSV parser (0.35 rather than 35 * 0.01 = 0.35000000000000003)
+def _round_nodes(nodes):
+    with np.errstate(divide='ignore'):
+        decimals = 11 - np.floor(np.log10(nodes))
+    scale = 10 ** np.where(nodes > 0, decimals, 0)
+    return np.round(nodes * scale) / scale
+
+
+# Last normalized time of an event with a usable sample (0 when there is none)
+def event_end(normalized_time, normalized_discharge):
+    normalized_time = np.asarray(normalized_time, dtype=np.float64)
+    valid = np.isfinite(normalized_time) & ~np.isnan(np.asarray(normalized_discharge, dtype=np.float64))
+    return float(normalized_time[valid].max()) if valid.any() else 0.0
+
+
+# The grid a process_smoothed_files call works on: a TimeGrid is fitted to the events, an array is
+# used as it is
+def resolve_grid(common_time_axis, events):
+    if isinstance(common_time_axis, TimeGrid):
+        return common_time_axis.axis_for(events)
+    return np.asarray(common_time_axis, dtype=np.float64)
@@ -0,0 +1,87 @@
+import os
+import pandas as pd
+import streamlit as st
+from .data_io import read_discharge_file
+from .events import EventWindows
+from .site_store import load_event, event_source
+from .peak_detection import find_filtered_peaks
+from .peak_index import PeakIndex
+from .smoothing import apply_gaussian_smoothing
+from .charts import streamlit_notify
+from .jobs import JobQueue, JOBS_FILE
+
+# Memoized loaders for the Streamlit script. Every widget interaction reruns main(), so anything
+# read from disk is keyed on the file's path, mtime and size (a rewritten file is a new entry) and
+# anything computed is keyed on its parameters. max_entries bounds each cache (LRU eviction).
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+# Discharge frames are large and only read downstream, so they are shared instead of copied
+@st.cache_resource(max_entries=4, show_spinner="Loading discharge data...")
+def _load_discharge(signature, user_months):
+    return read_discharge_file(signature[0], None if user_months is None else list(user_months))
+
+
+def load_discharge(discharge_file, user_months=None):
+    return _load_discharge(file_signature(discharge_file), None if user_months is None else tuple(user_months))
+
+
+# Sorted sample times of a discharge record, for cutting event windows on every rerun
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _event_windows(signature):
+    return EventWindows(_load_discharge(signature, None))
+
+
+def event_windows(discharge_file):
+    return _event_windows(file_signature(discharge_file))
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _load_peaks(signature):
+    return pd.read_csv(signature[0])
+
+
+def load_peaks(peaks_file):
+    return _load_peaks(file_signature(peaks_file))
+
+
+# Cached replacement for read_data(peaks_file, discharge_file)
+def load_peaks_and_discharge(peaks_file, discharge_file):
+    return load_peaks(peaks_file), load_discharge(discharge_file)
+
+
+# The leading underscore keeps Streamlit from hashing the whole frame; discharge_key identifies it
+# (it holds data_io.discharge_signature of the frame, so revised data is a new entry)
+@st.cache_resource(max_entries=4, show_spinner="Computing peak prominences...")
+def prominence_index(_discharge_filtered, discharge_key):
+    return PeakIndex(_discharge_filtered)
+
+
+# Whole-record detection is answered from the prominence index, so a new prominence is a lookup
+@st.cache_data(max_entries=32, show_spinner="Detecting peaks...")
+def detect_peaks(_discharge_filtered, discharge_key, prominence_value, min_peak_gap_hours, by_year=False):
+    if by_year:
+        return find_filtered_peaks(_discharge_filtered, prominence_value, min_peak_gap_hours, by_year)
+    return prominence_index(_discharge_filtered, discharge_key).query(prominence_value, min_peak_gap_hours)
+
+
+@st.cache_data(max_entries=64, show_spinner="Smoothing...")
+def _smooth_event(signature, USGS_data, event_name, storage, sigma):
+    event_data = load_event(USGS_data, event_name, storage)
+    return apply_gaussian_smoothing(event_data, sigma, show_plot=False, notify=streamlit_notify)
+
+
+# Gaussian smoothing of a saved event (CSV file or site store entry); returns (smoothed frame, NSE, peak difference)
+def smooth_event(USGS_data, event_name, sigma, storage='csv'):
+    return _smooth_event(file_signature(event_source(USGS_data, event_name, storage)), USGS_data, event_name,
+                         storage, sigma)
+
+
+# One job queue per server, shared by every session; the job table is kept next to the app
+@st.cache_resource
+def job_queue():
+    return JobQueue(JOBS_FILE)
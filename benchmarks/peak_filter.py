@@ -0,0 +1,85 @@
+# Compare the array-based peak spacing filter with the original iterrows loop.
+#   python -m benchmarks.peak_filter [n_peaks]
+
+import sys
+import time
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from app.peak_detection import filter_similar_peaks
+
+
+# The filter loop DetectAndSavePeaks used before filter_similar_peaks, kept as the reference
+def iterrows_filter(all_peaks_df, min_peak_gap_hours):
+    filtered_peaks = []
+    last_kept_time = None
+    last_kept_value = None
+
+    for _, row in all_peaks_df.iterrows():
+        current_time = row['Peak_Date']
+        current_value = row['discharge_cfs']
+
+        if last_kept_time is None:
+            filtered_peaks.append(row)
+            last_kept_time = current_time
+            last_kept_value = current_value
+            continue
+
+        time_diff = current_time - last_kept_time
+        value_diff = abs(current_value - last_kept_value) / max(last_kept_value, 1e-6)
+
+        if time_diff >= timedelta(hours=min_peak_gap_hours) and value_diff > 0.01:
+            filtered_peaks.append(row)
+            last_kept_time = current_time
+            last_kept_value = current_value
+
+    return pd.DataFrame(filtered_peaks)
+
+
+def array_filter(all_peaks_df, min_peak_gap_hours):
+    keep = filter_similar_peaks(all_peaks_df['Peak_Date'].to_numpy(dtype='datetime64[ns]').view('int64'),
+                                all_peaks_df['discharge_cfs'].to_numpy(dtype=float),
+                                pd.Timedelta(timedelta(hours=min_peak_gap_hours)).value)
+    return all_peaks_df.iloc[keep]
+
+
+# Candidate peaks spaced like a low-prominence run on 15-minute data, with flat-topped repeats
+def synthetic_peaks(n_peaks, seed=0):
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(1, 32, n_peaks) * np.timedelta64(15, 'm')
+    dates = pd.Timestamp("1900-01-01", tz="UTC") + pd.to_timedelta(np.cumsum(steps))
+    values = np.round(rng.lognormal(1.5, 1.0, n_peaks), 2)
+    repeats = rng.random(n_peaks) < 0.2
+    values[1:][repeats[1:]] = values[:-1][repeats[1:]]
+    return pd.DataFrame({
+        'discharge_cfs': values,
+        'qualifiers': 'A',
+        'Index': np.arange(n_peaks),
+        'Year': dates.year,
+        'Peak_Date': dates,
+    })
+
+
+def main(n_peaks=150_000, min_peak_gap_hours=12):
+    all_peaks_df = synthetic_peaks(n_peaks)
+
+    started = time.perf_counter()
+    expected = iterrows_filter(all_peaks_df, min_peak_gap_hours)
+    old_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    result = array_filter(all_peaks_df, min_peak_gap_hours)
+    new_seconds = time.perf_counter() - started
+
+    if not expected.index.equals(result.index) or expected.to_csv(index=False) != result.to_csv(index=False):
+        raise AssertionError("Array filter does not reproduce the iterrows filter")
+
+    print(f"{n_peaks} candidate peaks -> {len(result)} kept")
+    print(f"iterrows loop : {old_seconds:8.3f} s")
+    print(f"array filter  : {new_seconds:8.3f} s  ({old_seconds / new_seconds:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 150_000)
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "USGS05125039")
+
+
+def pytest_addoption(parser):
+    parser.addoption("--scales", default="10,100",
+                     help="Comma-separated sizes of the synthetic records, as multiples of the USGS05125039 fixture")
+
+
+def pytest_generate_tests(metafunc):
+    if 'scale' in metafunc.fixturenames:
+        scales = [int(scale) for scale in metafunc.config.getoption("scales").split(",") if scale.strip()]
+        metafunc.parametrize('scale', scales, ids=[f"{scale}x" for scale in scales])
+
+
+# notify(level, message) callback that records the messages the compute modules send
+class Notifications:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, level, message):
+        self.calls.append((level, message))
+
+    def messages(self, level):
+        return [message for kind, message in self.calls if kind == level]
+
+
+@pytest.fixture
+def notifications():
+    return Notifications()
+
+
+# Figures are not part of the measured work
+@pytest.fixture
+def no_figures():
+    from app.rendering import get_render_mode, set_render_mode
+    previous = get_render_mode()
+    set_render_mode('off')
+    yield
+    set_render_mode(previous)
+
+
+@pytest.fixture(scope="session")
+def fixture_discharge():
+    from app.data_io import read_discharge_csv
+    return read_discharge_csv(os.path.join(FIXTURE_DIR, "USGS_Discharge_05125039.csv"))
+
+
+# The record repeated `copies` times back to back, each copy moved one record span (plus a day)
+# earlier than the next, so the last copy is the original. The gap between copies splits them for
+# peak detection, so every copy gives the fixture's peaks.
+def repeat_record(discharge, copies):
+    shift = (discharge.index[-1] - discharge.index[0] + pd.Timedelta(days=1)).value
+    times = np.concatenate([discharge.index.asi8 - (copies - 1 - copy) * shift for copy in range(copies)])
+    return pd.DataFrame({
+        'discharge_cfs': np.tile(discharge['discharge_cfs'].to_numpy(), copies),
+        'qualifiers': pd.Categorical.from_codes(np.tile(discharge['qualifiers'].cat.codes.to_numpy(), copies),
+                                                discharge['qualifiers'].cat.categories),
+    }, index=pd.DatetimeIndex(times, tz='UTC', name=discharge.index.name))
+
+
+# An event table (datetimeUTC column, 15-minute steps) repeated `copies` times in a row
+def repeat_event(event, copies):
+    step = event['datetimeUTC'].iloc[1] - event['datetimeUTC'].iloc[0]
+    repeated = pd.concat([event] * copies, ignore_index=True)
+    repeated['datetimeUTC'] = event['datetimeUTC'].iloc[0] + step * np.arange(len(repeated))
+    return repeated
@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.async_fetcher import AsyncNWISFetcher
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+RECORDED_IV = os.path.join(TESTS_DIR, "nwis", "iv_05125039.json")
+RECORDED_SITE = os.path.join(TESTS_DIR, "nwis", "site_05125039.rdb")
+SITE_NO = "05125039"
+
+
+# Stand-in for waterservices.usgs.gov: answers /nwis/iv/ from the recorded JSON (only the values
+# dated between startDT and endDT, like NWIS) and /nwis/site/ from the recorded RDB file
+class StandInNWIS:
+    def __init__(self):
+        with open(RECORDED_IV) as f:
+            self.recorded = json.load(f)
+        with open(RECORDED_SITE) as f:
+            self.site_rdb = f.read()
+        self.requests = []
+        self.fail_first = 0          # answer this many requests with 503 first
+        self.fail_start_dates = set()  # always answer 500 for chunks starting on these dates
+        self.delay = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def iv_response(self, query):
+        response = json.loads(json.dumps(self.recorded))
+        series = response['value']['timeSeries'][0]
+        if query['sites'][0] != SITE_NO:
+            response['value']['timeSeries'] = []
+            return response
+        start, end = query['startDT'][0], query['endDT'][0]
+        values = [value for value in series['values'][0]['value'] if start <= value['dateTime'][:10] <= end]
+        if not values:
+            response['value']['timeSeries'] = []
+        series['values'][0]['value'] = values
+        return response
+
+
+@pytest.fixture
+def nwis():
+    stand_in = StandInNWIS()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            with stand_in.lock:
+                stand_in.requests.append((url.path, query))
+                stand_in.in_flight += 1
+                stand_in.max_in_flight = max(stand_in.max_in_flight, stand_in.in_flight)
+                fail = stand_in.fail_first > 0
+                stand_in.fail_first -= 1
+            try:
+                time.sleep(stand_in.delay)
+                if fail:
+                    self.send_error(503)
+                elif query.get('startDT', [None])[0] in stand_in.fail_start_dates:
+                    self.send_error(500)
+                elif url.path == "/nwis/iv/":
+                    self._send(json.dumps(stand_in.iv_response(query)), "application/json")
+                elif url.path == "/nwis/site/":
+                    self._send(stand_in.site_rdb, "text/plain")
+                else:
+                    self.send_error(404)
+            finally:
+                with stand_in.lock:
+                    stand_in.in_flight -= 1
+
+        def _send(self, body, content_type):
+            body = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stand_in.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield stand_in
+    server.shutdown()
+    server.server_close()
+
+
+def make_fetcher(nwis, **kwargs):
+    kwargs.setdefault('backoff_seconds', 0.01)
+    return AsyncNWISFetcher(iv_url=nwis.base_url + "/nwis/iv/", site_url=nwis.base_url + "/nwis/site/", **kwargs)
+
+
+# The recorded values as the saved discharge CSV has them
+def expected_discharge():
+    saved = pd.read_csv(os.path.join(TESTS_DIR, "USGS05125039", "USGS_Discharge_05125039.csv"))
+    saved['datetimeUTC'] = pd.to_datetime(saved['datetimeUTC'])
+    saved = saved.set_index('datetimeUTC')
+    return saved[(saved['qualifiers'] == 'A') & (saved.index >= '2014-05-01 05:00')
+                 & (saved.index < '2014-05-11 05:00')]
+
+
+def test_chunks_are_stitched_into_one_frame(nwis):
+    discharge = make_fetcher(nwis, chunk_days=3).discharge(SITE_NO, "2014-05-01", "2014-05-10")
+
+    assert len(nwis.requests) == 4
+    assert list(discharge.columns) == ['discharge_cfs', 'qualifiers']
+    assert discharge.index.is_monotonic_increasing and discharge.index.is_unique
+    recorded = discharge[discharge['qualifiers'] == 'A']
+    expected = expected_discharge()
+    pd.testing.assert_index_equal(recorded.index, expected.index, check_names=False)
+    assert (recorded['discharge_cfs'].to_numpy() == expected['discharge_cfs'].to_numpy()).all()
+
+
+def test_server_errors_are_retried(nwis):
+    nwis.fail_first = 2
+    discharge = make_fetcher(nwis, chunk_days=10, max_concurrency=1).discharge(SITE_NO, "2014-05-01", "2014-05-10")
+
+    assert len(nwis.requests) == 3
+    assert len(discharge[discharge['qualifiers'] == 'A']) == len(expected_discharge())
+
+
+def test_requests_in_flight_are_bounded(nwis):
+    nwis.delay = 0.05
+    make_fetcher(nwis, chunk_days=1, max_concurrency=2).discharge(SITE_NO, "2014-05-01", "2014-05-10")
+
+    assert len(nwis.requests) == 10
+    assert nwis.max_in_flight == 2
+
+
+def test_failed_run_resumes_from_saved_chunks(nwis, tmp_path):
+    partial_dir = str(tmp_path / "partial")
+    nwis.fail_start_dates = {"2014-05-07"}
+    with pytest.raises(Exception):
+        make_fetcher(nwis, chunk_days=3, max_retries=1, partial_dir=partial_dir).discharge(SITE_NO, "2014-05-01", "2014-05-10")
+    assert len(os.listdir(partial_dir)) == 3
+
+    nwis.fail_start_dates = set()
+    nwis.requests.clear()
+    discharge = make_fetcher(nwis, chunk_days=3, partial_dir=partial_dir).discharge(SITE_NO, "2014-05-01", "2014-05-10")
+
+    assert [query['startDT'][0] for _, query in nwis.requests] == ["2014-05-07"]
+    assert len(discharge[discharge['qualifiers'] == 'A']) == len(expected_discharge())
+    assert os.listdir(partial_dir) == []
+
+
+def test_dates_without_data_give_an_empty_frame(nwis):
+    discharge = make_fetcher(nwis).discharge(SITE_NO, "2020-01-01", "2020-01-31")
+    assert discharge.empty
+    assert list(discharge.columns) == ['discharge_cfs', 'qualifiers']
+
+
+def test_several_sites_share_one_run(nwis):
+    results = make_fetcher(nwis, chunk_days=5).discharge_many([SITE_NO, "00000000"], "2014-05-01", "2014-05-10")
+
+    assert len(results[SITE_NO][results[SITE_NO]['qualifiers'] == 'A']) == len(expected_discharge())
+    assert results["00000000"].empty
+
+
+def test_site_info(nwis):
+    site_info = make_fetcher(nwis).site_info(SITE_NO)
+    assert site_info.loc[0, 'site_no'] == SITE_NO
+    assert site_info.loc[0, 'station_nm'] == "KEELEY CREEK ABOVE MOUTH NEAR BABBITT, MN"
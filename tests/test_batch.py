@@ -0,0 +1,19 @@
+import pytest
+
+from app.batch import load_config, main, DEFAULT_CONFIG
+
+
+def write_config(tmp_path, text):
+    path = tmp_path / "params.toml"
+    path.write_text(text)
+    return str(path)
+
+
+def test_unknown_keys_are_rejected(tmp_path, capsys):
+    path = write_config(tmp_path, "sigma = 5.0\nprominance = 3\n")
+    with pytest.raises(ValueError, match="prominance"):
+        load_config(path)
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / "sites.txt"), "--config", path])
+    assert "Unknown parameters" in capsys.readouterr().err
+    assert load_config()['sigma'] == DEFAULT_CONFIG['sigma']
@@ -0,0 +1,281 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.interpolate import Akima1DInterpolator
+
+from conftest import FIXTURE_DIR, repeat_record, repeat_event
+from app.peak_detection import DetectAndSavePeaks, find_filtered_peaks
+from app.peak_index import PeakIndex
+from app.events import get_storm_hydrograph
+from app.normalization import events_on_grid, ragged_offsets
+from app.duh_bootstrap import bootstrap_duh_bands
+from app.regional import DuhShapeIndex
+from app.smoothing import (apply_gaussian_smoothing, create_dimensionless_unit_hydrograph, process_smoothed_files,
+                           interpolate_duh)
+
+# Benchmarks of the pipeline stages on the USGS05125039 fixture and on synthetic records made of
+# many copies of it (--scales, default 10x and 100x). Every benchmark also checks its output
+# against the committed CSVs, so a faster version that changes the results fails.
+#
+#   python -m pytest tests/test_benchmarks.py --benchmark-autosave       # save a baseline
+#   python -m pytest tests/test_benchmarks.py --benchmark-compare --benchmark-compare-fail=median:25%
+#
+# The parameters below are the ones the fixture was made with (see its nuhg_log.txt).
+
+SITE_NO = "05125039"
+PROMINENCE = 15.021432107414864
+MIN_PEAK_GAP_HOURS = 12
+SIGMA = 10.0
+# Event number: (peak date, samples kept before the peak, samples kept from the peak on)
+EVENTS = {
+    1: ("2015-07-14 17:45:00+00:00", 200, 1425),
+    2: ("2015-11-19 22:45:00+00:00", 384, 1442),
+}
+FIXTURE_FILTERED_PEAKS = 10
+COMMON_TIME_AXIS = np.arange(0, 10.001, 0.001)
+
+
+def read_fixture(name, **kwargs):
+    return pd.read_csv(os.path.join(FIXTURE_DIR, name), **kwargs)
+
+
+def read_event(name):
+    return read_fixture(name, parse_dates=['datetimeUTC'])
+
+
+def copy_duh_files(folder, copies=1):
+    for copy in range(copies):
+        for event_no in EVENTS:
+            shutil.copy(os.path.join(FIXTURE_DIR, f"DUH_Event_{event_no}.csv"),
+                        os.path.join(folder, f"DUH_Event_{copy * len(EVENTS) + event_no}.csv"))
+
+
+# Mean over events ignoring NaN, and NaN where no event has a value
+def mean_of_events(rows):
+    rows = np.asarray(rows)
+    with np.errstate(invalid='ignore'):
+        return np.nansum(rows, axis=0) / np.sum(~np.isnan(rows), axis=0)
+
+
+# Mean of the events' Akima interpolations, each NaN outside its own time span
+def expected_overall_duh(common_time_axis=COMMON_TIME_AXIS):
+    rows = []
+    for event_no in EVENTS:
+        duh = read_fixture(f"DUH_Event_{event_no}.csv").drop_duplicates('Normalized Time')
+        rows.append(Akima1DInterpolator(duh['Normalized Time'], duh['Normalized Discharge'])(common_time_axis,
+                                                                                               extrapolate=False))
+    return mean_of_events(rows)
+
+
+# Fixture-sized runs
+
+def test_detect_and_save_peaks(benchmark, tmp_path, fixture_discharge, no_figures):
+    filtered = benchmark(DetectAndSavePeaks, fixture_discharge, PROMINENCE, str(tmp_path), SITE_NO, MIN_PEAK_GAP_HOURS,
+                         by_year=True)
+
+    assert len(filtered) == FIXTURE_FILTERED_PEAKS
+    # The committed peaks file holds the two peaks that were kept from this result
+    committed = read_fixture(f"Peaks_{SITE_NO}_All_Years.csv", parse_dates=['Peak_Date'])
+    kept = filtered.set_index('Index').loc[committed['Index']]
+    assert (kept['Year'].to_numpy() == committed['Year'].to_numpy()).all()
+    assert (kept['Peak_Date'].to_numpy() == committed['Peak_Date'].to_numpy()).all()
+    np.testing.assert_array_equal(kept['discharge_cfs'].to_numpy(), committed['discharge_cfs'].to_numpy(dtype=np.float32))
+    assert os.path.exists(tmp_path / f"Peaks_{SITE_NO}_All_Years.csv")
+
+
+# A query of the prominence index gives the peaks of a full detection run at that prominence
+def test_prominence_index_query(benchmark, fixture_discharge):
+    index = PeakIndex(fixture_discharge)
+    all_peaks_df, filtered = benchmark(index.query, PROMINENCE, MIN_PEAK_GAP_HOURS)
+
+    assert len(filtered) == FIXTURE_FILTERED_PEAKS
+    for prominence_value in (0.5, 5.0, PROMINENCE, 100.0, 1e6):
+        expected_all, expected_filtered = find_filtered_peaks(fixture_discharge, prominence_value, MIN_PEAK_GAP_HOURS)
+        queried_all, queried_filtered = index.query(prominence_value, MIN_PEAK_GAP_HOURS)
+        pd.testing.assert_frame_equal(queried_all, expected_all)
+        pd.testing.assert_frame_equal(queried_filtered, expected_filtered)
+        assert index.peak_count(prominence_value) == len(expected_all)
+
+    curve = index.count_curve()
+    assert curve['Peaks'].is_monotonic_decreasing
+    assert curve['Peaks'].iloc[0] == len(index) and curve['Peaks'].iloc[-1] >= 1
+
+
+@pytest.mark.parametrize('event_no', sorted(EVENTS))
+def test_get_storm_hydrograph(benchmark, fixture_discharge, event_no):
+    peak_date, before, after = EVENTS[event_no]
+    storm_hydrograph = benchmark(get_storm_hydrograph, fixture_discharge, pd.Timestamp(peak_date), before, after)
+
+    expected = read_event(f"Event_{event_no}_2015.csv")
+    assert (storm_hydrograph.index == expected['datetimeUTC']).all()
+    np.testing.assert_array_equal(storm_hydrograph['discharge_cfs'].to_numpy(),
+                                  expected['discharge_cfs'].to_numpy(dtype=np.float32))
+    assert (storm_hydrograph['qualifiers'].astype(str).to_numpy() == expected['qualifiers'].to_numpy()).all()
+
+
+@pytest.mark.parametrize('event_no', sorted(EVENTS))
+def test_apply_gaussian_smoothing(benchmark, notifications, event_no):
+    event = read_event(f"Event_{event_no}_2015.csv")
+    smoothed, nse, peak_diff = benchmark(lambda: apply_gaussian_smoothing(event.copy(), SIGMA, show_plot=False,
+                                                                          notify=notifications))
+
+    expected = read_event(f"S_Event_{event_no}.csv")
+    np.testing.assert_allclose(smoothed['smoothed_discharge_cfs'], expected['smoothed_discharge_cfs'], rtol=1e-12)
+    assert 0.9 < nse <= 1
+    assert notifications.messages('error') == []
+
+
+@pytest.mark.parametrize('event_no', sorted(EVENTS))
+def test_create_dimensionless_unit_hydrograph(benchmark, notifications, event_no):
+    smoothed = read_event(f"S_Event_{event_no}.csv")
+    normalized_discharge, normalized_time = benchmark(
+        lambda: create_dimensionless_unit_hydrograph(smoothed.copy(), notify=notifications))
+
+    expected = read_fixture(f"DUH_Event_{event_no}.csv")
+    np.testing.assert_allclose(normalized_discharge, expected['Normalized Discharge'], rtol=1e-12, atol=1e-15)
+    np.testing.assert_allclose(normalized_time, expected['Normalized Time'], rtol=1e-12)
+    assert notifications.messages('error') == []
+
+
+def test_process_smoothed_files(benchmark, tmp_path, notifications):
+    copy_duh_files(tmp_path)
+    overall_duh_df, matrix = benchmark(process_smoothed_files, str(tmp_path), COMMON_TIME_AXIS, incremental=False,
+                                        notify=notifications, with_matrix=True)
+
+    committed = read_fixture("overall_duh.csv")
+    np.testing.assert_allclose(overall_duh_df['Normalized Time'], committed['Normalized Time'], rtol=1e-12)
+    np.testing.assert_allclose(overall_duh_df['Normalized Discharge'], expected_overall_duh(), atol=1e-6)
+    assert matrix.shape == (len(EVENTS), len(COMMON_TIME_AXIS))
+    assert notifications.messages('info')[-1] == f"Processed {len(EVENTS)} DUH_Event files."
+    assert notifications.messages('warning') == []
+
+
+# The committed overall_duh.csv was made before the DUH stack interpolated through every event
+# sample (it reindexed each event onto the grid first); the old method still reproduces it
+def test_committed_overall_duh_matches_grid_reindexing():
+    interpolated = [interpolate_duh(read_fixture(f"DUH_Event_{event_no}.csv"), COMMON_TIME_AXIS)
+                    ['Normalized Discharge'].to_numpy() for event_no in EVENTS]
+    np.testing.assert_allclose(mean_of_events(interpolated), read_fixture("overall_duh.csv")['Normalized Discharge'],
+                               atol=1e-12)
+
+
+# Synthetic records scaled up from the fixture
+
+def test_detect_and_save_peaks_scaled(benchmark, tmp_path, fixture_discharge, no_figures, scale):
+    discharge = repeat_record(fixture_discharge, scale)
+    filtered = benchmark.pedantic(DetectAndSavePeaks, args=(discharge, PROMINENCE, str(tmp_path), SITE_NO,
+                                                            MIN_PEAK_GAP_HOURS), rounds=3, iterations=1)
+
+    assert len(filtered) == FIXTURE_FILTERED_PEAKS * scale
+    last_copy = filtered[filtered['Peak_Date'] >= fixture_discharge.index[0]]
+    committed = read_fixture(f"Peaks_{SITE_NO}_All_Years.csv", parse_dates=['Peak_Date'])
+    assert set(committed['Peak_Date']) <= set(last_copy['Peak_Date'])
+
+
+def test_prominence_index_scaled(benchmark, fixture_discharge, scale):
+    discharge = repeat_record(fixture_discharge, scale)
+    index = benchmark.pedantic(PeakIndex, args=(discharge,), rounds=3, iterations=1)
+
+    _, filtered = index.query(PROMINENCE, MIN_PEAK_GAP_HOURS)
+    assert len(filtered) == FIXTURE_FILTERED_PEAKS * scale
+
+
+def test_get_storm_hydrograph_scaled(benchmark, fixture_discharge, scale):
+    discharge = repeat_record(fixture_discharge, scale)
+    peak_date, before, after = EVENTS[1]
+    storm_hydrograph = benchmark(get_storm_hydrograph, discharge, pd.Timestamp(peak_date), before, after)
+
+    expected = read_event("Event_1_2015.csv")
+    assert (storm_hydrograph.index == expected['datetimeUTC']).all()
+    np.testing.assert_array_equal(storm_hydrograph['discharge_cfs'].to_numpy(),
+                                  expected['discharge_cfs'].to_numpy(dtype=np.float32))
+
+
+def test_apply_gaussian_smoothing_scaled(benchmark, notifications, scale):
+    event = repeat_event(read_event("Event_1_2015.csv"), scale)
+    smoothed, nse, _ = benchmark.pedantic(
+        lambda: apply_gaussian_smoothing(event.copy(), SIGMA, show_plot=False, notify=notifications),
+        rounds=5, iterations=1)
+
+    # Away from the ends of each copy (4 sigma, scipy's kernel radius) the smoothing only sees that
+    # copy, so it matches the committed smoothed event there
+    expected = read_event("S_Event_1.csv")['smoothed_discharge_cfs'].to_numpy()
+    margin = int(4 * SIGMA)
+    copies = smoothed['smoothed_discharge_cfs'].to_numpy().reshape(scale, -1)
+    np.testing.assert_allclose(copies[:, margin:-margin], np.tile(expected[margin:-margin], (scale, 1)), rtol=1e-9)
+    assert np.isfinite(nse)
+    assert notifications.messages('error') == []
+
+
+def test_create_dimensionless_unit_hydrograph_scaled(benchmark, notifications, scale):
+    smoothed = repeat_event(read_event("S_Event_1.csv"), scale)
+    normalized_discharge, normalized_time = benchmark.pedantic(
+        lambda: create_dimensionless_unit_hydrograph(smoothed.copy(), notify=notifications), rounds=5, iterations=1)
+
+    # Same base flow, peak and time to peak as the single event
+    expected = read_fixture("DUH_Event_1.csv")
+    np.testing.assert_allclose(normalized_discharge, np.tile(expected['Normalized Discharge'], scale),
+                               rtol=1e-12, atol=1e-15)
+    np.testing.assert_allclose(normalized_time[:len(expected)], expected['Normalized Time'], rtol=1e-12)
+    assert notifications.messages('error') == []
+
+
+# Smoothed events straight to DUH rows on the grid, without the per-event files in between
+def test_events_on_grid_scaled(benchmark, scale):
+    events = [read_event(f"S_Event_{event_no}.csv") for event_no in EVENTS] * scale
+    offsets = ragged_offsets([len(event) for event in events])
+    times = np.concatenate([pd.DatetimeIndex(event['datetimeUTC']).asi8 for event in events])
+    discharge = np.concatenate([event['smoothed_discharge_cfs'].to_numpy() for event in events])
+    matrix, stats = benchmark.pedantic(events_on_grid, args=(offsets, times, discharge, COMMON_TIME_AXIS), rounds=3,
+                                       iterations=1)
+
+    assert stats['On Grid'].all()
+    np.testing.assert_allclose(mean_of_events(matrix.astype(np.float64)), expected_overall_duh(), atol=1e-6)
+
+
+def test_process_smoothed_files_scaled(benchmark, tmp_path, notifications, scale):
+    copy_duh_files(tmp_path, scale)
+    overall_duh_df, matrix = benchmark.pedantic(process_smoothed_files, args=(str(tmp_path),),
+                                                kwargs=dict(incremental=False, notify=notifications, with_matrix=True),
+                                                rounds=3, iterations=1)
+
+    # Repeating every event the same number of times leaves the mean unchanged
+    grid = overall_duh_df['Normalized Time'].to_numpy()
+    np.testing.assert_allclose(overall_duh_df['Normalized Discharge'], expected_overall_duh(grid), atol=1e-6)
+    assert matrix.shape == (len(EVENTS) * scale, len(grid))
+    assert overall_duh_df['Event Count'].max() == len(EVENTS) * scale
+
+
+# 1,000 bootstrap replicates of the overall DUH of `scale` copies of the fixture events
+def test_bootstrap_duh_bands_scaled(benchmark, tmp_path, scale):
+    copy_duh_files(tmp_path, scale)
+    overall_duh_df, matrix = process_smoothed_files(str(tmp_path), incremental=False, with_matrix=True)
+    grid = overall_duh_df['Normalized Time'].to_numpy()
+    bands = benchmark.pedantic(bootstrap_duh_bands, args=(matrix, grid), rounds=3, iterations=1)
+
+    np.testing.assert_allclose(bands['Normalized Discharge'], overall_duh_df['Normalized Discharge'], atol=1e-9)
+    covered = overall_duh_df['Event Count'].to_numpy() > 0
+    assert (bands['Bootstrap P05 Normalized Discharge'][covered] <= bands['Normalized Discharge'][covered] + 1e-9).all()
+    assert (bands['Bootstrap P95 Normalized Discharge'][covered] >= bands['Normalized Discharge'][covered] - 1e-9).all()
+
+
+# Shape index and k-means of 100 * scale sites, each the fixture's overall DUH stretched in time
+def test_duh_shape_index_scaled(benchmark, scale):
+    committed = read_fixture("overall_duh.csv")
+    stretch = np.linspace(0.5, 2.0, 100 * scale)
+    sites = [f"{site:08d}" for site in range(len(stretch))]
+    grids = [committed['Normalized Time'].to_numpy() * factor for factor in stretch]
+    curves = [committed['Normalized Discharge'].to_numpy()] * len(stretch)
+
+    def build_and_cluster():
+        index = DuhShapeIndex.from_curves(sites, grids, curves)
+        return index, index.cluster(4)
+
+    index, labels = benchmark.pedantic(build_and_cluster, rounds=3, iterations=1)
+    assert len(index) == len(sites)
+    np.testing.assert_allclose(index.to_frame()['Peak Time'], stretch * index.to_frame()['Peak Time'].iloc[0] / stretch[0],
+                               rtol=0.02)
+    assert len(set(labels)) == 4
@@ -0,0 +1,93 @@
+import os
+import json
+
+import pandas as pd
+import pytest
+
+from conftest import FIXTURE_DIR
+from app.cache import CachedFetcher, missing_intervals, COVERAGE_FILE
+from app.fetchers import LocalFetcher
+
+SITE_NO = "05125039"
+
+
+# LocalFetcher over the fixture that records the date ranges it is asked for; tz gives the index
+# another UTC offset, like a source that reports local time
+class CountingFetcher(LocalFetcher):
+    def __init__(self, tz=None):
+        super().__init__(FIXTURE_DIR)
+        self.calls = []
+        self.tz = tz
+
+    def discharge(self, site_no, begin_date, end_date, log=None):
+        self.calls.append((str(begin_date), str(end_date)))
+        discharge = super().discharge(site_no, begin_date, end_date, log)
+        return discharge.tz_convert(self.tz) if self.tz is not None else discharge
+
+
+def expected(begin_date, end_date):
+    return LocalFetcher(FIXTURE_DIR).discharge(SITE_NO, begin_date, end_date)
+
+
+def assert_same_discharge(cached, begin_date, end_date):
+    direct = expected(begin_date, end_date)
+    assert not direct.empty
+    pd.testing.assert_frame_equal(cached.tz_convert('UTC'), direct, check_freq=False)
+
+
+def test_missing_intervals():
+    day = pd.Timestamp
+    covered = [(day("2014-06-01"), day("2014-06-30")), (day("2014-08-01"), day("2014-08-31"))]
+    assert missing_intervals(covered, day("2014-06-10"), day("2014-06-20")) == []
+    assert missing_intervals(covered, day("2014-05-25"), day("2014-09-03")) == [
+        (day("2014-05-25"), day("2014-05-31")), (day("2014-07-01"), day("2014-07-31")),
+        (day("2014-09-01"), day("2014-09-03"))]
+    assert missing_intervals([], day("2014-06-01"), day("2014-06-01")) == [(day("2014-06-01"), day("2014-06-01"))]
+
+
+def test_cold_then_warm_fetch(tmp_path):
+    source = CountingFetcher()
+    fetcher = CachedFetcher(source, str(tmp_path))
+
+    assert_same_discharge(fetcher.discharge(SITE_NO, "2014-06-01", "2014-06-30"), "2014-06-01", "2014-06-30")
+    assert source.calls == [("2014-06-01", "2014-06-30")]
+    assert os.path.exists(tmp_path / SITE_NO / "2014.parquet")
+    with open(tmp_path / SITE_NO / COVERAGE_FILE) as f:
+        assert json.load(f) == [["2014-06-01", "2014-06-30"]]
+
+    # The same range and any range inside it are answered from the cache
+    assert_same_discharge(fetcher.discharge(SITE_NO, "2014-06-01", "2014-06-30"), "2014-06-01", "2014-06-30")
+    assert_same_discharge(fetcher.discharge(SITE_NO, "2014-06-10", "2014-06-12"), "2014-06-10", "2014-06-12")
+    assert len(source.calls) == 1
+
+    # A new fetcher over the same folder uses the saved cache
+    assert_same_discharge(CachedFetcher(source, str(tmp_path)).discharge(SITE_NO, "2014-06-05", "2014-06-25"),
+                          "2014-06-05", "2014-06-25")
+    assert len(source.calls) == 1
+
+
+def test_overlapping_range_fetches_only_the_gap(tmp_path):
+    source = CountingFetcher()
+    fetcher = CachedFetcher(source, str(tmp_path))
+    fetcher.discharge(SITE_NO, "2014-06-01", "2014-06-30")
+
+    assert_same_discharge(fetcher.discharge(SITE_NO, "2014-05-20", "2014-07-15"), "2014-05-20", "2014-07-15")
+    assert source.calls[1:] == [("2014-05-20", "2014-05-31"), ("2014-07-01", "2014-07-15")]
+    with open(tmp_path / SITE_NO / COVERAGE_FILE) as f:
+        assert json.load(f) == [["2014-05-20", "2014-07-15"]]
+
+
+# A range across New Year is kept in two year files and read back whole; days are UTC days also
+# when the source reports another offset
+@pytest.mark.parametrize('tz', [None, 'America/Chicago', 'Asia/Tokyo'])
+def test_year_boundary_and_utc_offset(tmp_path, tz):
+    source = CountingFetcher(tz)
+    fetcher = CachedFetcher(source, str(tmp_path))
+
+    assert_same_discharge(fetcher.discharge(SITE_NO, "2014-12-20", "2015-01-10"), "2014-12-20", "2015-01-10")
+    assert os.path.exists(tmp_path / SITE_NO / "2014.parquet") and os.path.exists(tmp_path / SITE_NO / "2015.parquet")
+
+    for begin_date, end_date in (("2014-12-31", "2014-12-31"), ("2015-01-01", "2015-01-01"),
+                                 ("2014-12-31", "2015-01-01")):
+        assert_same_discharge(fetcher.discharge(SITE_NO, begin_date, end_date), begin_date, end_date)
+    assert len(source.calls) == 1
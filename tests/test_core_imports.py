@@ -0,0 +1,34 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The compute modules and the batch runner only need NumPy, pandas and SciPy at import time;
+# the UI and plotting libraries are imported when something is drawn or downloaded
+CORE_MODULES = ['app.data_io', 'app.peak_detection', 'app.smoothing', 'app.plotting', 'app.event_batch',
+                'app.sigma_sweep', 'app.site_store', 'app.fetchers', 'app.async_fetcher', 'app.duh_bootstrap', 'app.regional',
+                'app.jobs', 'app.batch']
+UI_PACKAGES = ['streamlit', 'plotly', 'matplotlib', 'hydrofunctions']
+
+
+# Import in a fresh interpreter and report which of the given packages ended up loaded
+def loaded_after_import(modules, packages):
+    code = (f"import sys, json, importlib\n"
+            f"for module in {modules!r}: importlib.import_module(module)\n"
+            f"print(json.dumps([p for p in {packages!r} if p in sys.modules]))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_core_modules_do_not_import_ui_packages():
+    assert loaded_after_import(CORE_MODULES, UI_PACKAGES) == []
+
+
+def test_chart_layer_imports_ui_packages():
+    pytest.importorskip('streamlit')
+    pytest.importorskip('plotly')
+    assert loaded_after_import(['app.charts'], ['streamlit', 'plotly']) == ['streamlit', 'plotly']
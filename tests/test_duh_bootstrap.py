@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import FIXTURE_DIR
+from app.duh_bootstrap import bootstrap_duh_bands, column_percentiles
+from app.duh_stack import load_duh_events, stack_duhs
+from app.site_store import SiteStore, save_duh_bands, BANDS_FILE
+from app.time_grid import TimeGrid
+
+
+# Fixture DUHs stretched in time by different amounts, so the events disagree and cover different
+# parts of the grid
+def stretched_events(copies=20):
+    events = load_duh_events(FIXTURE_DIR)
+    return [(f"DUH_Event_{copy * 2 + row + 1}", time * (0.7 + 0.03 * copy), discharge)
+            for copy in range(copies) for row, (_, time, discharge) in enumerate(events)]
+
+
+def test_column_percentiles_match_nanpercentile():
+    rng = np.random.default_rng(3)
+    values = rng.normal(size=(40, 200))
+    values[rng.random(values.shape) < 0.3] = np.nan
+    values[:, 7] = np.nan
+    values[1:, 8] = np.nan
+
+    with pytest.warns(RuntimeWarning):
+        expected = np.nanpercentile(values, [5, 50, 95], axis=0)
+    np.testing.assert_allclose(column_percentiles(values, [5, 50, 95]), expected, rtol=1e-12, equal_nan=True)
+
+
+# Same resamples drawn one replicate at a time
+def test_bands_match_resampling_event_by_event():
+    events = stretched_events()
+    grid = TimeGrid().axis_for(events)
+    matrix, _ = stack_duhs(events, grid)
+    bands = bootstrap_duh_bands(matrix, grid, replicates=200, seed=7)
+
+    draws = np.random.default_rng(7).multinomial(len(matrix), np.full(len(matrix), 1 / len(matrix)), size=200)
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        means = np.array([np.nanmean(np.repeat(matrix, counts, axis=0).astype(np.float64), axis=0)
+                          for counts in draws])
+        expected = np.nanpercentile(means, [5, 95], axis=0)
+    np.testing.assert_allclose(bands['Bootstrap P05 Normalized Discharge'], expected[0], atol=1e-9, equal_nan=True)
+    np.testing.assert_allclose(bands['Bootstrap P95 Normalized Discharge'], expected[1], atol=1e-9, equal_nan=True)
+
+    covered = ~np.isnan(bands['Normalized Discharge'])
+    assert (bands['Bootstrap P05 Normalized Discharge'][covered] <= bands['Normalized Discharge'][covered] + 1e-9).all()
+    assert (bands['Bootstrap P95 Normalized Discharge'][covered] >= bands['Normalized Discharge'][covered] - 1e-9).all()
+    pd.testing.assert_frame_equal(bands, bootstrap_duh_bands(matrix, grid, replicates=200, seed=7))
+
+
+def test_one_event_has_no_spread():
+    events = load_duh_events(FIXTURE_DIR)[:1]
+    grid = TimeGrid().axis_for(events)
+    matrix, _ = stack_duhs(events, grid)
+    bands = bootstrap_duh_bands(matrix, grid)
+
+    np.testing.assert_allclose(bands['Bootstrap P05 Normalized Discharge'], matrix[0], atol=1e-7, equal_nan=True)
+    np.testing.assert_allclose(bands['Bootstrap P95 Normalized Discharge'], matrix[0], atol=1e-7, equal_nan=True)
+
+
+@pytest.mark.parametrize('storage', ['csv', 'store'])
+def test_bands_are_saved_next_to_the_overall_duh(tmp_path, storage):
+    events = stretched_events(2)
+    grid = TimeGrid().axis_for(events)
+    bands = bootstrap_duh_bands(stack_duhs(events, grid)[0], grid, replicates=50)
+    save_duh_bands(str(tmp_path), bands, storage)
+
+    if storage == 'store':
+        assert SiteStore(str(tmp_path)).export_csv("05125039") == [BANDS_FILE]
+    saved = pd.read_csv(tmp_path / BANDS_FILE)
+    assert saved.columns.tolist() == bands.columns.tolist()
+    np.testing.assert_array_equal(saved['Normalized Time'], grid)
+    np.testing.assert_allclose(saved['Bootstrap P95 Normalized Discharge'], bands['Bootstrap P95 Normalized Discharge'],
+                               rtol=1e-6)
@@ -0,0 +1,50 @@
+import os
+import time
+
+import app.helpers as helpers
+from app.helpers import log_progress, flush_logs, run_in_background, wait_for_background_task
+
+
+def read_log(folder):
+    with open(os.path.join(folder, "nuhg_log.txt")) as f:
+        return f.read()
+
+
+# Buffered lines reach the file on a timer, idle files are closed and only a few stay open
+def test_logs_are_flushed_and_closed_without_further_messages(tmp_path, monkeypatch):
+    monkeypatch.setattr(helpers, 'LOG_FLUSH_SECONDS', 0.05)
+    monkeypatch.setattr(helpers, 'LOG_IDLE_SECONDS', 0.2)
+    monkeypatch.setattr(helpers, 'MAX_OPEN_LOGS', 2)
+    flush_logs()
+    folders = [str(tmp_path / name) for name in "abc"]
+    for folder in folders:
+        os.makedirs(folder)
+        log_progress(folder, f"Message for {os.path.basename(folder)}")
+    assert len(helpers._log_writer.files) == 2
+
+    deadline = time.monotonic() + 5
+    while helpers._log_writer.files and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not helpers._log_writer.files
+    for folder in folders:
+        assert f"Message for {os.path.basename(folder)}" in read_log(folder)
+
+    # A closed log is opened again for the next message
+    log_progress(folders[0], "Second message")
+    flush_logs()
+    assert read_log(folders[0]).splitlines()[-1].endswith("Second message")
+
+
+# A failed side output is logged and reported, not raised in the caller
+def test_waiting_on_a_failed_background_task(tmp_path):
+    def fail():
+        raise OSError("disk full")
+
+    assert wait_for_background_task(run_in_background(str(tmp_path), "discharge CSV", lambda: None))
+    assert not wait_for_background_task(run_in_background(str(tmp_path), "discharge CSV", fail))
+    assert wait_for_background_task(None)
+    deadline = time.monotonic() + 5
+    while "disk full" not in (read_log(tmp_path) if os.path.exists(tmp_path / "nuhg_log.txt") else "") \
+            and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert "Background task failed (discharge CSV): disk full" in read_log(tmp_path)
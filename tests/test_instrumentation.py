@@ -0,0 +1,20 @@
+import gc
+import tracemalloc
+
+from app.instrumentation import TimingReport, set_memory_tracking
+
+
+# Tracing runs while any session's report asks for it
+def test_memory_tracking_is_shared_by_sessions():
+    assert not tracemalloc.is_tracing()
+    first, second = TimingReport("first"), TimingReport("second")
+    set_memory_tracking(True, first)
+    set_memory_tracking(True, second)
+    set_memory_tracking(False, first)
+    assert tracemalloc.is_tracing()
+
+    # A session that is gone no longer keeps it on
+    del second
+    gc.collect()
+    set_memory_tracking(False, first)
+    assert not tracemalloc.is_tracing()
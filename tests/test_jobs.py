@@ -0,0 +1,207 @@
+import os
+import shutil
+import sqlite3
+import threading
+
+import pandas as pd
+import pytest
+
+from conftest import FIXTURE_DIR
+from app.fetchers import LocalFetcher
+from app.jobs import JobQueue, InlineJob, JOBS_FILE, download_task, detect_peaks_task, overall_duh_task
+from app.site_store import BANDS_FILE
+from app.data_io import discharge_signature
+from app.helpers import wait_for_background_task
+
+SITE_NO = "05125039"
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / JOBS_FILE), max_workers=4)
+    yield queue
+    queue.shutdown()
+
+
+def reporting_task(job, steps):
+    for step in range(1, steps + 1):
+        job.progress(step, steps, f"Step {step}")
+        job.partial('step', step)
+    job.notify('success', f"Did {steps} steps")
+    return steps * 10
+
+
+def failing_task(job):
+    job.notify('warning', "About to fail")
+    raise ValueError("no streamflow columns")
+
+
+def test_job_rows_messages_and_result(queue):
+    job_id = queue.submit("session-a", 'count', reporting_task, 3, label="Count to 3")
+    row = queue.wait(job_id, timeout=10)
+
+    assert row['status'] == 'done' and row['progress'] == 1.0
+    assert (row['session'], row['kind'], row['label']) == ("session-a", 'count', "Count to 3")
+    assert row['message'] == "Step 3" and row['started'] <= row['finished']
+    assert [message[1:] for message in queue.messages(job_id)] == [('success', "Did 3 steps")]
+    assert queue.partials(job_id) == {'step': 3}
+    assert [job['id'] for job in queue.unclaimed("session-a")] == [job_id]
+    assert queue.unclaimed("session-b") == []
+
+    # A result is handed over once
+    assert queue.claim(job_id) == 30
+    assert queue.claim(job_id) is None
+    assert queue.unclaimed("session-a") == [] and queue.partials(job_id) == {}
+
+    # The table is readable from another connection, e.g. another server process
+    with sqlite3.connect(queue.db_path) as db:
+        assert db.execute("SELECT status, claimed FROM jobs WHERE id = ?", (job_id,)).fetchone() == ('done', 1)
+
+
+def test_failures_are_recorded(queue):
+    job_id = queue.submit("session-a", 'fail', failing_task)
+    row = queue.wait(job_id, timeout=10)
+
+    assert row['status'] == 'failed'
+    assert row['error'] == "ValueError: no streamflow columns"
+    assert [message[1:] for message in queue.messages(job_id)] == [('warning', "About to fail")]
+    assert queue.claim(job_id) is None
+
+
+# Two sites run at the same time; jobs of one site run in the order they were submitted
+def test_sites_run_concurrently_and_in_order(queue):
+    both_running = threading.Barrier(2, timeout=10)
+    order = []
+
+    def site_job(job, name, meet):
+        if meet:
+            both_running.wait()
+        order.append(name)
+        return name
+
+    first = queue.submit("session-a", 'site', site_job, "a1", True, site_key="USGS1")
+    waiting = queue.submit("session-a", 'site', site_job, "a2", False, site_key="USGS1")
+    other = queue.submit("session-b", 'site', site_job, "b1", True, site_key="USGS2")
+
+    for job_id in (first, waiting, other):
+        assert queue.wait(job_id, timeout=10)['status'] == 'done'
+    assert order.index("a1") < order.index("a2")
+    assert [queue.claim(job_id) for job_id in (first, waiting, other)] == ["a1", "a2", "b1"]
+
+
+def test_cancel_a_queued_job(queue):
+    release = threading.Event()
+    running = queue.submit("session-a", 'block', lambda job: release.wait(10), site_key="USGS1")
+    queued = queue.submit("session-a", 'count', reporting_task, 2, site_key="USGS1")
+    assert queue.job(queued)['message'] == "Waiting for another job on this site"
+
+    assert queue.cancel(queued)
+    release.set()
+    assert queue.wait(running, timeout=10)['status'] == 'done'
+    assert queue.wait(queued, timeout=10)['status'] == 'cancelled'
+    assert not queue.cancel(running)
+    assert queue.partials(queued) == {}
+
+
+def test_jobs_of_a_stopped_server_are_failed(tmp_path):
+    path = str(tmp_path / JOBS_FILE)
+    first = JobQueue(path)
+    release = threading.Event()
+    job_id = first.submit("session-a", 'block', lambda job: release.wait(10))
+
+    restarted = JobQueue(path)
+    assert restarted.job(job_id)['status'] == 'failed'
+    assert restarted.jobs("session-a")[0]['id'] == job_id
+    release.set()
+    first.shutdown()
+    restarted.shutdown()
+
+
+# Download, peak detection and the overall DUH of the fixture site as jobs, with the results the app keeps
+def test_app_tasks(queue, tmp_path, no_figures):
+    output_folder = str(tmp_path / "out")
+    download = queue.submit("session-a", 'download', download_task, SITE_NO, "2014-01-01", "2014-12-31",
+                            output_folder, list(range(1, 13)), fetcher=LocalFetcher(FIXTURE_DIR),
+                            site_key=SITE_NO)
+    row = queue.wait(download, timeout=60)
+    assert row['status'] == 'done' and row['message'] == "Downloaded 1 of 1 date slices"
+    discharge_filtered, USGS_data, discharge_key, discharge_written = queue.claim(download)
+    assert wait_for_background_task(discharge_written)
+    assert os.path.exists(os.path.join(USGS_data, f"USGS_Discharge_{SITE_NO}.csv"))
+    assert USGS_data == os.path.join(output_folder, f"USGS{SITE_NO}")
+    assert discharge_key == (SITE_NO, "2014-01-01", "2014-12-31", tuple(range(1, 13)),
+                             discharge_signature(discharge_filtered))
+    # A new download of the same range with one revised value is a different key
+    revised = discharge_filtered.copy()
+    assert discharge_signature(revised) == discharge_key[-1]
+    revised.iloc[-1, revised.columns.get_loc('discharge_cfs')] += 1
+    assert discharge_signature(revised) != discharge_key[-1]
+    assert not discharge_filtered.empty
+
+    peaks = queue.submit("session-a", 'peaks', detect_peaks_task, discharge_filtered,
+                         float(discharge_filtered['discharge_cfs'].std()), USGS_data, SITE_NO, 12, site_key=SITE_NO)
+    assert queue.wait(peaks, timeout=60)['status'] == 'done'
+    partial_peaks = queue.partials(peaks)['peaks']
+    peaks_df = queue.claim(peaks)
+    pd.testing.assert_frame_equal(peaks_df, partial_peaks)
+    assert os.path.exists(os.path.join(USGS_data, f"Peaks_{SITE_NO}_All_Years.csv"))
+
+    # The fixture's saved DUH events stand in for the processed events
+    duh_folder = tmp_path / "duhs"
+    duh_folder.mkdir()
+    for name in os.listdir(FIXTURE_DIR):
+        if name.startswith("DUH_Event_"):
+            shutil.copy(os.path.join(FIXTURE_DIR, name), duh_folder / name)
+    duh = queue.submit("session-a", 'duh', overall_duh_task, str(duh_folder))
+    assert queue.wait(duh, timeout=60)['status'] == 'done'
+    overall_duh_df, matrix, bands = queue.claim(duh)
+    assert len(matrix) == len([name for name in os.listdir(duh_folder) if name.startswith("DUH_Event_")])
+    assert bands['Normalized Time'].tolist() == overall_duh_df['Normalized Time'].tolist()
+    assert os.path.exists(duh_folder / "overall_duh.csv") and os.path.exists(duh_folder / BANDS_FILE)
+
+
+def test_inline_job_passes_messages_on(tmp_path, notifications):
+    overall_duh_df, matrix, bands = overall_duh_task(InlineJob(notifications), str(tmp_path))
+    assert overall_duh_df.empty and bands is None
+    assert notifications.calls
+
+
+# The fetcher a download job makes for parallel requests is closed, also when the download fails;
+# the job's log lines are on disk when it finishes
+def test_download_closes_its_fetcher_and_writes_the_log(queue, tmp_path, monkeypatch, no_figures):
+    import app.async_fetcher
+    made = []
+
+    class ClosingFetcher(LocalFetcher):
+        def __init__(self, max_concurrency, partial_dir):
+            super().__init__(FIXTURE_DIR)
+            self.closed = False
+            made.append(self)
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(app.async_fetcher, 'AsyncNWISFetcher', ClosingFetcher)
+    output_folder = str(tmp_path / "out")
+    for site_no, status in ((SITE_NO, 'done'), ("00000000", 'failed')):
+        job_id = queue.submit("session-a", 'download', download_task, site_no, "2014-01-01", "2014-12-31",
+                              output_folder, list(range(1, 13)), parallel_requests=4)
+        assert queue.wait(job_id, timeout=60)['status'] == status
+    assert [fetcher.closed for fetcher in made] == [True, True]
+    with open(os.path.join(output_folder, f"USGS{SITE_NO}", "nuhg_log.txt")) as f:
+        assert f"Started data download for site {SITE_NO}" in f.read()
+
+
+# Figures deferred by one session's job are held by that session only; the process default is not touched
+def test_deferred_figures_belong_to_the_session(queue, tmp_path, no_figures, fixture_discharge):
+    from app.rendering import Figures, get_render_mode
+    mine, other = Figures('defer'), Figures('defer')
+    job_id = queue.submit("session-a", 'peaks', detect_peaks_task, fixture_discharge,
+                          float(fixture_discharge['discharge_cfs'].std()), str(tmp_path), SITE_NO, 12, figures=mine)
+    assert queue.wait(job_id, timeout=60)['status'] == 'done'
+
+    deferred = mine.deferred_figures()
+    assert deferred and other.deferred_figures() == []
+    assert get_render_mode() == 'off' and not any(os.path.exists(path) for path in deferred)
+    assert other.render_deferred() == [] and len(mine.render_deferred()) == len(deferred)
+    assert all(os.path.exists(path) for path in deferred) and mine.deferred_figures() == []
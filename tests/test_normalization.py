@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import FIXTURE_DIR
+from app.normalization import normalize_events, akima_on_grid, events_on_grid, ragged_offsets
+from app.duh_stack import interpolate_event
+from app.smoothing import apply_gaussian_smoothing, create_dimensionless_unit_hydrograph, process_smoothed_files
+from app.event_batch import smooth_and_normalize, process_all_events
+from app.site_store import list_events, load_event
+
+COMMON_TIME_AXIS = np.arange(0, 10.001, 0.001)
+
+
+# Ragged events covering the awkward cases: two samples, repeated and unsorted times, NaN samples,
+# a plateau that leaves Akima's slope undefined, an event too short to interpolate, an empty one
+def awkward_events():
+    rng = np.random.default_rng(0)
+    events = []
+    for size in (2, 3, 5, 50, 1, 0, 400, 3):
+        time = np.sort(rng.uniform(0, 12, size))
+        discharge = rng.uniform(0, 1, size)
+        if size > 3:
+            time[3] = time[2]
+        if size > 10:
+            time[5:7] = np.nan
+            time[20:30] = time[20:30][::-1]
+        events.append((time, discharge))
+    events.append((np.arange(7.0), np.array([0, 0, 0, 1, 1, 1, 1.0])))
+    return events
+
+
+def read_smoothed_events():
+    return [pd.read_csv(f"{FIXTURE_DIR}/S_Event_{event_no}.csv", parse_dates=['datetimeUTC']) for event_no in (1, 2)]
+
+
+def test_akima_on_grid_matches_scipy_event_by_event():
+    events = awkward_events()
+    offsets = ragged_offsets([len(time) for time, _ in events])
+    matrix, usable = akima_on_grid(offsets, np.concatenate([time for time, _ in events]),
+                                   np.concatenate([discharge for _, discharge in events]), COMMON_TIME_AXIS)
+
+    for row, (time, discharge) in enumerate(events):
+        expected = interpolate_event(time, discharge, COMMON_TIME_AXIS) if len(time) else None
+        assert usable[row] == (expected is not None)
+        if expected is None:
+            assert np.isnan(matrix[row]).all()
+        else:
+            np.testing.assert_array_equal(matrix[row], expected.astype(np.float32))
+
+
+def test_normalize_events_matches_single_event_normalization():
+    events = read_smoothed_events()
+    offsets = ragged_offsets([len(event) for event in events])
+    times = np.concatenate([pd.DatetimeIndex(event['datetimeUTC']).asi8 for event in events])
+    discharge = np.concatenate([event['smoothed_discharge_cfs'].to_numpy() for event in events])
+    normalized_discharge, normalized_time, stats = normalize_events(offsets, times, discharge)
+
+    assert stats['Has DUH'].all()
+    for event_no, event in enumerate(events):
+        expected = pd.read_csv(f"{FIXTURE_DIR}/DUH_Event_{event_no + 1}.csv")
+        span = slice(offsets[event_no], offsets[event_no + 1])
+        np.testing.assert_allclose(normalized_discharge[span], expected['Normalized Discharge'], rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(normalized_time[span], expected['Normalized Time'], rtol=1e-12)
+
+
+@pytest.mark.parametrize('method, baseflow_slope', [('first', None), ('linear', None), ('constant_slope', 0.5)])
+def test_baseflow_methods(method, baseflow_slope):
+    # Hourly samples: flat at 10, a storm peaking at 40 after 3 hours, a recession to 16
+    times = np.arange(7) * 3600 * 10**9
+    discharge = np.array([10, 20, 35, 40, 30, 20, 16.0])
+    normalized_discharge, normalized_time, stats = normalize_events([0, 7], times, discharge, method,
+                                                                    baseflow_slope)
+
+    base = {'first': np.full(7, 10.0), 'linear': 10 + np.arange(7.0), 'constant_slope': 10 + 0.5 * np.arange(7.0)}[method]
+    storm = np.maximum(discharge - base, 0)
+    np.testing.assert_allclose(normalized_discharge, storm / storm.max())
+    np.testing.assert_allclose(normalized_time, np.arange(7) / 3)
+    assert stats['Time to Peak (hours)'].iloc[0] == 3
+    assert stats['Peak Storm Flow'].iloc[0] == storm.max()
+
+    normalized, _ = create_dimensionless_unit_hydrograph(
+        pd.DataFrame({'datetimeUTC': pd.to_datetime(times, utc=True), 'smoothed_discharge_cfs': discharge}),
+        baseflow=method, baseflow_slope=baseflow_slope)
+    np.testing.assert_allclose(normalized, normalized_discharge)
+
+
+def test_constant_slope_needs_a_slope():
+    with pytest.raises(ValueError):
+        normalize_events([0, 3], np.arange(3), np.ones(3), 'constant_slope')
+
+
+def test_events_on_grid_skips_events_without_a_duh():
+    events = read_smoothed_events()
+    flat = pd.DataFrame({'datetimeUTC': events[0]['datetimeUTC'], 'smoothed_discharge_cfs': 5.0})
+    events = [events[0], flat, events[1]]
+    offsets = ragged_offsets([len(event) for event in events])
+    matrix, stats = events_on_grid(offsets,
+                                   np.concatenate([pd.DatetimeIndex(event['datetimeUTC']).asi8 for event in events]),
+                                   np.concatenate([event['smoothed_discharge_cfs'].to_numpy() for event in events]),
+                                   COMMON_TIME_AXIS)
+
+    assert stats['Has DUH'].tolist() == [True, False, True]
+    assert stats['On Grid'].tolist() == [True, False, True]
+    assert np.isnan(matrix[1]).all()
+    for row, event_no in ((0, 1), (2, 2)):
+        expected = pd.read_csv(f"{FIXTURE_DIR}/DUH_Event_{event_no}.csv")
+        np.testing.assert_allclose(matrix[row], interpolate_event(expected['Normalized Time'].to_numpy(),
+                                                                  expected['Normalized Discharge'].to_numpy(),
+                                                                  COMMON_TIME_AXIS), atol=1e-6)
+
+
+def test_smooth_and_normalize_uses_the_baseflow_method():
+    times = np.arange(400) * 900 * 10**9
+    discharge = (10 + np.arange(400) * 0.05 + 50 * np.exp(-((np.arange(400) - 100) / 20.0) ** 2)).astype(np.float32)
+    _, first, _, _, _ = smooth_and_normalize(discharge, times, np.array([0]), np.array([400]), 2.0)
+    _, linear, _, _, stats = smooth_and_normalize(discharge, times, np.array([0]), np.array([400]), 2.0, 'linear')
+
+    # A rising baseflow keeps the end of the first-sample DUH well above zero; the linear one returns to it
+    assert first[-1] > 0.3
+    assert linear[-1] == pytest.approx(0, abs=1e-9)
+    assert bool(stats['Has DUH'].iloc[0])
+
+
+# An event that never rises above its baseflow leaves no samples to interpolate
+def test_events_without_samples_give_empty_rows(tmp_path):
+    times = np.arange(4) * 900 * 10**9
+    matrix, stats = events_on_grid([0, 4], times, np.array([3.0, 2.0, 1.0, 1.0]), COMMON_TIME_AXIS)
+    assert not stats['Has DUH'].any()
+    assert matrix.shape == (1, len(COMMON_TIME_AXIS)) and np.isnan(matrix).all()
+
+    matrix, usable = akima_on_grid([0, 0], np.empty(0), np.empty(0), COMMON_TIME_AXIS)
+    assert matrix.shape == (1, len(COMMON_TIME_AXIS)) and not usable.any()
+
+    # DUH files of flat events, as the app wrote them, are all NaN
+    for event_no in (1, 2):
+        pd.DataFrame({'Normalized Time': [np.nan] * 3, 'Normalized Discharge': [np.nan] * 3}
+                     ).to_csv(tmp_path / f"DUH_Event_{event_no}.csv", index=False)
+    overall_duh_df, matrix = process_smoothed_files(str(tmp_path), COMMON_TIME_AXIS, incremental=False,
+                                                    with_matrix=True)
+    assert overall_duh_df.empty and len(matrix) == 0
+
+
+# The batch pass over all events gives the files of the app's one-event-at-a-time path: the event
+# read back from its CSV, smoothed by apply_gaussian_smoothing and normalized by
+# create_dimensionless_unit_hydrograph
+def test_process_all_events_matches_the_single_event_path(tmp_path, fixture_discharge):
+    peaks_df = pd.read_csv(os.path.join(FIXTURE_DIR, "Peaks_05125039_All_Years.csv"), parse_dates=['Peak_Date'])
+    summary = process_all_events(fixture_discharge, peaks_df, str(tmp_path), 10.0, hours_before=50, hours_after=50)
+    assert summary['Processed'].all()
+
+    for event_name, (_, row) in zip(list_events(str(tmp_path)), summary.iterrows()):
+        event = load_event(str(tmp_path), event_name)
+        smoothed_data, nse, peak_diff = apply_gaussian_smoothing(event, 10.0, show_plot=False)
+        saved = pd.read_csv(tmp_path / f"S_Event_{row['Event']}.csv")
+        np.testing.assert_allclose(saved['smoothed_discharge_cfs'], smoothed_data['smoothed_discharge_cfs'],
+                                   rtol=1e-12)
+        assert row['NSE'] == pytest.approx(nse, rel=1e-12)
+        assert row['Peak Difference'] == pytest.approx(peak_diff, rel=1e-9, abs=1e-12)
+
+        normalized_discharge, normalized_time = create_dimensionless_unit_hydrograph(smoothed_data)
+        duh = pd.read_csv(tmp_path / f"DUH_Event_{row['Event']}.csv")
+        np.testing.assert_allclose(duh['Normalized Discharge'], normalized_discharge, rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(duh['Normalized Time'], normalized_time, rtol=1e-12)
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import FIXTURE_DIR
+from app.regional import (shape_features, stack_site_curves, DuhShapeIndex, FEATURES, INDEX_FILE, CLUSTERS_FILE,
+                          main)
+from app.time_grid import TimeGrid
+
+
+def feature(features, name):
+    return features[:, FEATURES.index(name)]
+
+
+# Gamma-shaped DUHs peaking at 1: low `shape` values are flashy with a long tail, high ones are
+# narrow and symmetric. The first half of the sites are of the first kind, the second half of the other.
+def gamma_sites(n_sites, grid, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = np.r_[rng.uniform(2, 3, n_sites // 2), rng.uniform(6, 8, n_sites - n_sites // 2)]
+    curves = grid[None, :] ** (shape[:, None] - 1) * np.exp(-(shape[:, None] - 1) * (grid[None, :] - 1))
+    return [f"{site:08d}" for site in range(n_sites)], curves
+
+
+def test_triangle_features():
+    grid = np.linspace(0, 3, 30001)
+    curves = np.vstack([np.interp(grid, [0, 1, 3], [0, 1, 0]), np.interp(grid, [0, 1, 3], [0, 0.5, 0]),
+                        np.full(len(grid), np.nan)])
+    features = shape_features(grid, curves)
+
+    # A triangle rising over one time to peak and falling over two; halving it leaves its shape alone
+    expected = [1.0, 1.0, 0.9, 1.8, 1.5, 0.75, np.sqrt(2) * 20 / (5 * 7 ** 1.5)]
+    np.testing.assert_allclose(features[0], expected, rtol=1e-4)
+    np.testing.assert_allclose(np.delete(features[1], 1), np.delete(features[0], 1), rtol=1e-9)
+    assert feature(features, 'Peak Discharge')[1] == pytest.approx(0.5)
+    assert np.isnan(features[2]).all()
+
+
+def test_features_do_not_depend_on_the_grid():
+    sites, curves = gamma_sites(20, TimeGrid().axis(12))
+    dense = np.arange(0, 12.001, 0.001)
+    _, dense_curves = gamma_sites(20, dense)
+    np.testing.assert_allclose(shape_features(TimeGrid().axis(12), curves), shape_features(dense, dense_curves),
+                               atol=0.02)
+
+
+def test_site_curves_on_other_grids_are_interpolated():
+    short, long = TimeGrid().axis(4), TimeGrid().axis(9)
+    grid, matrix = stack_site_curves([short, long], [np.sin(short), np.cos(long)])
+    np.testing.assert_array_equal(grid, long)
+    np.testing.assert_array_equal(matrix[0, :len(short)], np.sin(short))
+    assert np.isnan(matrix[0, len(short):]).all()
+
+    # A site on the old evenly spaced grid puts every site on the TimeGrid
+    dense = np.arange(0, 9.001, 0.001)
+    grid, matrix = stack_site_curves([short, long, dense], [np.sin(short), np.cos(long), np.cos(dense)])
+    np.testing.assert_array_equal(grid, TimeGrid().axis(9))
+    inside = grid <= dense[-1]
+    np.testing.assert_allclose(matrix[2, inside], np.cos(grid[inside]), atol=1e-6)
+    np.testing.assert_allclose(matrix[1], np.cos(grid))
+    assert np.isnan(matrix[0, grid > short[-1]]).all()
+
+
+# Sites that all share the old evenly spaced grid are put on the TimeGrid too, not stacked as they are
+def test_sites_on_the_dense_grid_are_interpolated():
+    dense = np.arange(0, 10.001, 0.001)
+    grid, matrix = stack_site_curves([dense, dense], [np.sin(dense), np.cos(dense)])
+    np.testing.assert_array_equal(grid, TimeGrid().axis(10))
+    assert matrix.shape == (2, len(TimeGrid().axis(10)))
+    inside = grid <= dense[-1]
+    np.testing.assert_allclose(matrix[1, inside], np.cos(grid[inside]), atol=1e-6)
+
+
+@pytest.mark.parametrize('method', ['kmeans', 'hierarchical'])
+def test_clusters_separate_the_two_kinds_of_site(method):
+    grid = TimeGrid().axis(12)
+    sites, curves = gamma_sites(2000, grid)
+    index = DuhShapeIndex(sites, shape_features(grid, curves))
+    labels = index.cluster(2, method)
+
+    assert len(set(labels[:1000])) == 1 and len(set(labels[1000:])) == 1
+    assert labels[0] != labels[-1]
+    neighbours = index.nearest(sites[3], 10)
+    assert sites[3] not in neighbours['site_no'].tolist()
+    assert (neighbours['site_no'].astype(int) < 1000).all()
+    assert neighbours['Distance'].is_monotonic_increasing
+
+
+def test_index_round_trip(tmp_path):
+    grid = TimeGrid().axis(12)
+    sites, curves = gamma_sites(50, grid)
+    index = DuhShapeIndex(sites, shape_features(grid, curves))
+    index.save(str(tmp_path / INDEX_FILE))
+    loaded = DuhShapeIndex.load(str(tmp_path / INDEX_FILE))
+
+    pd.testing.assert_frame_equal(loaded.to_frame(), index.to_frame())
+    pd.testing.assert_frame_equal(loaded.nearest(sites[0], 3), index.nearest(sites[0], 3))
+    with pytest.raises(KeyError):
+        index.nearest('99999999')
+
+
+# Command line run on an output folder holding the fixture site and two scaled copies of its DUH
+def test_main_reads_the_site_folders(tmp_path, capsys):
+    committed = pd.read_csv(os.path.join(FIXTURE_DIR, "overall_duh.csv"))
+    for site_no, stretch in (("05125039", 1.0), ("00000001", 1.5), ("00000002", 0.8)):
+        os.makedirs(tmp_path / f"USGS{site_no}")
+        pd.DataFrame({'Normalized Time': committed['Normalized Time'] * stretch,
+                      'Normalized Discharge': committed['Normalized Discharge']}
+                     ).to_csv(tmp_path / f"USGS{site_no}" / "overall_duh.csv", index=False)
+    os.makedirs(tmp_path / "USGS00000003")
+    os.makedirs(tmp_path / "nwis_cache")
+
+    assert main([str(tmp_path), "--clusters", "2"]) == 0
+    clusters = pd.read_csv(tmp_path / CLUSTERS_FILE, dtype={'site_no': str})
+    assert clusters['site_no'].tolist() == ["00000001", "00000002", "05125039"]
+    peak_time = clusters.set_index('site_no')['Peak Time']
+    # The stretched sites are put on the default TimeGrid, 0.01 apart around the peak
+    assert peak_time['00000001'] == pytest.approx(1.5 * peak_time['05125039'], abs=0.01)
+    assert len(DuhShapeIndex.load(str(tmp_path / INDEX_FILE))) == 3
+    assert "for 3 sites" in capsys.readouterr().out
@@ -0,0 +1,55 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from conftest import FIXTURE_DIR
+from app.site_store import SiteStore, save_event, save_duh, list_events, load_event, event_source
+
+SITE_NO = "05125039"
+
+
+def fixture_event(event_no):
+    return pd.read_csv(os.path.join(FIXTURE_DIR, f"Event_{event_no}_2015.csv"), parse_dates=['datetimeUTC'],
+                       index_col='datetimeUTC')
+
+
+# Saving an event writes that event's files and index row only
+def test_saving_one_event_leaves_the_others(tmp_path):
+    store = SiteStore(str(tmp_path))
+    for event_no in (1, 2):
+        save_event(str(tmp_path), event_no, fixture_event(event_no), storage='store')
+    first = os.stat(store.partition_path('hydrographs', 1)).st_mtime_ns
+
+    save_event(str(tmp_path), 2, fixture_event(1), storage='store')
+    save_duh(str(tmp_path), 2, np.linspace(0, 1, 5), np.linspace(0, 2, 5), storage='store')
+
+    assert os.stat(store.partition_path('hydrographs', 1)).st_mtime_ns == first
+    assert list_events(str(tmp_path), storage='store') == ["Event_1_2015", "Event_2_2015"]
+    assert store.event_index()['points'].tolist() == [len(fixture_event(1))] * 2
+    assert store.event_index()['has_duh'].tolist() == [False, True]
+    assert event_source(str(tmp_path), "Event_2_2015", storage='store') == store.partition_path('hydrographs', 2)
+    pd.testing.assert_series_equal(load_event(str(tmp_path), "Event_2_2015", storage='store')['discharge_cfs'],
+                                   fixture_event(1)['discharge_cfs'].astype(np.float32).reset_index(drop=True))
+
+
+# Two sessions saving events of the same site at once keep all of them
+def test_concurrent_saves_keep_every_event(tmp_path):
+    start = threading.Barrier(2, timeout=10)
+
+    def save_events(event_numbers):
+        start.wait()
+        for event_no in event_numbers:
+            save_event(str(tmp_path), event_no, fixture_event(1 + event_no % 2), storage='store')
+
+    threads = [threading.Thread(target=save_events, args=(range(first, 21, 2),)) for first in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    store = SiteStore(str(tmp_path))
+    assert store.event_index()['event_no'].tolist() == list(range(1, 21))
+    assert store.partitions('hydrographs') == list(range(1, 21))
+
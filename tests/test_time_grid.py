@@ -0,0 +1,141 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import FIXTURE_DIR
+from app.time_grid import TimeGrid
+from app.duh_stack import load_duh_events, stack_duhs, STATE_FILE, ROWS_FOLDER
+from app.smoothing import process_smoothed_files
+from app.site_store import save_overall_duh
+
+DENSE_GRID = np.arange(0, 10.001, 0.001)
+
+
+def copy_duh_file(folder, event_no, name=None):
+    shutil.copy(os.path.join(FIXTURE_DIR, f"DUH_Event_{event_no}.csv"),
+                os.path.join(folder, name or f"DUH_Event_{event_no}.csv"))
+
+
+def test_grid_nodes_do_not_depend_on_the_end():
+    grid = TimeGrid()
+    longest = grid.axis(100)
+
+    for end in (0, 0.004, 2.5, 5.0, 5.01, 10, 37.2, 100):
+        axis = grid.axis(end)
+        np.testing.assert_array_equal(axis, longest[:len(axis)])
+        assert axis[-1] >= end and (len(axis) == 1 or axis[-2] < end)
+        assert grid.holds(axis)
+    assert np.all(np.diff(longest) > 0)
+    # Dense up to 5 times to peak, then 300 nodes per decade
+    assert len(grid.axis(10)) == 501 + 91
+    assert not grid.holds(DENSE_GRID)
+    assert not TimeGrid(max_time=10).holds(grid.axis(5))
+
+
+def test_grid_reaches_the_longest_event():
+    events = load_duh_events(FIXTURE_DIR)
+    axis = TimeGrid().axis_for(events)
+    assert axis[-1] >= max(time.max() for _, time, _ in events)
+    assert len(TimeGrid(max_time=3).axis_for(events)) == 301
+
+
+# The adaptive grid's nodes carry the same values as the dense grid, and the DUHs read between the
+# nodes by linear interpolation stay close to the dense ones
+def test_grid_keeps_the_dense_grid_accuracy():
+    events = load_duh_events(FIXTURE_DIR)
+    axis = TimeGrid().axis_for(events)
+    dense, _ = stack_duhs(events, DENSE_GRID)
+    adaptive, _ = stack_duhs(events, axis)
+
+    assert len(axis) * 10 < len(DENSE_GRID)
+    shared = np.flatnonzero(np.isin(DENSE_GRID, axis))
+    np.testing.assert_array_equal(adaptive[:, np.searchsorted(axis, DENSE_GRID[shared])], dense[:, shared])
+    for row in range(len(events)):
+        covered = ~np.isnan(dense[row]) & (DENSE_GRID <= axis[~np.isnan(adaptive[row])][-1])
+        between = np.interp(DENSE_GRID[covered], axis, np.nan_to_num(adaptive[row]))
+        np.testing.assert_allclose(between, dense[row, covered], atol=1e-3)
+
+
+@pytest.mark.parametrize('storage', ['csv', 'store'])
+def test_overall_duh_file_holds_the_grid(tmp_path, storage):
+    for event_no in (1, 2):
+        copy_duh_file(tmp_path, event_no)
+    overall_duh_df, _ = process_smoothed_files(str(tmp_path), storage='csv')
+    save_overall_duh(str(tmp_path), overall_duh_df, storage)
+
+    if storage == 'csv':
+        saved = pd.read_csv(tmp_path / "overall_duh.csv")
+    else:
+        from app.site_store import SiteStore
+        saved = SiteStore(str(tmp_path)).get_overall_duh()
+    np.testing.assert_array_equal(saved['Normalized Time'], TimeGrid().axis_for(load_duh_events(str(tmp_path))))
+
+
+# A longer event added to the running state pads the grid instead of starting over; the result is
+# the same as stacking every event from scratch
+def test_running_state_follows_the_longest_event(tmp_path, notifications):
+    copy_duh_file(tmp_path, 2, "DUH_Event_1.csv")
+    first, _ = process_smoothed_files(str(tmp_path))
+    assert first['Normalized Time'].iloc[-1] < 5
+
+    copy_duh_file(tmp_path, 1, "DUH_Event_2.csv")
+    overall_duh_df, matrix = process_smoothed_files(str(tmp_path), notify=notifications, with_matrix=True)
+    expected_df, expected_matrix = process_smoothed_files(str(tmp_path), incremental=False, with_matrix=True)
+
+    assert notifications.messages('info')[0] == "Updated overall DUH: 1 added, 0 changed, 0 removed."
+    np.testing.assert_array_equal(overall_duh_df['Normalized Time'], expected_df['Normalized Time'])
+    np.testing.assert_array_equal(overall_duh_df['Normalized Time'].iloc[:len(first)], first['Normalized Time'])
+    np.testing.assert_array_equal(matrix, expected_matrix)
+    np.testing.assert_allclose(overall_duh_df['Normalized Discharge'], expected_df['Normalized Discharge'], atol=1e-6)
+
+    # Removing the long event trims the grid again
+    os.remove(tmp_path / "DUH_Event_2.csv")
+    trimmed, _ = process_smoothed_files(str(tmp_path))
+    np.testing.assert_array_equal(trimmed['Normalized Time'], first['Normalized Time'])
+    np.testing.assert_allclose(trimmed['Normalized Discharge'], first['Normalized Discharge'], atol=1e-6)
+
+
+# The state file only holds the sums and the manifest; each event's row is written once, and a
+# change to one event rewrites only that event's row
+def test_running_state_keeps_rows_out_of_the_state_file(tmp_path):
+    for event_no in range(1, 9):
+        copy_duh_file(tmp_path, 1 + event_no % 2, f"DUH_Event_{event_no}.csv")
+    process_smoothed_files(str(tmp_path))
+    with np.load(tmp_path / STATE_FILE) as saved:
+        assert 'rows' not in saved.files and len(saved['names']) == 8
+    rows = {name: os.stat(tmp_path / ROWS_FOLDER / name).st_mtime_ns for name in os.listdir(tmp_path / ROWS_FOLDER)}
+    assert len(rows) == 8
+
+    copy_duh_file(tmp_path, 1, "DUH_Event_3.csv")
+    os.remove(tmp_path / "DUH_Event_8.csv")
+    overall_duh_df, matrix = process_smoothed_files(str(tmp_path), with_matrix=True)
+    expected_df, expected_matrix = process_smoothed_files(str(tmp_path), incremental=False, with_matrix=True)
+
+    after = {name: os.stat(tmp_path / ROWS_FOLDER / name).st_mtime_ns for name in os.listdir(tmp_path / ROWS_FOLDER)}
+    assert len(after) == 7
+    assert [name for name in after if name not in rows] == [name for name in after if name.startswith("DUH_Event_3.")]
+    assert all(after[name] == rows[name] for name in after if name in rows)
+    np.testing.assert_array_equal(matrix, expected_matrix)
+    np.testing.assert_allclose(overall_duh_df['Normalized Discharge'], expected_df['Normalized Discharge'], atol=1e-6)
+
+
+# A refresh takes the mean and Std from the running sums; the event rows are only read when the
+# percentile bands or the matrix are asked for
+def test_running_state_refresh_does_not_read_the_rows(tmp_path):
+    for event_no in (1, 2):
+        copy_duh_file(tmp_path, event_no)
+    expected_df, _ = process_smoothed_files(str(tmp_path), incremental=False)
+    process_smoothed_files(str(tmp_path))
+    for name in os.listdir(tmp_path / ROWS_FOLDER):
+        os.remove(tmp_path / ROWS_FOLDER / name)
+
+    overall_duh_df, matrix = process_smoothed_files(str(tmp_path))
+    assert matrix is None and 'Median Normalized Discharge' not in overall_duh_df
+    np.testing.assert_allclose(overall_duh_df['Normalized Discharge'], expected_df['Normalized Discharge'], atol=1e-6)
+    np.testing.assert_allclose(overall_duh_df['Std Normalized Discharge'], expected_df['Std Normalized Discharge'],
+                               atol=1e-6)
+    with pytest.raises(FileNotFoundError):
+        process_smoothed_files(str(tmp_path), with_matrix=True)